@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+
+benchmark.py
+============
+
+Desc: Measure yolk commands against a local stand-in PyPI
+
+      Boots `fakepypi.FakePyPI` with a synthetic catalogue, puts fake
+      installed packages (.egg-info dirs for older versions of some of
+      the catalogue's packages) on PYTHONPATH and runs each yolk command
+      in a fresh process with an empty ~/.yolk, reporting wall time,
+      the number of requests the server saw and peak memory (RSS).
+
+      Results can be saved with --save and compared against with
+      --baseline, which exits with status 1 on a regression.
+
+      e.g. python tests/benchmark.py --packages 2000 --latency 20
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakepypi import Catalogue, FakePyPI
+
+
+#Commands to time. PKG is replaced by a package in the catalogue.
+COMMANDS = [['-l'], ['-U'], ['-V', 'PKG'], ['-D', 'PKG'], ['-C', '24'],
+        ['-S', 'name=pkg-00']]
+
+#Runs yolk in a child process against the fake server, then records its
+#peak memory use
+BOOTSTRAP = """
+import os, resource, sys
+import yolk.pypi
+yolk.pypi.XML_RPC_SERVER = os.environ['YOLK_BENCH_SERVER']
+import yolk.cli
+sys.argv[0] = 'yolk'
+try:
+    yolk.cli.main()
+finally:
+    open(os.environ['YOLK_BENCH_RUSAGE'], 'w').write(
+            str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+"""
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_installed(directory, catalogue, count):
+    """
+    Create .egg-info dirs for `count` packages of the catalogue, installed
+    at their oldest version so -U has something to report
+    """
+    for name in catalogue.names[:count]:
+        version = catalogue.versions[-1]
+        egg_info = os.path.join(directory, "%s-%s.egg-info" % \
+                (name.replace('-', '_'), version))
+        os.mkdir(egg_info)
+        pkg_info = open(os.path.join(egg_info, 'PKG-INFO'), 'w')
+        pkg_info.write("Metadata-Version: 1.0\nName: %s\nVersion: %s\n" \
+                "Summary: Synthetic package\n" % (name, version))
+        pkg_info.close()
+
+
+def run_command(server, args, env, warm):
+    """
+    Run yolk with `args` and measure it
+
+    @param warm: run it once first, so caches in ~/.yolk are filled
+    @type warm: boolean
+
+    @returns: dict with seconds, requests and maxrss_kb
+    """
+    home = tempfile.mkdtemp()
+    rusage_file = os.path.join(home, 'rusage')
+    env = dict(env, HOME=home, YOLK_BENCH_SERVER=server.url,
+            YOLK_BENCH_RUSAGE=rusage_file)
+    cmd = [sys.executable, '-c', BOOTSTRAP] + args
+    devnull = open(os.devnull, 'w')
+    try:
+        if warm:
+            subprocess.call(cmd, env=env, stdout=devnull, stderr=devnull)
+        server.reset()
+        start = time.time()
+        status = subprocess.call(cmd, env=env, stdout=devnull,
+                stderr=devnull)
+        seconds = time.time() - start
+        maxrss = int(open(rusage_file).read())
+    finally:
+        devnull.close()
+        shutil.rmtree(home)
+    if sys.platform == 'darwin':
+        #Bytes, not kilobytes
+        maxrss //= 1024
+    return {'seconds': seconds, 'requests': server.requests(),
+            'counts': dict(server.counts), 'maxrss_kb': maxrss,
+            'status': status}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return list of regressions in `results` compared to `baseline`
+
+    Time and memory may grow by `tolerance` (0.2 is 20%), requests
+    must not grow at all.
+    """
+    regressions = []
+    for (command, result) in sorted(results.items()):
+        if not command in baseline:
+            continue
+        old = baseline[command]
+        if result['requests'] > old['requests']:
+            regressions.append("%s: %d requests, was %d" % (command,
+                result['requests'], old['requests']))
+        for field in ('seconds', 'maxrss_kb'):
+            if result[field] > old[field] * (1 + tolerance):
+                regressions.append("%s: %s %.2f, was %.2f" % (command, field,
+                    result[field], old[field]))
+    return regressions
+
+
+def setup_opt_parser():
+    """Return the OptionParser for the benchmark"""
+    opt_parser = optparse.OptionParser(usage="%prog [options]")
+    opt_parser.add_option("--packages", type='int', default=500,
+            help="Number of packages in the catalogue. Default: 500")
+    opt_parser.add_option("--versions", type='int', default=10,
+            help="Number of versions of each package. Default: 10")
+    opt_parser.add_option("--installed", type='int', default=50,
+            help="Number of those packages installed. Default: 50")
+    opt_parser.add_option("--latency", type='float', default=0,
+            metavar='MS', help="Milliseconds added to every request.")
+    opt_parser.add_option("--warm", action='store_true', default=False,
+            help="Measure with ~/.yolk caches already filled.")
+    opt_parser.add_option("--yolk-args", default="",
+            help="Extra arguments for every yolk command, " +
+            "e.g. '--backend xmlrpc'")
+    opt_parser.add_option("--save", metavar='FILE',
+            help="Save results as JSON.")
+    opt_parser.add_option("--baseline", metavar='FILE',
+            help="Compare with results saved by --save.")
+    opt_parser.add_option("--tolerance", type='float', default=0.2,
+            help="Allowed growth of time and memory over the baseline. " +
+            "Default: 0.2")
+    return opt_parser
+
+
+def main():
+    """Run the benchmark"""
+    (options, args) = setup_opt_parser().parse_args()
+    catalogue = Catalogue(options.packages, options.versions)
+    server = FakePyPI(catalogue, options.latency / 1000.0).start()
+    site_dir = tempfile.mkdtemp()
+    try:
+        make_installed(site_dir, catalogue, options.installed)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([TOP_DIR,
+            site_dir, os.environ.get('PYTHONPATH', '')]))
+        results = {}
+        print("%-18s %9s %9s %11s" % ("command", "seconds", "requests",
+            "maxrss MB"))
+        for command in COMMANDS:
+            args = [arg.replace('PKG', catalogue.names[0]) for arg in command]
+            args = options.yolk_args.split() + args
+            result = run_command(server, args, env, options.warm)
+            name = " ".join(command)
+            results[name] = result
+            print("%-18s %9.2f %9d %11.1f%s" % (name, result['seconds'],
+                result['requests'], result['maxrss_kb'] / 1024.0,
+                result['status'] and "  (exit status %s)" % result['status']
+                or ""))
+    finally:
+        server.stop()
+        shutil.rmtree(site_dir)
+
+    if options.save:
+        out = open(options.save, 'w')
+        json.dump(results, out, indent=2, sort_keys=True)
+        out.close()
+    if options.baseline:
+        regressions = compare(results, json.load(open(options.baseline)),
+                options.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+"""
+
+fakepypi.py
+===========
+
+Desc: Local stand-in for PyPI, for tests and benchmarks
+
+      Serves a synthetic catalogue of packages over the XML-RPC
+      interface (/pypi), the JSON API (/pypi/<name>/json) and a PEP 503
+      simple index (/simple/<name>/), with optional latency added to
+      every request. Requests are counted by kind, and the next few
+      requests can be made to fail with 503 Service Unavailable.
+      Responses are gzipped for clients that accept it, and gzipped
+      XML-RPC requests are understood.
+
+      Run it on its own with: python fakepypi.py [PACKAGES [VERSIONS]]
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import gzip
+import io
+import json
+import re
+import sys
+import threading
+import time
+if sys.version_info[0] == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+    from xmlrpc.server import SimpleXMLRPCDispatcher
+
+
+class Catalogue(object):
+
+    """
+    Synthetic package index
+
+    Package names look like 'Pkg-0042', versions go from '1.0' up to
+    '<versions>.0', and there is one release of every package in the
+    last `hours` hours for the changelog.
+    """
+
+    def __init__(self, packages=100, versions=5, hours=48):
+        self.names = ["Pkg-%04d" % i for i in range(packages)]
+        self.versions = ["%d.0" % i for i in range(versions, 0, -1)]
+        self.hours = hours
+        self.created = int(time.time())
+        self.keys = dict([(normalize_name(name), name) for name in self.names])
+
+    def find(self, name):
+        """Return the catalogue's name for a package name, or None"""
+        return self.keys.get(normalize_name(name))
+
+    def release_time(self, index):
+        """Return time of the latest release of the `index`th package"""
+        return self.created - (index * 3600 * self.hours) \
+                // max(len(self.names), 1)
+
+    def release_data(self, name, version):
+        """Return metadata of a release, like PyPI's release_data"""
+        return {'name': name, 'version': version,
+                'summary': 'Synthetic package %s' % name,
+                'home_page': 'http://example.com/%s' % name,
+                'license': 'BSD', 'author': 'yolk',
+                'download_url': 'UNKNOWN'}
+
+    def release_urls(self, name, version):
+        """Return files of a release, like PyPI's release_urls"""
+        base = "http://files.example.com/%s/%s-%s" % (name, name, version)
+        return [{'packagetype': 'sdist', 'url': base + '.tar.gz',
+                    'filename': base.rsplit('/', 1)[-1] + '.tar.gz'},
+                {'packagetype': 'bdist_egg',
+                    'url': base + '-py%d.%d.egg' % sys.version_info[:2],
+                    'filename': base.rsplit('/', 1)[-1] + \
+                            '-py%d.%d.egg' % sys.version_info[:2]}]
+
+    def changelog(self, since):
+        """Return PyPI-style changelog entries since a time, oldest first"""
+        entries = []
+        for i in range(len(self.names) - 1, -1, -1):
+            timestamp = self.release_time(i)
+            if timestamp >= since:
+                entries.append([self.names[i], self.versions[0], timestamp,
+                    'new release', len(self.names) - i])
+        return entries
+
+    def search(self, spec, operator):
+        """Match terms against names and summaries, like PyPI's search"""
+        results = []
+        for name in self.names:
+            metadata = self.release_data(name, self.versions[0])
+            matches = []
+            for (field, terms) in spec.items():
+                if not isinstance(terms, list):
+                    terms = [terms]
+                for term in terms:
+                    matches.append(term.strip().lower() in \
+                            str(metadata.get(field, "")).lower())
+            if (operator == 'or' and any(matches)) or \
+                    (operator != 'or' and matches and all(matches)):
+                results.append({'name': name, 'version': self.versions[0],
+                    'summary': metadata['summary'], '_pypi_ordering': 0})
+        return results
+
+
+class FakePyPI(ThreadingMixIn, HTTPServer):
+
+    """
+    HTTP server for a `Catalogue`
+
+    `url` is the XML-RPC URL, to put in `yolk.pypi.XML_RPC_SERVER`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalogue=None, latency=0, port=0, gzip=True):
+        """
+        @param catalogue: packages to serve, a default `Catalogue` if None
+        @type catalogue: `Catalogue`
+
+        @param latency: seconds to wait before answering each request
+        @type latency: float
+
+        @param port: port to listen on, any free port if 0
+        @type port: int
+
+        @param gzip: compress responses for clients that accept it
+        @type gzip: boolean
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakePyPIHandler)
+        if catalogue is None:
+            catalogue = Catalogue()
+        self.catalogue = catalogue
+        self.latency = latency
+        self.gzip = gzip
+        #Bytes of response bodies sent
+        self.sent = 0
+        self.url = 'http://127.0.0.1:%d/pypi' % self.server_address[1]
+        self.lock = threading.Lock()
+        self.counts = {}
+        #Number of coming requests to answer with 503
+        self.failures = 0
+        self.dispatcher = make_dispatcher(catalogue, self)
+        self.thread = None
+
+    def count(self, kind):
+        """Count a request of `kind`, e.g. 'xmlrpc' or 'json'"""
+        self.lock.acquire()
+        try:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+        finally:
+            self.lock.release()
+
+    def fail_next(self):
+        """Return True if this request should fail, see `failures`"""
+        self.lock.acquire()
+        try:
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def requests(self):
+        """Return total number of requests served"""
+        return sum(self.counts.values())
+
+    def reset(self):
+        """Reset request counts"""
+        self.lock.acquire()
+        try:
+            self.counts = {}
+            self.sent = 0
+        finally:
+            self.lock.release()
+
+    def start(self):
+        """Serve requests from a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self.shutdown()
+        self.server_close()
+
+
+class FakePyPIHandler(BaseHTTPRequestHandler):
+
+    """Answers XML-RPC, JSON API and simple index requests"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        """Be quiet"""
+        pass
+
+    def send(self, status, body, content_type='text/html'):
+        """Send a complete response"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if self.server.gzip and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip_bytes(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.server.lock.acquire()
+        try:
+            self.server.sent += len(body)
+        finally:
+            self.server.lock.release()
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """XML-RPC call, including system.multicall"""
+        self.server.count('xmlrpc')
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.fail_next():
+            return self.send(503, b'Service Unavailable')
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        response = self.server.dispatcher._marshaled_dispatch(data)
+        if not isinstance(response, bytes):
+            response = response.encode('utf-8')
+        self.send(200, response, 'text/xml')
+
+    def do_GET(self):
+        """JSON API document or simple index page"""
+        catalogue = self.server.catalogue
+        path = unquote(self.path.split('?')[0])
+        if self.server.fail_next():
+            self.server.count('failed')
+            return self.send(503, b'Service Unavailable')
+        match = re.match(r'^/pypi/([^/]+)/(?:([^/]+)/)?json$', path)
+        if match:
+            self.server.count('json')
+            name = catalogue.find(match.group(1))
+            version = match.group(2)
+            if not name or (version and version not in catalogue.versions):
+                return self.send(404, b'Not Found')
+            if version:
+                doc = {'info': catalogue.release_data(name, version),
+                        'urls': catalogue.release_urls(name, version)}
+            else:
+                doc = {'info': catalogue.release_data(name,
+                    catalogue.versions[0]),
+                    'releases': dict([(ver, catalogue.release_urls(name, ver))
+                        for ver in catalogue.versions]),
+                    'urls': catalogue.release_urls(name,
+                        catalogue.versions[0])}
+            return self.send(200, json.dumps(doc).encode('utf-8'),
+                    'application/json')
+        match = re.match(r'^/simple/([^/]+)/$', path)
+        if match:
+            self.server.count('simple')
+            name = catalogue.find(match.group(1))
+            if not name:
+                return self.send(404, b'Not Found')
+            links = []
+            for ver in catalogue.versions:
+                for release in catalogue.release_urls(name, ver):
+                    links.append('<a href="%s">%s</a><br/>' % (release['url'],
+                        release['filename']))
+            return self.send(200, ('<html><body>%s</body></html>' % \
+                    '\n'.join(links)).encode('utf-8'))
+        self.server.count('other')
+        self.send(404, b'Not Found')
+
+
+def make_dispatcher(catalogue, server):
+    """Return XML-RPC dispatcher with the PyPI methods yolk uses"""
+    dispatcher = SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
+    def package_releases(name, show_hidden=False):
+        #Like PyPI, only the latest release unless hidden ones are wanted
+        if catalogue.find(name) != name:
+            return []
+        if show_hidden:
+            return catalogue.versions
+        return catalogue.versions[:1]
+    def release_data(name, version):
+        if catalogue.find(name) != name or not version in catalogue.versions:
+            return {}
+        return catalogue.release_data(name, version)
+    def release_urls(name, version):
+        if catalogue.find(name) != name or not version in catalogue.versions:
+            return []
+        return catalogue.release_urls(name, version)
+    def changelog_since_serial(serial):
+        return [entry for entry in catalogue.changelog(0) if entry[4] > serial]
+    def updated_releases(since):
+        return [entry[:2] for entry in reversed(catalogue.changelog(since))]
+    def changelog(since, with_ids=False):
+        if with_ids:
+            return catalogue.changelog(since)
+        return [entry[:4] for entry in catalogue.changelog(since)]
+    dispatcher.register_function(lambda: catalogue.names, 'list_packages')
+    dispatcher.register_function(package_releases, 'package_releases')
+    dispatcher.register_function(release_data, 'release_data')
+    dispatcher.register_function(release_urls, 'release_urls')
+    dispatcher.register_function(lambda: len(catalogue.names),
+            'changelog_last_serial')
+    dispatcher.register_function(changelog_since_serial,
+            'changelog_since_serial')
+    dispatcher.register_function(updated_releases, 'updated_releases')
+    dispatcher.register_function(changelog, 'changelog')
+    dispatcher.register_function(catalogue.search, 'search')
+    dispatcher.register_multicall_functions()
+    return dispatcher
+
+
+def gzip_bytes(data):
+    """Return data gzipped"""
+    out = io.BytesIO()
+    gzip_file = gzip.GzipFile(fileobj=out, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return out.getvalue()
+
+
+def normalize_name(name):
+    """PEP 503 normalized name"""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+if __name__ == "__main__":
+    ARGS = [int(arg) for arg in sys.argv[1:3]]
+    SERVER = FakePyPI(Catalogue(*ARGS))
+    print("Serving %s" % SERVER.url)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,157 @@
+import socket
+import sys
+import unittest
+
+from fakepypi import Catalogue, FakePyPI
+
+#yolk.aiopypi is written with async/await, Python 3.5 onwards
+HAS_ASYNCIO = sys.version_info >= (3, 5)
+if HAS_ASYNCIO:
+    import asyncio
+    import xmlrpc.client as xmlrpclib
+    import yolk.aiopypi
+
+
+def read(data, head=False):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return loop.run_until_complete(yolk.aiopypi.read_response(reader,
+            head))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@unittest.skipIf(not HAS_ASYNCIO, "requires Python 3.5")
+class TestReadResponse (unittest.TestCase):
+    def test_content_length(self):
+        response = read(b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello")
+        self.assertEqual(200, response.status)
+        self.assertEqual(b"hello", response.body)
+        self.assertFalse(response.will_close)
+
+    def test_chunked(self):
+        response = read(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n"
+                b"\r\n3\r\nhel\r\n2\r\nlo\r\n0\r\n\r\n")
+        self.assertEqual(b"hello", response.body)
+
+    def test_read_until_close(self):
+        response = read(b"HTTP/1.0 404 Not Found\r\n\r\nmissing")
+        self.assertEqual(404, response.status)
+        self.assertEqual("Not Found", response.reason)
+        self.assertEqual(b"missing", response.body)
+        self.assertTrue(response.will_close)
+
+
+@unittest.skipIf(not HAS_ASYNCIO, "requires Python 3.5")
+class TestConnectionPool (unittest.TestCase):
+    def test_timeout(self):
+        #Accepts the connection but never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            pool = yolk.aiopypi.AsyncConnectionPool(timeout=0.1)
+            url = 'http://127.0.0.1:%d/pypi' % server.getsockname()[1]
+            loop = asyncio.new_event_loop()
+            try:
+                self.assertRaises(socket.timeout, loop.run_until_complete,
+                        pool.request('POST', url, b''))
+            finally:
+                loop.close()
+        finally:
+            server.close()
+
+
+@unittest.skipIf(not HAS_ASYNCIO, "requires Python 3.5")
+class TestAsyncCheeseShop (unittest.TestCase):
+    def setUp(self):
+        self.server = FakePyPI(Catalogue(20, 3)).start()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.shop = yolk.aiopypi.AsyncCheeseShop(self.server.url)
+
+    def tearDown(self):
+        self.shop.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        self.server.stop()
+
+    def run_coroutine(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def count_calls(self, obj, name, counts):
+        """Count calls of a coroutine method and how many run at once"""
+        method = getattr(obj, name)
+        counts.update({'calls': 0, 'running': 0, 'most': 0})
+        def finished(task):
+            counts['running'] -= 1
+        def counted(*args):
+            task = asyncio.ensure_future(method(*args), loop=self.loop)
+            counts['calls'] += 1
+            counts['running'] += 1
+            counts['most'] = max(counts['most'], counts['running'])
+            task.add_done_callback(finished)
+            return task
+        setattr(obj, name, counted)
+
+    def test_call(self):
+        self.assertEqual(['3.0'],
+                self.run_coroutine(self.shop.package_releases('Pkg-0001')))
+        self.assertEqual(['3.0', '2.0', '1.0'],
+                self.run_coroutine(self.shop.call('package_releases',
+                    'Pkg-0001', True)))
+        self.assertRaises(xmlrpclib.Fault, self.run_coroutine,
+                self.shop.call('no_such_method'))
+
+    def test_get_download_urls(self):
+        self.assertEqual(['http://files.example.com/Pkg-0001/'
+            'Pkg-0001-3.0.tar.gz'], self.run_coroutine(
+                self.shop.get_download_urls('Pkg-0001', pkg_type='source')))
+        self.assertEqual(['http://files.example.com/Pkg-0002/'
+            'Pkg-0002-2.0.tar.gz'], self.run_coroutine(
+                self.shop.get_download_urls('Pkg-0002', '2.0', 'source')))
+        #package_releases, then release_data and release_urls of a version
+        self.assertEqual(5, self.server.counts['xmlrpc'])
+
+    def test_concurrency_limit(self):
+        self.server.latency = 0.05
+        self.shop = yolk.aiopypi.AsyncCheeseShop(self.server.url,
+                max_concurrency=2)
+        counts = {}
+        self.count_calls(self.shop.pool, 'request', counts)
+        names = ['Pkg-%04d' % i for i in range(6)]
+        self.assertEqual([['3.0']] * 6, self.run_coroutine(asyncio.gather(
+            *[self.shop.package_releases(name) for name in names])))
+        self.assertEqual(6, counts['calls'])
+        self.assertEqual(2, counts['most'])
+
+    def test_connection_reuse(self):
+        counts = {}
+        self.count_calls(self.shop.pool, 'new_connection', counts)
+        for name in ('Pkg-0001', 'Pkg-0002', 'Pkg-0003'):
+            self.run_coroutine(self.shop.package_releases(name))
+        self.assertEqual(1, counts['calls'])
+        #The server drops the idle connection, so it is tried again on a
+        #new one
+        [(reader, writer)] = list(self.shop.pool.idle.values())[0]
+        reader.feed_eof()
+        self.assertEqual(['3.0'],
+                self.run_coroutine(self.shop.package_releases('Pkg-0004')))
+        self.assertEqual(2, counts['calls'])
+        self.assertEqual(5, self.server.counts['xmlrpc'])
+
+
+@unittest.skipIf(not HAS_ASYNCIO, "requires Python 3.5")
+class TestSplitHost (unittest.TestCase):
+    def test_split_host(self):
+        self.assertEqual(('pypi.org', 443),
+                yolk.aiopypi.split_host('pypi.org', 443))
+        self.assertEqual(('proxy', 3128),
+                yolk.aiopypi.split_host('proxy:3128', 80))
+        self.assertEqual(('::1', 8080),
+                yolk.aiopypi.split_host('[::1]:8080', 80))
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import yolk.cache
+
+
+class TestResponseCache (unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = yolk.cache.ResponseCache(
+                os.path.join(self.tmpdir, 'responses.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_set(self):
+        self.assertEqual(None, self.cache.get('package_releases', ('yolk',)))
+        self.cache.set('package_releases', ('yolk',), 'yolk', ['0.4.3'])
+        self.assertEqual(['0.4.3'],
+                self.cache.get('package_releases', ('yolk',)))
+
+    def test_uncached_method(self):
+        self.cache.set('search', ({'name': 'yolk'},), 'yolk', [])
+        self.assertEqual(None, self.cache.get('search', ({'name': 'yolk'},)))
+
+    def test_invalidate(self):
+        self.cache.set('release_data', ('yolk', '0.4.3'), 'yolk', {})
+        self.cache.set('release_data', ('nose', '1.0'), 'nose', {})
+        self.cache.invalidate(['yolk'])
+        self.assertEqual(None, self.cache.get('release_data', ('yolk', '0.4.3')))
+        self.assertEqual({}, self.cache.get('release_data', ('nose', '1.0')))
+
+    def test_ttl(self):
+        self.cache.ttls = {'package_releases': -1}
+        self.cache.set('package_releases', ('yolk',), 'yolk', ['0.4.3'])
+        self.assertEqual(None, self.cache.get('package_releases', ('yolk',)))
+
+    def test_evict_least_recently_used(self):
+        self.cache.set('release_urls', ('a', '1'), 'a', ['x' * 100])
+        self.cache.set('release_urls', ('b', '1'), 'b', ['x' * 100])
+        self.cache.get('release_urls', ('a', '1'))
+        self.cache.max_size = 200
+        self.cache.evict()
+        self.assertEqual(None, self.cache.get('release_urls', ('b', '1')))
+        self.assertNotEqual(None, self.cache.get('release_urls', ('a', '1')))
+
+    def test_serial(self):
+        self.assertEqual(None, self.cache.get_serial())
+        self.cache.set_serial(42)
+        self.assertEqual(42, self.cache.get_serial())
+
+    def test_database_errors(self):
+        self.cache.set_serial(42)
+        #Every query fails from now on
+        self.cache.conn.close()
+        self.assertEqual(None, self.cache.get_serial())
+        self.assertFalse(self.cache.set_serial(43))
+        self.assertFalse(self.cache.invalidate(['yolk']))
+        self.assertFalse(self.cache.clear())
+        self.cache.evict()
+        self.assertEqual((None, None, None),
+                self.cache.get_changelog_range())
+        self.assertEqual(None, self.cache.get('package_releases', ('yolk',)))
+
+
+class TestOpenResponseCache (unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'responses.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_damaged_file_is_replaced(self):
+        fileobj = open(self.filename, 'wb')
+        fileobj.write(b'not a database' * 100)
+        fileobj.close()
+        cache = yolk.cache.open_response_cache(self.filename)
+        cache.set('release_urls', ('foo', '1.0'), 'foo', ['x'])
+        self.assertEqual(['x'], cache.get('release_urls', ('foo', '1.0')))
+        cache.close()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import pkg_resources
+
+import yolk.envcache
+import yolk.utils
+import yolk.yolklib
+
+
+class TestEnvironmentSnapshot (unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.site = os.path.join(self.tmpdir, 'site-packages')
+        os.mkdir(self.site)
+        self.filename = os.path.join(self.tmpdir, 'yolk', 'installed.json')
+        self.add_egg_info('Foo', '1.0')
+        self.add_egg_info('bar', '2.0')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_egg_info(self, name, version):
+        egg_info = os.path.join(self.site, '%s-%s.egg-info' % (name, version))
+        os.mkdir(egg_info)
+        pkg_info = open(os.path.join(egg_info, 'PKG-INFO'), 'w')
+        pkg_info.write("Metadata-Version: 1.0\nName: %s\nVersion: %s\n" % \
+                (name, version))
+        pkg_info.close()
+        #Old enough for the modification times to be trusted
+        past = time.time() - 60 - len(os.listdir(self.site))
+        os.utime(os.path.join(egg_info, 'PKG-INFO'), (past, past))
+        os.utime(egg_info, (past, past))
+        os.utime(self.site, (past, past))
+
+    def load(self):
+        snapshot = yolk.envcache.EnvironmentSnapshot(self.filename)
+        (environment, working_set) = snapshot.load([self.site])
+        snapshot.save()
+        return (snapshot.scanned, environment, working_set)
+
+    def test_same_as_pkg_resources(self):
+        expected = pkg_resources.Environment([self.site])
+        for scans in (1, 0):
+            (scanned, environment, working_set) = self.load()
+            self.assertEqual(scans, scanned)
+            self.assertEqual(sorted(expected), sorted(environment))
+            for key in expected:
+                self.assertEqual(expected[key], environment[key])
+            self.assertEqual(list(pkg_resources.WorkingSet([self.site])),
+                    list(working_set))
+        self.assertEqual('1.0', environment['foo'][0].version)
+        self.assertTrue('Name: Foo' in
+                environment['foo'][0].get_metadata('PKG-INFO'))
+
+    def test_rescan_changed_entry(self):
+        self.load()
+        self.add_egg_info('Baz', '0.1')
+        (scanned, environment, working_set) = self.load()
+        self.assertEqual(1, scanned)
+        self.assertEqual('0.1', environment['baz'][0].version)
+        self.assertEqual(0, self.load()[0])
+
+    def test_rescan_changed_version_file(self):
+        #A develop install's Foo.egg-info has no version in its name
+        egg_info = os.path.join(self.site, 'Qux.egg-info')
+        os.mkdir(egg_info)
+        pkg_info = os.path.join(egg_info, 'PKG-INFO')
+        past = time.time() - 300
+        for (version, age) in (('1.0', 120), ('2.0', 60)):
+            open(pkg_info, 'w').write("Metadata-Version: 1.0\nName: Qux\n" \
+                    "Version: %s\n" % version)
+            os.utime(pkg_info, (time.time() - age, time.time() - age))
+            #Rewriting the file doesn't change the directories
+            os.utime(egg_info, (past, past))
+            os.utime(self.site, (past, past))
+            environment = self.load()[1]
+            self.assertEqual([version], [dist.version for dist
+                in environment['qux']])
+
+
+@unittest.skipIf(yolk.yolklib.importlib_metadata is None,
+        "requires importlib.metadata")
+class TestMetadataSnapshot (TestEnvironmentSnapshot):
+    def load(self):
+        snapshot = yolk.envcache.MetadataSnapshot(self.filename)
+        (environment, working_set) = snapshot.load([self.site])
+        snapshot.save()
+        return (snapshot.scanned, environment, working_set)
+
+    def test_same_as_pkg_resources(self):
+        expected = yolk.yolklib.MetadataDistributions([self.site])
+        for scans in (1, 0):
+            (scanned, environment, working_set) = self.load()
+            self.assertEqual(scans, scanned)
+            self.assertEqual([(str(dist), dist.location) for dist
+                in expected.working_set], [(str(dist), dist.location)
+                    for dist in working_set])
+        self.assertTrue('Name: Foo' in
+                environment['foo'][0].get_metadata('PKG-INFO'))
+
+
+class TestSnapshotFile (unittest.TestCase):
+    def test_file_per_interpreter_and_backend(self):
+        pkg_resources_file = yolk.utils.get_snapshot_file('pkg_resources')
+        importlib_file = yolk.utils.get_snapshot_file('importlib')
+        self.assertNotEqual(pkg_resources_file, importlib_file)
+        self.assertTrue(('%d.%d' % sys.version_info[:2]) in importlib_file)
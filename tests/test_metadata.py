@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pkg_resources
+
+from yolk.metadata import get_metadata, parse_headers
+
+
+PKG_INFO = """Metadata-Version: 2.1
+Name: Foo
+Version: 1.0
+Summary: A package
+License: BSD, with a
+        long continuation
+Classifier: Programming Language :: Python
+Classifier: License :: OSI Approved :: BSD License
+Requires-Dist: bar (>=1.0)
+
+Name: Not a header
+Long description.
+"""
+
+
+class TestParseHeaders (unittest.TestCase):
+    def test_all_fields(self):
+        metadata = parse_headers(PKG_INFO.splitlines(True))
+        self.assertEqual(['Classifier', 'License', 'Metadata-Version',
+            'Name', 'Requires-Dist', 'Summary', 'Version'], sorted(metadata))
+        self.assertEqual('Foo', metadata['Name'])
+        self.assertEqual('BSD, with a\n        long continuation',
+                metadata['License'])
+        self.assertEqual(['Programming Language :: Python',
+            'License :: OSI Approved :: BSD License'], metadata['Classifier'])
+        self.assertEqual(['bar (>=1.0)'], metadata['Requires-Dist'])
+
+    def test_some_fields(self):
+        lines = iter(PKG_INFO.splitlines(True))
+        self.assertEqual({'Name': 'Foo', 'Version': '1.0'},
+                parse_headers(lines, ['name', 'VERSION']))
+        #Stopped reading at the header after the ones wanted
+        self.assertEqual('License: BSD, with a\n', next(lines))
+        self.assertEqual({'Version': '1.0', 'Classifier': [
+            'Programming Language :: Python',
+            'License :: OSI Approved :: BSD License']},
+            parse_headers(PKG_INFO.splitlines(True), ['version',
+                'classifier']))
+
+
+class TestGetMetadata (unittest.TestCase):
+    def test_egg_info(self):
+        site = tempfile.mkdtemp()
+        try:
+            egg_info = os.path.join(site, 'Foo-1.0.egg-info')
+            os.mkdir(egg_info)
+            pkg_info = open(os.path.join(egg_info, 'PKG-INFO'), 'w')
+            pkg_info.write(PKG_INFO)
+            pkg_info.close()
+            dist = list(pkg_resources.find_distributions(site))[0]
+            self.assertEqual(parse_headers(PKG_INFO.splitlines()),
+                    get_metadata(dist))
+            self.assertEqual({'Summary': 'A package'},
+                    get_metadata(dist, ['Summary']))
+        finally:
+            shutil.rmtree(site)
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import yolk.namestore
+
+
+class TestPackageNameStore (unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'pkg_list.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        names = ['yolk', 'Zope.Interface', 'nose', 'Paste', 'Zope.Interface']
+        yolk.namestore.write_name_store(self.filename, names)
+        store = yolk.namestore.PackageNameStore(self.filename)
+        self.assertEqual(4, len(store))
+        self.assertEqual('Zope.Interface', store.get('zope-interface'))
+        self.assertEqual('Paste', store.get('paste'))
+        self.assertTrue('yolk' in store)
+        self.assertFalse('spam' in store)
+        self.assertEqual(['Paste', 'Zope.Interface', 'nose', 'yolk'],
+                list(store.values()))
+        store.close()
+
+    def test_empty(self):
+        yolk.namestore.write_name_store(self.filename, [])
+        store = yolk.namestore.PackageNameStore(self.filename)
+        self.assertEqual(None, store.get('yolk'))
+        self.assertEqual([], list(store.values()))
+
+    def test_corrupt(self):
+        yolk.namestore.write_name_store(self.filename, ['yolk', 'nose'])
+        data = open(self.filename, 'rb').read()
+        open(self.filename, 'wb').write(data[:-3])
+        self.assertRaises(ValueError, yolk.namestore.PackageNameStore,
+                self.filename)
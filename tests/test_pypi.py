@@ -0,0 +1,324 @@
+import io
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+import yolk.pypi
+import yolk.simpleindex
+from fakepypi import Catalogue, FakePyPI
+
+
+class TestPkgIndex (unittest.TestCase):
+    def test_normalize_name(self):
+        self.assertEqual('zope-interface',
+                yolk.pypi.normalize_name('Zope.Interface'))
+        self.assertEqual('foo-bar', yolk.pypi.normalize_name('foo__-.Bar'))
+
+    def test_build_pkg_index(self):
+        pkg_index = yolk.pypi.build_pkg_index(['Zope.Interface', 'yolk'])
+        self.assertEqual('Zope.Interface', pkg_index['zope-interface'])
+        self.assertEqual('yolk', pkg_index['yolk'])
+
+
+class TestStreaming (unittest.TestCase):
+    def parse(self, data):
+        return list(yolk.pypi.iter_xmlrpc_array(io.BytesIO(data)))
+
+    def dumps(self, params, **kwargs):
+        data = yolk.pypi.xmlrpclib.dumps(params, methodresponse=True,
+                **kwargs)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    def test_items_match_xmlrpclib(self):
+        result = [['yolk', '0.4.3', 1234567890, 'new release'],
+                {'name': u'caf\xe9', 'ok': True, 'score': 1.5,
+                    'nothing': None, 'list': []},
+                'plain']
+        data = self.dumps((result,), allow_none=True)
+        self.assertEqual(yolk.pypi.xmlrpclib.loads(data)[0][0],
+                self.parse(data))
+
+    def test_fault(self):
+        data = self.dumps(yolk.pypi.xmlrpclib.Fault(1, 'oops'))
+        self.assertRaises(yolk.pypi.xmlrpclib.Fault, self.parse, data)
+
+
+class FakeXMLRPCBackend (object):
+    def __init__(self, versions):
+        self.versions = versions
+
+    def package_releases(self, package_name, show_hidden=False):
+        return self.versions
+
+    def release_urls(self, package_name, version):
+        return ['xmlrpc']
+
+
+class TestJSONBackend (unittest.TestCase):
+    def setUp(self):
+        self.shop = yolk.pypi.CheeseShop(no_cache=True, backend='json')
+        self.backend = self.shop.backend
+        self.fetched = []
+        self.docs = {'Foo/json': {
+            'info': {'name': 'Foo', 'version': '1.10'},
+            'releases': {'1.9': [{'url': 'a'}], '1.10': [{'url': 'b'}]},
+            'urls': [{'url': 'b'}]},
+            'Foo/1.9/json': {'info': {'name': 'Foo', 'version': '1.9'},
+            'urls': [{'url': 'a'}]}}
+        self.backend.fetch_json = self.fetch_json
+
+    def fetch_json(self, url):
+        self.fetched.append(url)
+        return self.docs.get(url.split('/', 4)[-1])
+
+    def test_sort_versions(self):
+        self.assertEqual(['1.10', '1.9', '1.0b1'],
+                yolk.pypi.sort_versions(['1.0b1', '1.9', '1.10']))
+        #Legacy versions are left out
+        self.assertEqual(['1.0'], yolk.pypi.sort_versions(['2004d', '1.0']))
+
+    def test_one_request_per_project(self):
+        self.assertEqual(['1.10'], self.shop.package_releases('Foo'))
+        self.assertEqual([{'url': 'a'}], self.shop.release_urls('Foo', '1.9'))
+        self.assertEqual('1.10', self.shop.release_data('Foo', '1.10')['version'])
+        self.assertEqual(['b', 'a'], self.shop.get_download_urls('Foo',
+            '1.10') + self.shop.get_download_urls('Foo', '1.9'))
+        self.assertEqual(1, len(self.fetched))
+
+    def test_release_metadata(self):
+        self.assertEqual('1.9', self.shop.release_data('Foo', '1.9')['version'])
+        self.assertEqual(None, self.shop.release_data('Foo', '0.1'))
+        self.assertEqual([], self.shop.package_releases('Bar'))
+
+    def test_download_url_without_files(self):
+        self.docs['Foo/json']['releases']['1.8'] = []
+        self.docs['Foo/1.8/json'] = {'urls': [], 'info': {'name': 'Foo',
+            'version': '1.8', 'download_url': 'http://f/Foo-1.8.tar.gz'}}
+        releases = list(self.backend.iter_release_files('Foo',
+            ['1.10', '1.9', '1.8'], True, 2))
+        self.assertEqual([(None, [{'url': 'b'}]), (None, [{'url': 'a'}])],
+                releases[:2])
+        self.assertEqual('http://f/Foo-1.8.tar.gz',
+                releases[2][0]['download_url'])
+        #Only the release without files needs its own request
+        self.assertEqual(2, len(self.fetched))
+
+    def test_fallback_on_error(self):
+        def broken(url):
+            raise yolk.pypi.JSONAPIError('no JSON here')
+        self.backend.fetch_json = broken
+        self.assertRaises(yolk.pypi.JSONAPIError,
+                self.shop.package_releases, 'Foo')
+        self.backend.fallback = FakeXMLRPCBackend(['1.0'])
+        self.assertEqual(['1.0'], self.shop.package_releases('Foo'))
+        self.assertTrue(self.backend.failed)
+        self.assertEqual(['xmlrpc'], self.shop.release_urls('Foo', '1.0'))
+
+    def test_latest_stable_release(self):
+        self.docs['Foo/json']['releases']['2.0rc1'] = [{'url': 'c'}]
+        self.docs['Foo/json']['releases']['1.10'] = [{'url': 'b',
+            'yanked': True}]
+        self.docs['Foo/json']['releases']['1.11'] = []
+        self.docs['Foo/json']['releases']['1.10.dev1'] = [{'url': 'd'}]
+        #Not a PEP 440 version
+        self.docs['Foo/json']['releases']['1.10-beta.win32'] = [{'url': 'e'}]
+        #Without setuptools too
+        pkg_resources = sys.modules.get('pkg_resources')
+        sys.modules['pkg_resources'] = None
+        try:
+            self.assertEqual(['1.9'], self.shop.package_releases('Foo'))
+        finally:
+            if pkg_resources is None:
+                del sys.modules['pkg_resources']
+            else:
+                sys.modules['pkg_resources'] = pkg_resources
+
+    def test_every_release(self):
+        self.docs['Foo/json']['releases']['2.0rc1'] = []
+        self.assertEqual(['2.0rc1', '1.10', '1.9'],
+                self.shop.package_releases('Foo', True))
+
+    def test_fallback_when_json_is_missing(self):
+        self.backend.fallback = FakeXMLRPCBackend(['1.0'])
+        self.assertEqual(['1.0'], self.shop.package_releases('Bar'))
+        self.assertTrue(self.backend.failed)
+
+
+class TestFakePyPI (unittest.TestCase):
+    def setUp(self):
+        self.server = FakePyPI(Catalogue(20, 3)).start()
+        self.old_server = yolk.pypi.XML_RPC_SERVER
+        yolk.pypi.XML_RPC_SERVER = self.server.url
+        self.yolk_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        yolk.pypi.XML_RPC_SERVER = self.old_server
+        self.server.stop()
+        shutil.rmtree(self.yolk_dir)
+
+    def test_backends_agree(self):
+        names = ['pkg_0001', 'missing', 'PKG-0002']
+        for backend in ('json', 'xmlrpc'):
+            shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir,
+                    backend=backend)
+            self.assertEqual([('Pkg-0001', ['3.0']), ('missing', []),
+                ('Pkg-0002', ['3.0'])],
+                list(shop.query_versions_pypi_many(names, 2)))
+            self.assertEqual(['3.0', '2.0', '1.0'],
+                    shop.package_releases('Pkg-0001', True))
+            self.assertEqual(1, len(shop.get_download_urls('pkg-0001',
+                pkg_type='source')))
+            shop.response_cache.clear()
+
+    def test_many_versions_in_multicalls(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir)
+        names = shop.list_packages()
+        self.server.reset()
+        self.assertEqual([['3.0']] * len(names), [versions for (name,
+            versions) in shop.query_versions_pypi_many(names, 2)])
+        #Batched, not a JSON document for each package
+        self.assertFalse('json' in self.server.counts)
+        self.assertTrue(self.server.counts['xmlrpc'] < len(names))
+
+    def test_name_store_in_use(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir)
+        names = shop.pkg_list
+        old_store = shop.pkg_index
+        last_sync = shop.query_last_sync()
+        write_name_store = yolk.pypi.write_name_store
+        def mapped_elsewhere(filename, names):
+            #The store must be closed before the file is replaced
+            self.assertRaises(ValueError, old_store.get, 'pkg-0001')
+            raise OSError(13, "The file is mapped by another process")
+        yolk.pypi.write_name_store = mapped_elsewhere
+        try:
+            shop.write_pkg_list(names + ['New-Pkg'], last_sync[1] + 1)
+        finally:
+            yolk.pypi.write_name_store = write_name_store
+        #Used for this run, synced again next time
+        self.assertEqual('New-Pkg', shop.find_package_name('new_pkg'))
+        self.assertEqual(last_sync, shop.query_last_sync())
+        self.assertEqual(None, yolk.pypi.CheeseShop(
+            yolk_dir=self.yolk_dir).pkg_index.get('new-pkg'))
+
+    def test_response_cache_not_validated(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir,
+                backend='xmlrpc')
+        self.assertEqual(['3.0'], shop.package_releases('Pkg-0001'))
+        #A stale response the changelog would have dropped
+        shop.response_cache.set('package_releases', ('Pkg-0001',),
+                'pkg-0001', ['0.1'])
+        shop.response_cache.close()
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir,
+                backend='xmlrpc')
+        def unreachable(method, *args):
+            raise socket.error(111, "Connection refused")
+        shop.stream_call = unreachable
+        self.assertEqual(['3.0'], shop.package_releases('Pkg-0001'))
+        self.assertEqual(None, shop.get_response_cache())
+
+    def test_download_urls_skip_metadata(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir,
+                backend='xmlrpc')
+        methods = []
+        multicall = shop.multicall
+        def record_calls(calls, jobs=1):
+            methods.extend([method for (method, args) in calls])
+            return multicall(calls, jobs)
+        shop.multicall = record_calls
+        urls = shop.iter_download_urls('Pkg-0001', pkg_type='source')
+        self.assertEqual('http://files.example.com/Pkg-0001/'
+                'Pkg-0001-3.0.tar.gz', next(urls))
+        self.assertEqual([], list(urls))
+        releases = list(shop.backend.iter_release_files('Pkg-0001',
+            ['3.0', '2.0', '1.0']))
+        self.assertEqual([None] * 3, [release_data for (release_data, files)
+            in releases])
+        self.assertEqual(['release_urls'] * 4, methods)
+
+    def test_retry_unavailable(self):
+        resilience = yolk.pypi.CONNECTION_POOL.resilience
+        retries = resilience.counters['retries']
+        for backend in ('json', 'xmlrpc'):
+            shop = yolk.pypi.CheeseShop(no_cache=True, backend=backend)
+            self.server.failures = 1
+            self.assertEqual(['3.0'], shop.package_releases('Pkg-0001'))
+        self.assertEqual(retries + 2, resilience.counters['retries'])
+
+    def test_gzip(self):
+        shop = yolk.pypi.CheeseShop(no_cache=True, compress_requests=True)
+        names = shop.list_packages()
+        self.assertEqual(self.server.catalogue.names, names)
+        #Multicall batches big enough to be compressed
+        calls = [('release_urls', (name, '1.0')) for name in names] * 10
+        shop.batch_size = len(calls)
+        results = list(shop.multicall(calls))
+        self.assertEqual(shop.xmlrpc.release_urls(names[0], '1.0'),
+                results[0])
+        self.assertEqual(names, list(shop.stream_call('list_packages')))
+        compressed = self.server.sent
+        self.server.gzip = False
+        self.server.reset()
+        self.assertEqual(names, shop.list_packages())
+        list(shop.multicall(calls))
+        list(shop.stream_call('list_packages'))
+        self.assertTrue(compressed < self.server.sent / 2)
+
+    def test_stream_changelog(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir)
+        calls = []
+        stream_call = shop.stream_call
+        def record_call(method, *args):
+            calls.append(method)
+            return stream_call(method, *args)
+        shop.stream_call = record_call
+        releases = shop.iter_updated_releases(48)
+        self.assertEqual(['Pkg-0000', '3.0'], next(releases))
+        #Nothing cached yet, the small updated_releases is streamed
+        self.assertEqual(['updated_releases'], calls)
+        self.assertEqual(20, len(list(releases)) + 1)
+        self.assertEqual(shop.xmlrpc.changelog(0), shop.changelog(48))
+
+    def test_cached_changelog(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir)
+        calls = []
+        stream_call = shop.stream_call
+        def record_call(method, *args):
+            calls.append(method)
+            return stream_call(method, *args)
+        shop.stream_call = record_call
+        changes = shop.changelog(48)
+        self.assertEqual(shop.xmlrpc.changelog(0), changes)
+        self.assertEqual(['changelog'], calls)
+        #The window is already cached, only newer entries are fetched
+        self.assertEqual(changes[10:], shop.changelog(23))
+        self.assertEqual(['changelog', 'changelog_since_serial'], calls)
+        self.assertEqual(shop.xmlrpc.updated_releases(0),
+                shop.updated_releases(48))
+        self.assertEqual('changelog_since_serial', calls[-1])
+        #A longer window than the cached one is fetched again
+        shop.changelog(72)
+        self.assertEqual('changelog', calls[-1])
+
+    def test_changelog_fetched_once(self):
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir)
+        changes = shop.changelog(48)
+        releases = shop.updated_releases(48)
+        shop.pkg_list
+        #Next run, with everything due to be brought up to date
+        shop = yolk.pypi.CheeseShop(yolk_dir=self.yolk_dir, max_age=-1)
+        self.server.reset()
+        shop.pkg_list
+        self.assertEqual(changes, shop.changelog(48))
+        self.assertEqual(releases, shop.updated_releases(48))
+        self.assertEqual({'xmlrpc': 1}, self.server.counts)
+
+    def test_simple_index(self):
+        self.assertEqual(
+                'http://files.example.com/Pkg-0003/Pkg-0003-2.0.tar.gz',
+                yolk.simpleindex.get_download_uri('pkg-0003', '2.0', True))
+        self.assertEqual(1, self.server.counts['simple'])
@@ -0,0 +1,65 @@
+import time
+import unittest
+
+from yolk.resilience import CircuitOpenError, Resilience, TransientError
+
+
+class Flaky (object):
+    def __init__(self, failures, error=None):
+        self.failures = failures
+        self.error = error or TransientError(503, 'Unavailable', 'url')
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+        return 'ok'
+
+
+class TestResilience (unittest.TestCase):
+    def setUp(self):
+        self.policy = Resilience(retries=2, backoff=0, breaker_threshold=3)
+
+    def test_retry(self):
+        func = Flaky(2)
+        self.assertEqual('ok', self.policy.call('host', func))
+        self.assertEqual(3, func.calls)
+        self.assertEqual(2, self.policy.counters['retries'])
+
+    def test_give_up(self):
+        func = Flaky(5)
+        self.assertRaises(TransientError, self.policy.call, 'host', func)
+        self.assertEqual(3, func.calls)
+        func = Flaky(1)
+        self.assertRaises(TransientError, self.policy.call, 'other', func,
+                idempotent=False)
+        self.assertEqual(1, func.calls)
+
+    def test_no_retry_for_other_errors(self):
+        func = Flaky(1, ValueError('bad'))
+        self.assertRaises(ValueError, self.policy.call, 'host', func)
+        self.assertEqual(1, func.calls)
+
+    def test_circuit_breaker(self):
+        self.assertRaises(TransientError, self.policy.call, 'host', Flaky(5))
+        func = Flaky(0)
+        self.assertRaises(CircuitOpenError, self.policy.call, 'host', func)
+        self.assertEqual(0, func.calls)
+        self.assertEqual('ok', self.policy.call('other', func))
+        self.policy.breaker_reset = 0
+        self.assertEqual('ok', self.policy.call('host', func))
+
+    def test_hedge(self):
+        policy = Resilience(hedge_percentile=50)
+        policy.latencies = [0.01] * 20
+        calls = []
+        def slow_once():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'fast'
+        self.assertEqual('fast', policy.call('host', slow_once))
+        self.assertEqual(1, policy.counters['hedged'])
+        self.assertEqual(1, policy.counters['hedge_wins'])
@@ -0,0 +1,96 @@
+import unittest
+
+import yolk.simpleindex
+
+
+PAGE = """<html><head><base href="http://files.example.com/pkgs/"></head>
+<body>
+<a href="yolk-0.4.1.tar.gz#sha256=ab">yolk-0.4.1.tar.gz</a>
+<a href="yolk-0.4.3.zip">yolk-0.4.3.zip</a>
+<a href="yolk-0.4.3-py1-none-any.whl">yolk-0.4.3-py1-none-any.whl</a>
+<a href="yolk-0.4.3-py2.py3-none-any.whl">yolk-0.4.3-py2.py3-none-any.whl</a>
+<a href="yolk-0.5.tar.gz" data-yanked="">yolk-0.5.tar.gz</a>
+<a href="yolk_extras-1.0.tar.gz">yolk_extras-1.0.tar.gz</a>
+<a href="http://svn.example.com/yolk/trunk#egg=yolk-dev">dev</a>
+</body></html>"""
+
+
+class FakeSimpleIndex (yolk.simpleindex.SimpleIndex):
+    reads = 0
+
+    def iter_links(self, project_name):
+        self.reads += 1
+        links = []
+        parser = yolk.simpleindex.LinkParser(self.project_url(project_name),
+                lambda link, attrs: links.append((link, attrs)))
+        #Feed it in small pieces, the way it is read
+        for i in range(0, len(PAGE), 7):
+            parser.feed(PAGE[i:i + 7])
+            while links:
+                yield links.pop(0)
+        parser.close()
+
+
+class TestSimpleIndex (unittest.TestCase):
+    def setUp(self):
+        self.index = FakeSimpleIndex('http://mirror.example.com/simple')
+
+    def test_project_url(self):
+        self.assertEqual('http://mirror.example.com/simple/zope-interface/',
+                self.index.project_url('Zope.Interface'))
+
+    def test_get_file_version(self):
+        get_file_version = yolk.simpleindex.get_file_version
+        self.assertEqual('1.0',
+                get_file_version('zope.interface-1.0.tar.gz',
+                    'Zope.Interface', True))
+        self.assertEqual(None, get_file_version('yolk_extras-1.0.tar.gz',
+            'yolk', True))
+        self.assertEqual(None, get_file_version('yolk-1.0.egg', 'yolk', True))
+        self.assertEqual('1.0-1', get_file_version('yolk-1.0_1.egg', 'yolk',
+            False))
+        #bdist_dumb archives
+        self.assertEqual(None, get_file_version('yolk-1.0.win32.zip', 'yolk',
+            True))
+        self.assertEqual(None, get_file_version(
+            'yolk-1.0.linux-x86_64.tar.gz', 'yolk', True))
+
+    def test_unparsed_version_skipped(self):
+        links = self.index.scan('yolk')
+        links.sources.append(('1.0.win32',
+            'http://files.example.com/pkgs/yolk-1.0.win32.zip', False))
+        self.assertEqual('http://files.example.com/pkgs/yolk-0.4.3.zip',
+                links.find_download_uri(None, True))
+
+    def test_highest_version(self):
+        self.assertEqual('http://files.example.com/pkgs/yolk-0.4.3.zip',
+                self.index.find_download_uri('yolk', None, True))
+
+    def test_exact_version(self):
+        self.assertEqual('http://files.example.com/pkgs/yolk-0.4.1.tar.gz',
+                self.index.find_download_uri('yolk', '0.4.1', True))
+        self.assertEqual('http://files.example.com/pkgs/yolk-0.5.tar.gz',
+                self.index.find_download_uri('yolk', '0.5', True))
+        self.assertEqual(None,
+                self.index.find_download_uri('yolk', '0.4.1', False))
+
+    def test_wheel(self):
+        self.assertEqual(
+                'http://files.example.com/pkgs/yolk-0.4.3-py2.py3-none-any.whl',
+                self.index.find_download_uri('yolk', None, False))
+
+    def test_dev(self):
+        self.assertEqual('http://svn.example.com/yolk/trunk',
+                self.index.find_download_uri('yolk', 'dev', True))
+
+    def test_scan_once(self):
+        links = self.index.scan('yolk')
+        self.assertEqual(['0.4.1', '0.4.3', '0.5'],
+                [version for (version, url, yanked) in links.sources])
+        self.assertEqual(['0.4.3'],
+                [version for (version, url, yanked) in links.binaries])
+        self.assertEqual(['http://svn.example.com/yolk/trunk'], links.dev)
+        self.index.find_download_uri('Yolk', None, True)
+        self.index.find_download_uri('yolk', None, False)
+        self.index.find_download_uri('yolk', 'dev', True)
+        self.assertEqual(1, self.index.reads)
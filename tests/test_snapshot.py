@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import yolk.pypi
+import yolk.snapshot
+
+
+class FakeShop (object):
+    pkg_list = ['Foo', 'Zope.Interface', 'bar']
+
+    def __init__(self):
+        self.backend = self
+
+    def find_package_name(self, package_name):
+        return yolk.pypi.build_pkg_index(self.pkg_list).get(
+                yolk.pypi.normalize_name(package_name))
+
+    def package_releases(self, package_name, show_hidden=False):
+        if show_hidden:
+            return ['2.0', '1.0']
+        return ['2.0']
+
+    def get_releases(self, package_name, versions, metadata=True):
+        return [({'name': package_name, 'version': ver,
+            'summary': '%s summary' % package_name},
+            [{'url': 'http://f/%s-%s.zip' % (package_name, ver)}])
+            for ver in versions]
+
+
+class TestSnapshot (unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'snapshot.db')
+        self.assertEqual(2, yolk.snapshot.write_snapshot(FakeShop(),
+            self.filename, ['foo', 'zope_interface', 'missing']))
+        self.shop = yolk.pypi.CheeseShop(snapshot=self.filename)
+
+    def tearDown(self):
+        self.shop.snapshot.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_names(self):
+        self.assertEqual('Zope.Interface',
+                self.shop.find_package_name('zope-interface'))
+        self.assertEqual(['Foo', 'Zope.Interface', 'bar'],
+                self.shop.list_packages())
+        self.assertEqual(None, self.shop.find_package_name('missing'))
+
+    def test_releases(self):
+        self.assertEqual(('Foo', ['2.0', '1.0']),
+                self.shop.query_versions_pypi('FOO'))
+        self.assertEqual(['bar', []], list(self.shop.query_versions_pypi(
+            'bar')))
+        self.assertEqual('1.0', self.shop.release_data('Foo', '1.0')['version'])
+        self.assertEqual(None, self.shop.release_data('Foo', '3.0'))
+        self.assertEqual(['http://f/Foo-2.0.zip', 'http://f/Foo-1.0.zip'],
+                self.shop.get_download_urls('foo'))
+
+    def test_search(self):
+        self.assertEqual(['Zope.Interface', 'Zope.Interface'],
+                [pkg['name'] for pkg in self.shop.search({'name': 'ZOPE'},
+                    'and')])
+        self.assertEqual(4, len(self.shop.search({'name': 'zope',
+            'summary': 'foo'}, 'or')))
+        self.assertEqual([], self.shop.search({'name': 'zope',
+            'summary': 'foo'}, 'and'))
+
+    def test_missing_snapshot(self):
+        self.assertRaises(IOError, yolk.pypi.CheeseShop,
+                snapshot=os.path.join(self.tmpdir, 'none.db'))
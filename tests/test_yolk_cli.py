@@ -1,5 +1,6 @@
 import unittest
 
+import yolk.utils
 import yolk.yolklib
 
 
@@ -117,3 +118,109 @@ class TestYolkLib (unittest.TestCase):
     def test_get_highest_version(self):
         versions = ['2.2', '3.0.5', '1.3', '3.1.2', '1.3.4', '0.3', '3.1.1', '1.2.4']
         self.assertEqual('3.1.2', yolk.yolklib.get_highest_version(versions))
+        self.assertEqual('1.10', yolk.yolklib.get_highest_version(['1.9',
+            '1.10rc1', '1.10', '1.10.dev2']))
+
+    def test_get_distributions(self):
+        import pkg_resources
+        dists = yolk.yolklib.Distributions()
+        dists.environment = pkg_resources.Environment([])
+        dists.working_set = pkg_resources.WorkingSet([])
+        for (name, version, location) in [('Foo', '1.0', '/a'),
+                ('Foo', '2.0', '/b'), ('bar', '0.1', '/a')]:
+            dist = pkg_resources.Distribution(location, project_name=name,
+                    version=version)
+            dists.environment.add(dist)
+            if version != '2.0':
+                dists.working_set.add(dist)
+        self.assertEqual([('Foo', '1.0', True), ('Foo', '2.0', False),
+            ('bar', '0.1', True)],
+            [(dist.project_name, dist.version, active) for (dist, active)
+                in dists.get_distributions("all")])
+        self.assertEqual(['2.0'], [dist.version for (dist, active)
+            in dists.get_distributions("nonactive", "Foo")])
+        self.assertEqual(['1.0'], [dist.version for (dist, active)
+            in dists.get_distributions("active", "Foo", "1.0")])
+        self.assertEqual([], list(dists.get_distributions("all", "foo")))
+
+    @unittest.skipIf(yolk.yolklib.importlib_metadata is None,
+            "requires importlib.metadata")
+    def test_metadata_distributions(self):
+        import os
+        import shutil
+        import sys
+        import tempfile
+        import pkg_resources
+        site = tempfile.mkdtemp()
+        try:
+            egg = 'Foo-2.0-py%d.%d.egg' % sys.version_info[:2]
+            for (directory, filename, name, version) in [
+                    ('Foo-1.0.egg-info', 'PKG-INFO', 'Foo', '1.0'),
+                    ('bar-0.1.dist-info', 'METADATA', 'bar', '0.1'),
+                    (egg + '/EGG-INFO', 'PKG-INFO', 'Foo', '2.0'),
+                    ('Baz-1.0-py1.5.egg/EGG-INFO', 'PKG-INFO', 'Baz', '1.0')]:
+                os.makedirs(os.path.join(site, directory))
+                metadata = open(os.path.join(site, directory, filename), 'w')
+                metadata.write("Metadata-Version: 1.1\nName: %s\n" \
+                        "Version: %s\n" % (name, version))
+                metadata.close()
+            dists = yolk.yolklib.MetadataDistributions([site])
+            self.assertEqual([('Foo', '1.0', True, site),
+                ('Foo', '2.0', False, os.path.join(site, egg)),
+                ('bar', '0.1', True, site)],
+                [(dist.project_name, dist.version, active, dist.location)
+                    for (dist, active) in dists.get_distributions("all")])
+            expected = pkg_resources.Environment([site])
+            self.assertEqual(sorted(expected), sorted(dists.environment))
+            self.assertEqual('2.0', dists.get_highest_installed('foo'))
+            self.assertEqual('Foo', dists.case_sensitive_name('FOO'))
+            dist = dists.working_set.by_key['bar']
+            self.assertTrue('Name: bar' in dist.get_metadata('PKG-INFO'))
+            self.assertEqual(['Foo', 'bar'], yolk.yolklib.get_pkglist(dists))
+        finally:
+            shutil.rmtree(site)
+
+
+class TestUtils (unittest.TestCase):
+    def test_parallel_map_keeps_order(self):
+        import time
+        def slow_square(num):
+            time.sleep(0.01 * (5 - num))
+            return num * num
+        results = list(yolk.utils.parallel_map(slow_square, range(5), 4))
+        self.assertEqual([0, 1, 4, 9, 16], results)
+
+    def test_parallel_map_serial(self):
+        self.assertEqual(['A', 'B'],
+                list(yolk.utils.parallel_map(str.upper, ['a', 'b'], 1)))
+
+    def test_atomic_write(self):
+        import os
+        import shutil
+        import tempfile
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'data')
+            yolk.utils.atomic_write(filename, b'old')
+            yolk.utils.atomic_write(filename, b'new')
+            self.assertEqual(b'new', open(filename, 'rb').read())
+            self.assertEqual(['data'], os.listdir(tmp_dir))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_file_lock_is_exclusive(self):
+        import os
+        import shutil
+        import tempfile
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'lock')
+            lock = yolk.utils.FileLock(filename)
+            other = yolk.utils.FileLock(filename)
+            self.assertTrue(lock.acquire())
+            self.assertFalse(other.acquire(blocking=False))
+            lock.release()
+            self.assertTrue(other.acquire(blocking=False))
+            other.release()
+        finally:
+            shutil.rmtree(tmp_dir)
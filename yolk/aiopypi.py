@@ -0,0 +1,382 @@
+"""
+
+aiopypi.py
+==========
+
+Desc: asyncio interface to The CheeseShop (PyPI a.k.a. Python Package Index)
+
+      `AsyncCheeseShop` offers the same queries as `yolk.pypi.CheeseShop`
+      as coroutines, so it can be used from an asyncio event loop without
+      blocking it. All calls share a pool of keep-alive connections and
+      a limit on how many requests are in flight at once.
+
+      Requires Python 3.5 or later.
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import asyncio
+import logging
+import os
+import socket
+import xmlrpc.client as xmlrpclib
+from urllib.parse import urlparse
+
+from yolk.__init__ import __version__ as VERSION
+from yolk.pypi import XML_RPC_SERVER, add_download_urls, get_proxy, \
+        get_seconds
+from yolk.resilience import REQUEST_TIMEOUT
+
+
+#Maximum number of requests in flight at once
+MAX_CONCURRENCY = 20
+
+
+class HTTPResponse(object):
+
+    """Status, headers and body of a HTTP response"""
+
+    def __init__(self, status, reason, headers, body, will_close):
+        self.status = status
+        self.reason = reason
+        #Header names are lower case
+        self.headers = headers
+        self.body = body
+        #True if the server will close the connection
+        self.will_close = will_close
+
+
+class AsyncConnectionPool(object):
+
+    """
+    Pool of persistent HTTP/1.1 connections for asyncio
+
+    Idle connections are kept per (scheme, host) and requests are routed
+    through the proxy set in the environment, like `yolk.pypi.ConnectionPool`.
+    Note: HTTPS through a proxy needs Python 3.11 or later.
+    """
+
+    def __init__(self, max_idle=MAX_CONCURRENCY, timeout=REQUEST_TIMEOUT):
+        """
+        @param max_idle: maximum number of idle connections kept per host
+        @type max_idle: int
+
+        @param timeout: seconds a request may take, including connecting,
+                        None to wait forever
+        @type timeout: float
+        """
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = {}
+
+    async def new_connection(self, scheme, host):
+        """
+        Open a connection to `host`, or to the proxy for `host`
+
+        @returns: tuple of asyncio StreamReader and StreamWriter
+        """
+        proxy = get_proxy(scheme, host)
+        (hostname, port) = split_host(proxy or host,
+                scheme == 'https' and not proxy and 443 or 80)
+        if scheme == 'https' and not proxy:
+            return await asyncio.open_connection(hostname, port, ssl=True)
+        (reader, writer) = await asyncio.open_connection(hostname, port)
+        if scheme == 'https':
+            #Tunnel through the proxy, then start TLS
+            try:
+                writer.write(("CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n" % \
+                        (host_with_port(host, 443),
+                            host_with_port(host, 443))).encode('latin-1'))
+                response = await read_response(reader, head=True)
+                if response.status != 200:
+                    raise OSError("Proxy refused tunnel to %s: %s %s" % \
+                            (host, response.status, response.reason))
+                await writer.start_tls(None,
+                        server_hostname=split_host(host, 443)[0])
+            except:
+                #Including cancellation when the request times out
+                writer.close()
+                raise
+        return (reader, writer)
+
+    async def request(self, method, url, body=None, headers=None):
+        """
+        Send a HTTP request and read its response
+
+        A server or proxy that stalls can't hold up the caller (and its
+        place among the requests in flight) for longer than `timeout`.
+
+        @returns: `HTTPResponse`
+
+        @raises socket.timeout: if it took longer than `timeout`
+        """
+        try:
+            return await asyncio.wait_for(self.send(method, url, body,
+                headers), self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("No response from %s within %s seconds" % \
+                    (url, self.timeout))
+
+    async def send(self, method, url, body=None, headers=None):
+        """
+        Send a HTTP request and read its response, with no time limit
+
+        @returns: `HTTPResponse`
+        """
+        (scheme, host, path, params, query, _fragment) = urlparse(url)
+        if query:
+            path = "%s?%s" % (path, query)
+        if get_proxy(scheme, host) and scheme != 'https':
+            #Plain HTTP proxies want the whole URL in the request line
+            path = url
+        lines = ["%s %s HTTP/1.1" % (method, path or "/"), "Host: %s" % host]
+        for (name, value) in (headers or {}).items():
+            lines.append("%s: %s" % (name, value))
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+        if body is not None:
+            data += body
+
+        while True:
+            idle = self.idle.get((scheme, host))
+            reused = bool(idle)
+            if reused:
+                (reader, writer) = idle.pop()
+            else:
+                (reader, writer) = await self.new_connection(scheme, host)
+            try:
+                writer.write(data)
+                await writer.drain()
+                response = await read_response(reader, head=method == 'HEAD')
+            except (OSError, EOFError, asyncio.IncompleteReadError):
+                writer.close()
+                #The server may have dropped an idle connection, so try
+                #again with a new one. Fail for real on a new connection.
+                if not reused:
+                    raise
+                continue
+            except:
+                writer.close()
+                raise
+            self.release(scheme, host, reader, writer, response)
+            return response
+
+    def release(self, scheme, host, reader, writer, response):
+        """
+        Keep a connection for reuse once its response has been read
+        """
+        idle = self.idle.setdefault((scheme, host), [])
+        if response.will_close or len(idle) >= self.max_idle:
+            writer.close()
+        else:
+            idle.append((reader, writer))
+
+    def close(self):
+        """Close all idle connections"""
+        for idle in self.idle.values():
+            for (_reader, writer) in idle:
+                writer.close()
+        self.idle = {}
+
+
+class AsyncCheeseShop(object):
+
+    """asyncio interface to Python Package Index"""
+
+    def __init__(self, server=None, max_concurrency=MAX_CONCURRENCY,
+            pool=None, timeout=REQUEST_TIMEOUT):
+        """
+        @param server: PyPI XML-RPC URL, `yolk.pypi.XML_RPC_SERVER` if None
+        @type server: string
+
+        @param max_concurrency: maximum number of requests in flight
+        @type max_concurrency: int
+
+        @param pool: connections to use, a new pool if None
+        @type pool: `AsyncConnectionPool`
+
+        @param timeout: seconds each request may take, for a new pool
+        @type timeout: float
+        """
+        if server is None:
+            server = XML_RPC_SERVER
+        self.server = server
+        self.max_concurrency = max_concurrency
+        if pool is None:
+            pool = AsyncConnectionPool(max_concurrency, timeout)
+        self.pool = pool
+        #Created on first use, so it belongs to the running event loop
+        self.semaphore = None
+        self.user_agent = "yolk/%s (asyncio)" % VERSION
+        self.verbose = 'XMLRPC_DEBUG' in os.environ
+        self.logger = logging.getLogger("yolk")
+
+    async def call(self, method, *args):
+        """
+        Make an XML-RPC call
+
+        @param method: XML-RPC method name
+        @type method: string
+
+        @returns: result of the call
+
+        @raises xmlrpclib.Fault: if the server returns a fault
+        @raises xmlrpclib.ProtocolError: on a HTTP error
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        body = xmlrpclib.dumps(args, method, allow_none=True).encode('utf-8')
+        headers = {'User-Agent': self.user_agent, 'Content-Type': 'text/xml'}
+        async with self.semaphore:
+            response = await self.pool.request('POST', self.server, body,
+                    headers)
+        if self.verbose:
+            self.logger.debug("DEBUG: %s%r -> %s %s" % (method, args,
+                response.status, response.reason))
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(self.server, response.status,
+                    response.reason, response.headers)
+        (params, _method) = xmlrpclib.loads(response.body)
+        return params[0]
+
+    async def search(self, spec, operator):
+        '''Query PYPI via XMLRPC interface using search spec'''
+        return await self.call('search', spec, operator.lower())
+
+    async def changelog(self, hours):
+        '''Query PYPI via XMLRPC interface for changes in the last `hours`'''
+        return await self.call('changelog', get_seconds(hours))
+
+    async def updated_releases(self, hours):
+        '''Query PYPI via XMLRPC interface for releases in the last `hours`'''
+        return await self.call('updated_releases', get_seconds(hours))
+
+    async def list_packages(self):
+        """Query PYPI via XMLRPC interface for a a list of all package names"""
+        return await self.call('list_packages')
+
+    async def release_urls(self, package_name, version):
+        """Query PYPI via XMLRPC interface for a pkg's files"""
+        return await self.call('release_urls', package_name, version)
+
+    async def release_data(self, package_name, version):
+        """Query PYPI via XMLRPC interface for a pkg's metadata"""
+        try:
+            return await self.call('release_data', package_name, version)
+        except xmlrpclib.Fault:
+            #XXX Raises xmlrpclib.Fault if you give non-existant version
+            return
+
+    async def package_releases(self, package_name):
+        """Query PYPI via XMLRPC interface for a pkg's available versions"""
+        return await self.call('package_releases', package_name)
+
+    async def get_download_urls(self, package_name, version="",
+            pkg_type="all"):
+        """
+        Query PyPI for pkg download URI for a packge
+
+        Unlike `yolk.pypi.CheeseShop.get_download_urls` this doesn't look
+        up the proper case of `package_name` in the package name cache.
+        """
+        if version:
+            versions = [version]
+        else:
+            versions = await self.package_releases(package_name)
+        releases = await asyncio.gather(*[self.get_release(package_name, ver)
+            for ver in versions])
+        all_urls = []
+        for (metadata, release_urls) in releases:
+            add_download_urls(all_urls, pkg_type, release_urls, metadata)
+        return all_urls
+
+    async def get_release(self, package_name, version):
+        """
+        Query PyPI for a release's metadata and files concurrently
+
+        @returns: tuple of release_data and release_urls results
+        """
+        return await asyncio.gather(self.release_data(package_name, version),
+                self.release_urls(package_name, version))
+
+    def close(self):
+        """Close idle connections"""
+        self.pool.close()
+
+
+async def read_response(reader, head=False):
+    """
+    Read a HTTP/1.1 response
+
+    @param reader: connection to read from
+    @type reader: asyncio StreamReader
+
+    @param head: True if the response has no body, e.g. for HEAD
+    @type head: boolean
+
+    @returns: `HTTPResponse`
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise EOFError("Connection closed by server")
+    parts = status_line.decode('latin-1').rstrip("\r\n").split(" ", 2)
+    (http_version, status) = (parts[0], int(parts[1]))
+    reason = len(parts) > 2 and parts[2] or ""
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        (name, value) = line.decode('latin-1').split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    will_close = headers.get('connection', '').lower() == 'close' or \
+            http_version == 'HTTP/1.0'
+    if head or status in (204, 304) or 100 <= status < 200:
+        body = b""
+    elif 'chunked' in headers.get('transfer-encoding', '').lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if not size:
+                #Skip trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b"".join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        will_close = True
+    return HTTPResponse(status, reason, headers, body, will_close)
+
+
+def split_host(host, default_port):
+    """
+    Split 'host:port' into host and port
+
+    @returns: tuple of host string and port int
+    """
+    if host.startswith('[') or host.count(':') != 1:
+        #Bare IPv6 address or host without port
+        if ']:' in host:
+            (hostname, port) = host.rsplit(':', 1)
+            return (hostname.strip('[]'), int(port))
+        return (host.strip('[]'), default_port)
+    (hostname, port) = host.split(':')
+    return (hostname, int(port))
+
+
+def host_with_port(host, default_port):
+    """Return 'host:port', adding `default_port` if there's no port"""
+    (hostname, port) = split_host(host, default_port)
+    if ':' in hostname:
+        hostname = '[%s]' % hostname
+    return '%s:%d' % (hostname, port)
@@ -0,0 +1,512 @@
+"""
+
+cache.py
+========
+
+Desc: Persistent cache of responses from The CheeseShop (PyPI)
+
+      Responses are kept in an SQLite database in the yolk dir, keyed by
+      XML-RPC method (or JSON document type) and arguments. The least
+      recently used responses are evicted when the cache grows past its
+      maximum size.
+
+      Entries are invalidated when their project shows up in PyPI's
+      changelog, so responses for untouched projects stay valid. A
+      time-to-live may also be set for each method.
+
+      PyPI's changelog itself is kept too, so a repeated query for the
+      last N hours only has to fetch the entries added since.
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import platform
+if platform.python_version().startswith('2'):
+    import cPickle
+else:
+    import pickle as cPickle
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+#Seconds a response is kept for each method we cache. None means it is
+#kept until its project changes on PyPI.
+METHOD_TTLS = {'package_releases': 60 * 60 * 24 * 7,
+               'release_data': None,
+               'release_urls': None,
+               #Documents from PyPI's JSON API
+               'project_json': 60 * 60 * 24 * 7,
+               'release_json': None,
+               }
+
+#Maximum size in bytes of all cached responses
+CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+#Check the size of the cache after this many new responses
+EVICT_INTERVAL = 100
+
+#Seconds changelog entries are kept, unless a longer window was asked for
+CHANGELOG_MAX_AGE = 60 * 60 * 24 * 7
+
+#Changelog entries read from the database at a time
+CHANGELOG_PAGE_SIZE = 1000
+
+
+class ResponseCache(object):
+
+    """Persistent LRU cache of PyPI responses"""
+
+    def __init__(self, filename, max_size=CACHE_MAX_SIZE, ttls=None):
+        """
+        @param filename: SQLite database file
+        @type filename: string
+
+        @param max_size: maximum size of all cached responses in bytes
+        @type max_size: int
+
+        @param ttls: seconds to keep responses for each method, see
+                     METHOD_TTLS. Methods not in it aren't cached.
+        @type ttls: dict
+        """
+        self.filename = filename
+        self.max_size = max_size
+        if ttls is None:
+            ttls = METHOD_TTLS
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        self.writes = 0
+        #Wait a while for other processes writing to the cache
+        self.conn = sqlite3.connect(filename, timeout=30,
+                check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                project TEXT,
+                stored REAL,
+                accessed REAL,
+                size INTEGER,
+                value BLOB)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS responses_project
+                ON responses (project)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS responses_accessed
+                ON responses (accessed)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS changelog (
+                serial INTEGER PRIMARY KEY,
+                name TEXT,
+                version TEXT,
+                timestamp INTEGER,
+                action TEXT)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS changelog_timestamp
+                ON changelog (timestamp)""")
+        self.evict()
+
+    def is_cached_method(self, method):
+        """
+        Return True if responses of XML-RPC `method` are cached
+        """
+        return method in self.ttls
+
+    def get(self, method, args):
+        """
+        Return cached response for XML-RPC call or None if not cached
+
+        @param method: XML-RPC method name
+        @type method: string
+
+        @param args: arguments of the call
+        @type args: tuple
+
+        """
+        if not self.is_cached_method(method):
+            return
+        key = make_key(method, args)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            try:
+                row = self.conn.execute(
+                        "SELECT stored, value FROM responses WHERE key = ?",
+                        (key,)).fetchone()
+                if row is None:
+                    return
+                (stored, value) = row
+                ttl = self.ttls[method]
+                if ttl is not None and now - stored > ttl:
+                    self.conn.execute("DELETE FROM responses WHERE key = ?",
+                            (key,))
+                    return
+                self.conn.execute(
+                        "UPDATE responses SET accessed = ? WHERE key = ?",
+                        (now, key))
+            except sqlite3.DatabaseError as err_msg:
+                #e.g. locked by another process for too long
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache read failed: %s" % err_msg)
+                return
+        finally:
+            self.lock.release()
+        try:
+            return cPickle.loads(bytes(value))
+        except Exception:
+            #Damaged entry, treat it as not cached
+            return
+
+    def set(self, method, args, project, value):
+        """
+        Cache response of XML-RPC call
+
+        @param method: XML-RPC method name
+        @type method: string
+
+        @param args: arguments of the call
+        @type args: tuple
+
+        @param project: normalized name of the project the response is
+                        about, used by `invalidate`
+        @type project: string
+
+        @param value: response
+        """
+        if not self.is_cached_method(method) or value is None:
+            return
+        data = cPickle.dumps(value, -1)
+        now = time.time()
+        evict = False
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.execute("""INSERT OR REPLACE INTO responses
+                        (key, project, stored, accessed, size, value)
+                        VALUES (?, ?, ?, ?, ?, ?)""",
+                        (make_key(method, args), project, now, now, len(data),
+                            sqlite3.Binary(data)))
+                self.writes += 1
+                evict = self.writes % EVICT_INTERVAL == 0
+            except sqlite3.DatabaseError as err_msg:
+                #Not caching a response is harmless
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+        finally:
+            self.lock.release()
+        if evict:
+            self.evict()
+
+    def invalidate(self, projects):
+        """
+        Drop all cached responses about `projects`
+
+        @param projects: normalized project names
+        @type projects: iterable of strings
+
+        @returns: False if they couldn't be dropped
+        """
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.executemany(
+                        "DELETE FROM responses WHERE project = ?",
+                        [(project,) for project in projects])
+            except sqlite3.DatabaseError as err_msg:
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+                return False
+        finally:
+            self.lock.release()
+        return True
+
+    def clear(self):
+        """
+        Drop all cached responses
+
+        @returns: False if they couldn't be dropped
+        """
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.execute("DELETE FROM responses")
+            except sqlite3.DatabaseError as err_msg:
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+                return False
+        finally:
+            self.lock.release()
+        return True
+
+    def evict(self):
+        """
+        Drop least recently used responses until the cache fits in
+        `max_size`
+        """
+        self.lock.acquire()
+        try:
+            try:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) "
+                        "FROM responses").fetchone()[0]
+                if total <= self.max_size:
+                    return
+                #Make some room so we don't evict again on the next write
+                excess = total - int(self.max_size * 0.9)
+                cursor = self.conn.execute(
+                        "SELECT key, size FROM responses ORDER BY accessed")
+                keys = []
+                for (key, size) in cursor:
+                    keys.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self.conn.executemany("DELETE FROM responses WHERE key = ?",
+                        keys)
+            except sqlite3.DatabaseError as err_msg:
+                #Tried again after the next EVICT_INTERVAL writes
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache eviction failed: %s" % err_msg)
+        finally:
+            self.lock.release()
+
+    def get_serial(self):
+        """
+        Return PyPI changelog serial the cache was last validated against
+
+        @returns: int or None, also if it can't be read
+        """
+        self.lock.acquire()
+        try:
+            try:
+                row = self.conn.execute("SELECT value FROM meta "
+                        "WHERE name = 'serial'").fetchone()
+            except sqlite3.DatabaseError as err_msg:
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache read failed: %s" % err_msg)
+                return
+        finally:
+            self.lock.release()
+        if row and row[0].isdigit():
+            return int(row[0])
+
+    def set_serial(self, serial):
+        """
+        Record PyPI changelog serial the cache has been validated against
+
+        @returns: False if it couldn't be written
+        """
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO meta (name, value) "
+                        "VALUES (?, ?)", ('serial', str(serial)))
+            except sqlite3.DatabaseError as err_msg:
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+                return False
+        finally:
+            self.lock.release()
+        return True
+
+    def get_changelog_range(self):
+        """
+        Return the span of PyPI's changelog that is cached completely
+
+        @returns: tuple of start time, time of the last fetch and serial
+                  of the last entry, all None if nothing is cached
+        """
+        self.lock.acquire()
+        try:
+            try:
+                row = self.conn.execute("SELECT value FROM meta "
+                        "WHERE name = 'changelog_range'").fetchone()
+            except sqlite3.DatabaseError as err_msg:
+                #Nothing is taken from the cached changelog then
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache read failed: %s" % err_msg)
+                row = None
+        finally:
+            self.lock.release()
+        try:
+            (start, fetched, serial) = row[0].split()
+            return (int(start), int(fetched), int(serial))
+        except (TypeError, ValueError):
+            return (None, None, None)
+
+    def set_changelog_range(self, start, fetched, serial):
+        """
+        Record that every changelog entry from `start` to the entry with
+        `serial`, fetched at time `fetched`, is cached
+        """
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO meta (name, value) "
+                        "VALUES (?, ?)", ('changelog_range',
+                            "%d %d %d" % (start, fetched, serial)))
+            except sqlite3.DatabaseError as err_msg:
+                #The entries are fetched again next time
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+        finally:
+            self.lock.release()
+
+    def add_changelog(self, entries):
+        """
+        Cache changelog entries
+
+        @param entries: (name, version, timestamp, action, serial) entries
+        @type entries: list
+
+        @returns: False if they couldn't be written
+        """
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.execute("BEGIN")
+                try:
+                    self.conn.executemany("""INSERT OR REPLACE INTO changelog
+                            (name, version, timestamp, action, serial)
+                            VALUES (?, ?, ?, ?, ?)""",
+                            [tuple(entry[:5]) for entry in entries])
+                    self.conn.execute("COMMIT")
+                except:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.DatabaseError as err_msg:
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+                return False
+        finally:
+            self.lock.release()
+        return True
+
+    def prune_changelog(self, before):
+        """Drop changelog entries older than time `before`"""
+        (start, fetched, serial) = self.get_changelog_range()
+        self.lock.acquire()
+        try:
+            try:
+                self.conn.execute("DELETE FROM changelog WHERE timestamp < ?",
+                        (before,))
+            except sqlite3.DatabaseError as err_msg:
+                logging.getLogger("yolk").debug(
+                        "DEBUG: Response cache write failed: %s" % err_msg)
+                return
+        finally:
+            self.lock.release()
+        if start is not None and start < before:
+            self.set_changelog_range(before, fetched, serial)
+
+    def iter_changelog(self, since):
+        """
+        Yield cached changelog entries from time `since` on, oldest first
+
+        @returns: yields [name, version, timestamp, action] lists
+        """
+        for row in self.iter_changelog_rows(since, -1):
+            yield row[:4]
+
+    def iter_changelog_after(self, serial):
+        """
+        Yield cached changelog entries after `serial`, oldest first
+
+        @returns: yields [name, version, timestamp, action, serial] lists
+        """
+        return self.iter_changelog_rows(-1, serial)
+
+    def iter_changelog_rows(self, since, serial):
+        """
+        Yield cached changelog entries from time `since` on with a serial
+        after `serial`, reading a page of them at a time
+
+        @returns: yields [name, version, timestamp, action, serial] lists
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                rows = self.conn.execute("""SELECT name, version, timestamp,
+                        action, serial FROM changelog
+                        WHERE timestamp >= ? AND serial > ?
+                        ORDER BY serial LIMIT ?""",
+                        (since, serial, CHANGELOG_PAGE_SIZE)).fetchall()
+            finally:
+                self.lock.release()
+            for row in rows:
+                yield list(row)
+            if len(rows) < CHANGELOG_PAGE_SIZE:
+                return
+            serial = rows[-1][4]
+
+    def iter_new_releases(self, since):
+        """
+        Yield releases made after time `since`, newest first, like PyPI's
+        updated_releases
+
+        @returns: yields [name, version] lists
+        """
+        self.lock.acquire()
+        try:
+            rows = self.conn.execute("""SELECT name, version FROM changelog
+                    WHERE action = 'new release' AND timestamp > ?
+                    ORDER BY timestamp DESC, serial DESC""",
+                    (since,)).fetchall()
+        finally:
+            self.lock.release()
+        for row in rows:
+            yield list(row)
+
+    def close(self):
+        """Close the database"""
+        self.conn.close()
+
+
+def make_key(method, args):
+    """
+    Return cache key for an XML-RPC call
+
+    @param method: XML-RPC method name
+    @type method: string
+
+    @param args: arguments of the call
+    @type args: tuple
+
+    @returns: string
+    """
+    return "%s%r" % (method, tuple(args))
+
+
+def open_response_cache(filename, max_size=CACHE_MAX_SIZE, ttls=None):
+    """
+    Open a response cache, starting a new one if the file is damaged
+
+    If the cache can't be opened at all, e.g. the disk is read-only, an
+    in-memory cache is used for this run.
+
+    @param filename: SQLite database file
+    @type filename: string
+
+    @returns: `ResponseCache`
+    """
+    logger = logging.getLogger("yolk")
+    try:
+        return ResponseCache(filename, max_size, ttls)
+    except sqlite3.OperationalError as err_msg:
+        #Locked, read-only etc. The file may be fine, so leave it alone.
+        logger.debug("DEBUG: Using in-memory response cache: %s" % err_msg)
+        return ResponseCache(":memory:", max_size, ttls)
+    except sqlite3.DatabaseError as err_msg:
+        logger.debug("DEBUG: Damaged response cache %s: %s" \
+                % (filename, err_msg))
+    try:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+        return ResponseCache(filename, max_size, ttls)
+    except (OSError, sqlite3.DatabaseError) as err_msg:
+        logger.debug("DEBUG: Using in-memory response cache: %s" % err_msg)
+    return ResponseCache(":memory:", max_size, ttls)
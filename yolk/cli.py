@@ -26,9 +26,9 @@ import pprint
 import os
 import sys
 import optparse
-import pkg_resources
 import webbrowser
 import logging
+import sqlite3
 import platform
 if platform.python_version().startswith('2'):
     from xmlrpclib import Fault as XMLRPCFault
@@ -38,13 +38,17 @@ else:
     from xmlrpc.client import Fault as XMLRPCFault
     from urllib.request import urlretrieve
     from urllib.parse import urlparse
-from distutils.sysconfig import get_python_lib
 from yolk.metadata import get_metadata
-from yolk.yolklib import get_highest_version, Distributions
-from yolk.pypi import CheeseShop
-from yolk.setuptools_support import get_download_uri, get_pkglist
+from yolk.yolklib import get_highest_version, get_installed, \
+        get_installed_backend, get_pkglist, version_key, INSTALLED_BACKENDS
+from yolk.pypi import CheeseShop, BACKENDS, CONNECTION_POOL, \
+        MULTICALL_BATCH_SIZE
+from yolk.resilience import MAX_RETRIES, REQUEST_TIMEOUT
+from yolk.simpleindex import SimpleIndex
+from yolk.snapshot import write_snapshot
 from yolk.plugins import load_plugins
-from yolk.utils import run_command, command_successful
+from yolk.utils import run_command, command_successful, \
+        get_python_lib, get_snapshot_file, iter_entry_points, parallel_map
 from yolk.__init__ import __version__ as VERSION
 
 
@@ -117,6 +121,8 @@ class Yolk(object):
         sys.stdout = StdOut(sys.stdout, shut_up)
         sys.stderr = StdOut(sys.stderr, shut_up)
         self.pypi = None
+        self.simple_index = None
+        self.installed = None
 
     def get_plugin(self, method):
         """
@@ -129,7 +135,7 @@ class Yolk(object):
 
         """
         all_plugins = []
-        for entry_point in pkg_resources.iter_entry_points('yolk.plugins'):
+        for entry_point in iter_entry_points('yolk.plugins'):
             plugin_obj = entry_point.load()
             plugin = plugin_obj()
             plugin.configure(self.options, None)
@@ -172,8 +178,8 @@ class Yolk(object):
             pkg_spec = remaining_args
         self.pkg_spec = pkg_spec
 
-        if not self.options.pypi_search and (len(sys.argv) == 1 or\
-                len(remaining_args) > 2):
+        if not (self.options.pypi_search or self.options.write_snapshot) and \
+                (len(sys.argv) == 1 or len(remaining_args) > 2):
             opt_parser.print_help()
             return 2
 
@@ -188,10 +194,23 @@ class Yolk(object):
             want_installed = False
         #show_updates may or may not have a pkg_spec
         if not want_installed or self.options.show_updates:
-            self.pypi = CheeseShop(self.options.debug)
+            CONNECTION_POOL.timeout = self.options.timeout
+            CONNECTION_POOL.resilience.retries = self.options.retries
+            CONNECTION_POOL.resilience.hedge_percentile = self.options.hedge
+            try:
+                self.pypi = CheeseShop(self.options.debug,
+                        batch_size=self.options.batch_size,
+                        max_age=self.options.cache_max_age * 60 * 60,
+                        backend=self.options.backend,
+                        snapshot=self.options.snapshot,
+                        compress_requests=self.options.compress_requests)
+            except (IOError, sqlite3.DatabaseError) as err_msg:
+                logger.error("ERROR: Can't read snapshot: %s" % err_msg)
+                return 2
             #XXX: We should return 2 here if we couldn't create xmlrpc server
 
-        if pkg_spec:
+        #--write-snapshot takes a list of packages
+        if pkg_spec and not self.options.write_snapshot:
             (self.project_name, self.version, self.all_versions) = \
                     self.parse_pkg_ver(want_installed)
             if want_installed and not self.project_name:
@@ -205,13 +224,17 @@ class Yolk(object):
                 'show_download_links', 'pypi_search', 'show_pypi_changelog',
                 'show_pypi_releases', 'yolk_version', 'show_all',
                 'show_active', 'show_non_active', 'show_entry_map',
-                'show_entry_points']
+                'show_entry_points', 'write_snapshot']
 
         #Run first command it finds, and only the first command, then return
         #XXX: Check if more than one command was set in options and give error?
         for action in commands:
             if getattr(self.options, action):
-                return getattr(self, action)()
+                status = getattr(self, action)()
+                if self.pypi is not None:
+                    logger.debug("DEBUG: PyPI requests: %s" % \
+                            CONNECTION_POOL.resilience.report())
+                return status
         opt_parser.print_help()
 
 
@@ -243,35 +266,41 @@ class Yolk(object):
 
         @returns: None
         """
-        dists = Distributions()
+        dists = self.get_installed()
         if self.project_name:
             #Check for a single package
             pkg_list = [self.project_name]
         else:
             #Check for every installed package
-            pkg_list = get_pkglist()
-        found = None
+            pkg_list = get_pkglist(dists)
+        check_dists = []
         for pkg in pkg_list:
             for (dist, active) in dists.get_distributions("all", pkg,
                     dists.get_highest_installed(pkg)):
-                (project_name, versions) = \
-                        self.pypi.query_versions_pypi(dist.project_name)
-                if versions:
+                check_dists.append(dist)
+
+        #Query PyPI in concurrent batches, but report in the same order
+        results = self.pypi.query_versions_pypi_many(
+                [dist.project_name for dist in check_dists],
+                self.options.jobs)
+        found = None
+        for (i, (project_name, versions)) in enumerate(results):
+            dist = check_dists[i]
+            if versions:
 
-                    #PyPI returns them in chronological order,
-                    #but who knows if its guaranteed in the API?
-                    #Make sure we grab the highest version:
+                #PyPI returns them in chronological order,
+                #but who knows if its guaranteed in the API?
+                #Make sure we grab the highest version:
 
-                    newest = get_highest_version(versions)
-                    if newest != dist.version:
+                newest = get_highest_version(versions)
+                if newest != dist.version:
 
-                        #We may have newer than what PyPI knows about
+                    #We may have newer than what PyPI knows about
 
-                        if pkg_resources.parse_version(dist.version) < \
-                            pkg_resources.parse_version(newest):
-                            found = True
-                            print(" %s %s (%s)" % (project_name, dist.version,
-                                    newest))
+                    if version_key(dist.version) < version_key(newest):
+                        found = True
+                        print(" %s %s (%s)" % (project_name, dist.version,
+                                newest))
         if not found and self.project_name:
             self.logger.info("You have the latest version installed.")
         elif not found:
@@ -302,26 +331,44 @@ class Yolk(object):
         if workingenv:
             ignores.append(workingenv)
 
-        dists = Distributions()
-        results = None
-        for (dist, active) in dists.get_distributions(show, self.project_name,
-                self.version):
-            metadata = get_metadata(dist)
+        python_lib = get_python_lib()
+        #Only read the metadata fields that will be printed
+        if self.options.fields:
+            fields = self.get_fields() + ['Name', 'Version']
+        elif show_metadata:
+            fields = None
+        else:
+            fields = ['Name', 'Version']
+        def read_dist(dist_active):
+            """Read a dist's metadata and plugin columns, in a pool thread"""
+            (dist, active) = dist_active
+            metadata = get_metadata(dist, fields)
             for prefix in ignores:
                 if dist.location.startswith(prefix):
                     dist.location = dist.location.replace(prefix, "")
             #Case-insensitve search because of Windows
-            if dist.location.lower().startswith(get_python_lib().lower()):
+            if dist.location.lower().startswith(python_lib.lower()):
                 develop = ""
             else:
                 develop = dist.location
+            add_column_text = ""
             if metadata:
-                add_column_text = ""
                 for my_plugin in plugins:
                     #See if package is 'owned' by a package manager such as
                     #portage, apt, rpm etc.
                     #add_column_text += my_plugin.add_column(filename) + " "
                     add_column_text += my_plugin.add_column(dist) + " "
+            return (dist, active, metadata, develop, add_column_text)
+
+        dists = self.get_installed()
+        results = None
+        #Files are read concurrently, each line is printed as soon as it
+        #and the lines before it are ready
+        for (dist, active, metadata, develop, add_column_text) in \
+                parallel_map(read_dist, dists.get_distributions(show,
+                    self.project_name, self.version),
+                    self.options.metadata_jobs):
+            if metadata:
                 self.print_metadata(metadata, develop, active, add_column_text)
             else:
                 print(str(dist) + " has no metadata")
@@ -364,11 +411,7 @@ class Yolk(object):
 
         """
         show_metadata = self.options.metadata
-        if self.options.fields:
-            fields = self.options.fields.split(',')
-            fields = map(str.strip, fields)
-        else:
-            fields = []
+        fields = self.get_fields()
         version = metadata['Version']
 
         #When showing all packages, note which are not active:
@@ -399,16 +442,26 @@ class Yolk(object):
                 " - " + status)
         if fields:
             #Only show specific fields, using case-insensitive search
-            fields = map(str.lower, fields)
+            fields = [field.lower() for field in fields]
             for field in metadata.keys():
                 if field.lower() in fields:
-                    print('    %s: %s' % (field, metadata[field]))
+                    print_field(field, metadata[field])
             print()
         elif show_metadata:
             #Print all available metadata fields
             for field in metadata.keys():
                 if field != 'Name' and field != 'Summary':
-                    print('    %s: %s' % (field, metadata[field]))
+                    print_field(field, metadata[field])
+
+    def get_fields(self):
+        """
+        Return metadata fields given with -f
+
+        @returns: list of field name strings, empty if -f wasn't used
+        """
+        if not self.options.fields:
+            return []
+        return [field.strip() for field in self.options.fields.split(',')]
 
     def show_deps(self):
         """
@@ -417,6 +470,11 @@ class Yolk(object):
         @returns: 0 - sucess  1 - No dependency info supplied
         """
 
+        try:
+            import pkg_resources
+        except ImportError:
+            self.logger.error("Showing dependencies needs setuptools")
+            return 1
         pkgs = pkg_resources.Environment()
 
         for pkg in pkgs[self.project_name]:
@@ -450,22 +508,21 @@ class Yolk(object):
             self.logger.error("Error: You must supply an integer.")
             return 1
 
+        #Entries are printed as they arrive
+        last_pkg = ''
         try:
-            changelog = self.pypi.changelog(int(hours))
+            for entry in self.pypi.iter_changelog(int(hours)):
+                pkg = entry[0]
+                if pkg != last_pkg:
+                    print("%s %s\n\t%s" % (entry[0], entry[1], entry[3]))
+                    last_pkg = pkg
+                else:
+                    print("\t%s" % entry[3])
         except XMLRPCFault as err_msg:
             self.logger.error(err_msg)
             self.logger.error("ERROR: Couldn't retrieve changelog.")
             return 1
 
-        last_pkg = ''
-        for entry in changelog:
-            pkg = entry[0]
-            if pkg != last_pkg:
-                print("%s %s\n\t%s" % (entry[0], entry[1], entry[3]))
-                last_pkg = pkg
-            else:
-                print("\t%s" % entry[3])
-
         return 0
 
     def show_pypi_releases(self):
@@ -481,14 +538,33 @@ class Yolk(object):
             self.logger.error("ERROR: You must supply an integer.")
             return 1
         try:
-            latest_releases = self.pypi.updated_releases(hours)
+            for release in self.pypi.iter_updated_releases(hours):
+                print("%s %s" % (release[0], release[1]))
         except XMLRPCFault as err_msg:
             self.logger.error(err_msg)
             self.logger.error("ERROR: Couldn't retrieve latest releases.")
             return 1
+        return 0
 
-        for release in latest_releases:
-            print("%s %s" % (release[0], release[1]))
+    def write_snapshot(self):
+        """
+        Save PyPI data about packages for use offline with --snapshot
+
+        The packages named on the command line are saved, or every
+        installed package if none are named.
+
+        @returns: 0
+        """
+        if self.options.all_projects:
+            project_names = None
+        elif self.pkg_spec:
+            project_names = self.pkg_spec
+        else:
+            project_names = get_pkglist(self.get_installed())
+        count = write_snapshot(self.pypi, self.options.write_snapshot,
+                project_names, self.options.jobs)
+        self.logger.info("Saved %d packages to %s" % (count,
+            self.options.write_snapshot))
         return 0
 
     def show_download_links(self):
@@ -523,6 +599,35 @@ class Yolk(object):
             self.print_download_uri(version, source)
         return 0
 
+    def get_installed(self):
+        """
+        Return installed packages, found on first use
+
+        importlib.metadata is used where Python has it, see
+        --installed-backend. sys.path is only rescanned where it changed
+        since the last run, see `yolk.envcache`.
+
+        @returns: `yolk.yolklib.Distributions`
+        """
+        if self.installed is None:
+            backend = get_installed_backend(self.options.installed_backend)
+            self.installed = get_installed(backend,
+                    get_snapshot_file(backend))
+        return self.installed
+
+    def get_simple_index(self):
+        """
+        Return the package index to find download links on
+
+        It is shared by all the lookups of a run, so a project's page is
+        only read once.
+
+        @returns: `yolk.simpleindex.SimpleIndex`
+        """
+        if self.simple_index is None:
+            self.simple_index = SimpleIndex(self.options.pypi_index)
+        return self.simple_index
+
     def print_download_uri(self, version, source):
         """
         @param version: version number or 'dev' for svn
@@ -543,9 +648,9 @@ class Yolk(object):
         else:
             pkg_type = "egg"
 
-        #Use setuptools monkey-patch to grab url
-        url = get_download_uri(self.project_name, version, source,
-                self.options.pypi_index)
+        #Look for it on the project's simple index page
+        url = self.get_simple_index().find_download_uri(self.project_name,
+                version, source)
         if url:
             print("%s" % url)
         else:
@@ -564,8 +669,8 @@ class Yolk(object):
 
         if self.options.file_type == "svn":
             version = "dev"
-            svn_uri = get_download_uri(self.project_name, \
-                    "dev", True)
+            svn_uri = self.get_simple_index().find_download_uri(
+                    self.project_name, "dev", True)
             if svn_uri:
                 directory = self.project_name + "_svn"
                 return self.fetch_svn(svn_uri, directory)
@@ -579,7 +684,8 @@ class Yolk(object):
         elif self.options.file_type == "egg":
             source = False
 
-        uri = get_download_uri(self.project_name, self.version, source)
+        uri = self.get_simple_index().find_download_uri(self.project_name,
+                self.version, source)
         if uri:
             return self.fetch_uri(directory, uri)
         else:
@@ -842,6 +948,11 @@ class Yolk(object):
 
         @returns: 0 for success or 1 if error
         """
+        try:
+            import pkg_resources
+        except ImportError:
+            self.logger.error("Showing entry maps needs setuptools")
+            return 1
         pprinter = pprint.PrettyPrinter()
         try:
             entry_map = pkg_resources.get_entry_map(self.options.show_entry_map)
@@ -861,8 +972,7 @@ class Yolk(object):
 
         """
         found = False
-        for entry_point in \
-                pkg_resources.iter_entry_points(self.options.show_entry_points):
+        for entry_point in iter_entry_points(self.options.show_entry_points):
             found = True
             try:
                 plugin = entry_point.load()
@@ -912,7 +1022,7 @@ class Yolk(object):
             version = version.strip()
         #Find proper case for package name
         if want_installed:
-            dists = Distributions()
+            dists = self.get_installed()
             project_name = dists.case_sensitive_name(project_name)
         else:
             (project_name, all_versions) = \
@@ -972,6 +1082,12 @@ def setup_opt_parser():
                            'Show all metadata for packages installed by ' +
                            'setuptools (use with -l -a or -n)')
 
+    group_local.add_option("--metadata-jobs", action='store', type='int',
+                           dest="metadata_jobs", metavar='N', default=4,
+                           help="Number of installed packages to read " +
+                           "metadata for at once with -l -a or -n. " +
+                           "Default: 4")
+
     group_local.add_option("-f", "--fields", action="store", dest=
                            "fields", default=False, help=
                            'Show specific metadata fields. ' +
@@ -991,10 +1107,30 @@ def setup_opt_parser():
                            dest="show_entry_map", default=False, help=
                            'List entry map for a package. e.g. --entry-map yolk',
                            metavar="PACKAGE_NAME")
+
+    group_local.add_option("--installed-backend", action='store',
+                           type='choice', dest="installed_backend",
+                           choices=list(INSTALLED_BACKENDS), default="auto",
+                           help="How to find installed packages: " +
+                           "'importlib' (importlib.metadata), " +
+                           "'pkg_resources', or 'auto' to use importlib " +
+                           "if Python has it. Default: auto")
     group_pypi = optparse.OptionGroup(opt_parser,
             "PyPI (Cheese Shop) options",
             "The following options query the Python Package Index:")
 
+    group_pypi.add_option("--backend", action='store', type='choice',
+                          dest="backend", choices=list(BACKENDS),
+                          default="auto", help=
+                          "How to query PyPI about packages: 'json' API, " +
+                          "'xmlrpc', or 'auto' to use the JSON API if the " +
+                          "server has it. Default: auto")
+
+    group_pypi.add_option("--cache-max-age", action='store', type='int',
+                          dest="cache_max_age", metavar='HOURS', default=24,
+                          help="Sync the cached list of PyPI package names " +
+                          "when it is older than HOURS. Default: 24")
+
     group_pypi.add_option("-C", "--changelog", action='store',
                           dest="show_pypi_changelog", metavar='HOURS',
                           default=False, help=
@@ -1018,7 +1154,8 @@ def setup_opt_parser():
     group_pypi.add_option("-I", "--pypi-index", action='store',
                           dest="pypi_index",
                           default=False, help=
-                          "Specify PyPI mirror for package index.")
+                          "Specify PyPI mirror for package index, e.g. " +
+                          "http://mirror.example.com/simple/ for -D and -F.")
 
     group_pypi.add_option("-L", "--latest-releases", action='store',
                           dest="show_pypi_releases", metavar="HOURS",
@@ -1037,13 +1174,67 @@ def setup_opt_parser():
 
     group_pypi.add_option("-T", "--file-type", action="store", dest=
                           "file_type", default="all", help=
-                          "You may specify 'source', 'egg', 'svn' or 'all' when using -D.")
+                          "You may specify 'source', 'egg' (eggs and wheels), 'svn' or 'all' when using -D.")
 
     group_pypi.add_option("-U", "--show-updates", action='store_true',
                           dest="show_updates", metavar='<PKG_NAME>',
                           default=False, help=
                           "Check PyPI for updates on package(s).")
 
+    group_pypi.add_option("--jobs", action='store', type='int',
+                          dest="jobs", metavar='N', default=4, help=
+                          "Number of concurrent PyPI queries to make when " +
+                          "checking for updates with -U or saving releases " +
+                          "with --write-snapshot. Default: 4")
+
+    group_pypi.add_option("--batch-size", action='store', type='int',
+                          dest="batch_size", metavar='N',
+                          default=MULTICALL_BATCH_SIZE, help=
+                          "Maximum number of PyPI queries to send in one " +
+                          "XML-RPC multicall request. Use 1 to disable " +
+                          "batching. Default: %d" % MULTICALL_BATCH_SIZE)
+
+    group_pypi.add_option("--timeout", action='store', type='float',
+                          dest="timeout", metavar='SECONDS',
+                          default=REQUEST_TIMEOUT, help=
+                          "Seconds to wait for PyPI to answer before " +
+                          "giving up on a request. Default: %d" % \
+                          REQUEST_TIMEOUT)
+
+    group_pypi.add_option("--retries", action='store', type='int',
+                          dest="retries", metavar='N', default=MAX_RETRIES,
+                          help="Number of times to retry a PyPI request " +
+                          "that failed with a network error or a 5xx " +
+                          "response. Default: %d" % MAX_RETRIES)
+
+    group_pypi.add_option("--hedge", action='store', type='float',
+                          dest="hedge", metavar='PERCENTILE', default=None,
+                          help="Send a second copy of a PyPI request that " +
+                          "takes longer than PERCENTILE (e.g. 95) of " +
+                          "recent requests, and use the first answer.")
+
+    group_pypi.add_option("--compress-requests", action='store_true',
+                          dest="compress_requests", default=False, help=
+                          "Compress large XML-RPC requests with gzip. " +
+                          "Responses are always compressed if the " +
+                          "server supports it.")
+
+    group_pypi.add_option("--snapshot", action='store', dest="snapshot",
+                          metavar='FILE', default=None, help=
+                          "Answer PyPI queries from a snapshot saved with " +
+                          "--write-snapshot, without using the network.")
+
+    group_pypi.add_option("--write-snapshot", action='store',
+                          dest="write_snapshot", metavar='FILE',
+                          default=False, help=
+                          "Save PyPI data for the packages named on the " +
+                          "command line, or every installed package, to " +
+                          "FILE for use with --snapshot.")
+
+    group_pypi.add_option("--all-projects", action='store_true',
+                          dest="all_projects", default=False, help=
+                          "Save every project on PyPI with --write-snapshot.")
+
     group_pypi.add_option("-V", "--versions-available", action=
                           'store', dest="versions_available",
                           default=False, metavar='PKG_SPEC',
@@ -1072,6 +1263,25 @@ def print_pkg_versions(project_name, versions):
     for ver in versions:
         print("%s %s" % (project_name, ver))
 
+def print_field(field, value):
+    """
+    Print a metadata field, one line for each value of a field given
+    more than once, e.g. Classifier
+
+    @param field: field name
+    @type field: string
+
+    @param value: field's value
+    @type value: string or list of strings
+
+    @returns: None
+    """
+    if not isinstance(value, list):
+        value = [value]
+    for item in value:
+        print('    %s: %s' % (field, item))
+
+
 def validate_pypi_opts(opt_parser):
     """
     Check parse options that require pkg_spec
@@ -0,0 +1,411 @@
+"""
+
+envcache.py
+===========
+
+Desc: Snapshot of the installed distributions found on sys.path
+
+      pkg_resources and importlib.metadata list every sys.path entry and
+      read the metadata in it each time installed packages are looked
+      for. The snapshot keeps what was found in each path entry, with
+      the modification times of the entry and of each metadata directory
+      (and file, where the version is read from it), so only entries
+      that changed since the last run are scanned.
+
+      Distributions are rebuilt from the snapshot the way the backend
+      that found them would make them, so their metadata is still read
+      from disk when it is asked for.
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+import logging
+import os
+import sys
+import time
+
+from yolk.utils import atomic_write, get_snapshot_file
+
+
+#Bumped when the layout of the snapshot changes
+SNAPSHOT_FORMAT = 2
+
+#Seconds a modification time has to be in the past to be trusted. A
+#directory changed again within the same clock tick would look unchanged.
+RACY_SECONDS = 2
+
+
+class EnvironmentSnapshot(object):
+
+    """
+    What pkg_resources found in each sys.path entry, kept between runs
+    """
+
+    #Finds the distributions, see `MetadataSnapshot`
+    backend = 'pkg_resources'
+
+    def __init__(self, filename):
+        """
+        @param filename: JSON file the snapshot is kept in
+        @type filename: string
+        """
+        self.filename = filename
+        self.entries = {}
+        self.changed = False
+        self.scanned = 0
+        try:
+            data = json.load(open(filename))
+            if data.get('format') == SNAPSHOT_FORMAT and \
+                    data.get('backend') == self.backend:
+                self.entries = data['entries']
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            #Missing or damaged, everything is scanned again
+            pass
+
+    def get_dists(self, path_item):
+        """
+        Return distributions in a sys.path entry, scanning it if it
+        changed since it was last scanned
+
+        @returns: list of (Distribution, in_environment, in_working_set)
+                  tuples, in the order pkg_resources finds them, or see
+                  `MetadataSnapshot.make_dists`
+        """
+        key = normalize_path(path_item)
+        record = self.entries.get(key)
+        if record is not None and is_current(path_item, record):
+            return self.make_dists(record)
+        (record, dists) = self.scan(path_item)
+        self.scanned += 1
+        if record is not None:
+            self.entries[key] = record
+            self.changed = True
+        elif self.entries.pop(key, None) is not None:
+            self.changed = True
+        return dists
+
+    def make_dists(self, record):
+        """Return distributions rebuilt from a path entry's record"""
+        return [(make_dist(info), info['env'], info['ws'])
+                for info in record['dists']]
+
+    def scan(self, path_item):
+        """Scan a path entry, see `scan_entry`"""
+        return scan_entry(path_item)
+
+    def load(self, search_path=None):
+        """
+        Return an Environment and WorkingSet for `search_path`, the same
+        as pkg_resources.Environment() and WorkingSet() would make
+
+        @param search_path: path entries, sys.path if None
+        @type search_path: list of strings
+
+        @returns: tuple of pkg_resources Environment and WorkingSet
+        """
+        import pkg_resources
+        if search_path is None:
+            search_path = sys.path
+        environment = pkg_resources.Environment([])
+        working_set = pkg_resources.WorkingSet([])
+        for path_item in search_path:
+            working_set.entry_keys.setdefault(path_item, [])
+            working_set.entries.append(path_item)
+            for (dist, in_environment, in_working_set) in \
+                    self.get_dists(path_item):
+                if in_environment:
+                    environment.add(dist)
+                if in_working_set:
+                    working_set.add(dist, path_item, False)
+        return (environment, working_set)
+
+    def save(self):
+        """Write the snapshot if anything was scanned"""
+        if not self.changed:
+            return
+        data = json.dumps({'format': SNAPSHOT_FORMAT,
+            'backend': self.backend, 'entries': self.entries}, sort_keys=True)
+        try:
+            directory = os.path.dirname(self.filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            atomic_write(self.filename, data.encode('utf-8'))
+            self.changed = False
+        except (IOError, OSError) as err_msg:
+            #Not keeping the snapshot only makes the next run slower
+            logging.getLogger("yolk").debug(
+                    "DEBUG: Can't save installed packages snapshot: %s" \
+                    % err_msg)
+
+
+class MetadataSnapshot(EnvironmentSnapshot):
+
+    """
+    What importlib.metadata found in each sys.path entry, kept between
+    runs
+    """
+
+    backend = 'importlib'
+
+    def make_dists(self, record):
+        """
+        Return distributions rebuilt from a path entry's record
+
+        @returns: list of (`yolk.yolklib.InstalledDistribution`, is_egg)
+                  tuples, see `yolk.yolklib.find_entry_dists`
+        """
+        from yolk.yolklib import InstalledDistribution, importlib_metadata
+        return [(InstalledDistribution(importlib_metadata.Distribution.at(
+            info['metadata'][0]), info['project_name'], info['version']),
+            info['egg']) for info in record['dists']]
+
+    def scan(self, path_item):
+        """Scan a path entry, see `scan_metadata_entry`"""
+        return scan_metadata_entry(path_item)
+
+    def load(self, search_path=None):
+        """
+        Return the installed and active distributions on `search_path`
+
+        @param search_path: path entries, sys.path if None
+        @type search_path: list of strings
+
+        @returns: tuple of `yolk.yolklib.MetadataEnvironment` and
+                  `yolk.yolklib.MetadataWorkingSet`
+        """
+        from yolk.yolklib import build_environment
+        if search_path is None:
+            search_path = sys.path
+        return build_environment(search_path, self.get_dists)
+
+
+def load_environment(filename=None, search_path=None):
+    """
+    Return an Environment and WorkingSet, scanning only the path entries
+    that changed since the snapshot was saved, and save it again
+
+    @param filename: snapshot file, `yolk.utils.get_snapshot_file` for
+                     the pkg_resources backend if None
+    @type filename: string
+
+    @param search_path: path entries, sys.path if None
+    @type search_path: list of strings
+
+    @returns: tuple of pkg_resources Environment and WorkingSet
+    """
+    snapshot = EnvironmentSnapshot(filename or
+            get_snapshot_file(EnvironmentSnapshot.backend))
+    result = snapshot.load(search_path)
+    snapshot.save()
+    return result
+
+
+def load_metadata_environment(filename=None, search_path=None):
+    """
+    Return the installed and active distributions importlib.metadata
+    finds, like `load_environment`
+
+    @returns: tuple of `yolk.yolklib.MetadataEnvironment` and
+              `yolk.yolklib.MetadataWorkingSet`
+    """
+    snapshot = MetadataSnapshot(filename or
+            get_snapshot_file(MetadataSnapshot.backend))
+    result = snapshot.load(search_path)
+    snapshot.save()
+    return result
+
+
+def normalize_path(path):
+    """Return absolute path with links resolved, like pkg_resources'"""
+    return os.path.normcase(os.path.realpath(os.path.normpath(path)))
+
+
+def get_mtime(path):
+    """Return modification time of a file or directory, None if missing"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return
+
+
+def is_current(path_item, record):
+    """
+    Return True if a path entry and its metadata directories haven't
+    changed since `record` was made, nor the metadata files versions
+    were read from
+    """
+    if get_mtime(path_item) != record['mtime']:
+        return False
+    for info in record['dists']:
+        if get_mtime(info['metadata'][-1]) != info['mtime']:
+            return False
+        if info['version_file'] and \
+                get_mtime(info['version_file'][0]) != info['version_file'][1]:
+            return False
+    return True
+
+
+def scan_dists(path_item):
+    """
+    Find distributions in a path entry with pkg_resources
+
+    @returns: list of (Distribution, in_environment, in_working_set)
+              tuples, see `EnvironmentSnapshot.get_dists`
+    """
+    import pkg_resources
+    #An Environment uses every distribution in the entry, a WorkingSet
+    #only those whose code is on sys.path as it is
+    active = list(pkg_resources.find_distributions(path_item, True))
+    active_set = set(active)
+    dists = []
+    for dist in pkg_resources.find_distributions(path_item):
+        dists.append((dist, True, dist in active_set))
+    found = set([dist for (dist, _env, _ws) in dists])
+    for dist in active:
+        if dist not in found:
+            dists.append((dist, False, True))
+    return dists
+
+
+def scan_entry(path_item):
+    """
+    Scan a path entry and make its snapshot record
+
+    There is no record if a distribution's metadata isn't in a plain
+    directory or file (e.g. a zipped egg), or if anything changed too
+    recently for its modification time to be trusted.
+
+    @returns: tuple of record dict or None, and the distributions found,
+              see `scan_dists`
+    """
+    now = time.time()
+    mtime = get_mtime(path_item)
+    dists = scan_dists(path_item)
+    record = {'mtime': mtime, 'dists': []}
+    if mtime is not None and now - mtime < RACY_SECONDS:
+        record = None
+    for (dist, in_environment, in_working_set) in dists:
+        if record is None:
+            break
+        metadata = get_metadata_paths(dist)
+        try:
+            version = dist.version
+        except ValueError:
+            metadata = None
+        if metadata is None:
+            record = None
+            break
+        info_mtime = get_mtime(metadata[-1])
+        if info_mtime is None or now - info_mtime < RACY_SECONDS:
+            record = None
+            break
+        #Rewriting the PKG-INFO of e.g. an unversioned Foo.egg-info
+        #directory changes the version without touching the directory
+        version_file = get_version_file(dist, metadata)
+        if version_file is not None:
+            version_mtime = get_mtime(version_file)
+            if version_mtime is None or now - version_mtime < RACY_SECONDS:
+                record = None
+                break
+            version_file = [version_file, version_mtime]
+        record['dists'].append({'location': dist.location,
+            'project_name': dist.project_name, 'version': version,
+            'py_version': dist.py_version, 'platform': dist.platform,
+            'precedence': dist.precedence,
+            'class': dist.__class__.__name__,
+            'metadata': metadata, 'mtime': info_mtime,
+            'version_file': version_file,
+            'env': in_environment, 'ws': in_working_set})
+    return (record, dists)
+
+
+def scan_metadata_entry(path_item):
+    """
+    Scan a path entry with importlib.metadata and make its snapshot
+    record, see `scan_entry`
+
+    @returns: tuple of record dict or None, and the distributions found,
+              see `yolk.yolklib.find_entry_dists`
+    """
+    from yolk.yolklib import find_entry_dists
+    now = time.time()
+    mtime = get_mtime(path_item)
+    dists = find_entry_dists(path_item)
+    record = {'mtime': mtime, 'dists': []}
+    if mtime is not None and now - mtime < RACY_SECONDS:
+        record = None
+    for (dist, egg) in dists:
+        if record is None:
+            break
+        #Name and version are read from the metadata file
+        filename = dist.metadata_file('PKG-INFO')
+        info_mtime = dist.path and get_mtime(dist.path)
+        file_mtime = filename and get_mtime(filename)
+        if info_mtime is None or file_mtime is None or \
+                now - max(info_mtime, file_mtime) < RACY_SECONDS:
+            record = None
+            break
+        record['dists'].append({'metadata': [dist.path],
+            'mtime': info_mtime, 'version_file': [filename, file_mtime],
+            'project_name': dist.project_name, 'version': dist.version,
+            'egg': egg})
+    return (record, dists)
+
+
+def get_metadata_paths(dist):
+    """
+    Return where a distribution's metadata provider reads from
+
+    @returns: [module_path, egg_info] for a metadata directory, [path]
+              for a metadata file (e.g. foo.egg-info), or None for
+              anything else, e.g. a zipped egg
+    """
+    import pkg_resources
+    provider = getattr(dist, '_provider', None)
+    if isinstance(provider, pkg_resources.PathMetadata):
+        return [provider.module_path, provider.egg_info]
+    if isinstance(provider, pkg_resources.FileMetadata):
+        return [provider.path]
+
+
+def get_version_file(dist, metadata):
+    """
+    Return the metadata file a distribution's version is read from, or
+    None if it comes from its directory's name or the file is already
+    checked, see `get_metadata_paths`
+    """
+    import pkg_resources
+    if len(metadata) != 2:
+        return
+    #e.g. Foo-1.0.egg-info, or Foo-1.0-py2.7.egg for its EGG-INFO
+    (module_path, egg_info) = metadata
+    if os.path.basename(egg_info) == 'EGG-INFO':
+        name = os.path.basename(module_path)
+    else:
+        name = os.path.basename(egg_info)
+    match = pkg_resources.EGG_NAME(os.path.splitext(name)[0])
+    if match and match.group('ver'):
+        return
+    return os.path.join(metadata[1], getattr(dist, 'PKG_INFO', 'PKG-INFO'))
+
+
+def make_dist(info):
+    """Rebuild a distribution from its snapshot record"""
+    import pkg_resources
+    if len(info['metadata']) == 2:
+        metadata = pkg_resources.PathMetadata(*info['metadata'])
+    else:
+        metadata = pkg_resources.FileMetadata(info['metadata'][0])
+    #e.g. DistInfoDistribution, which reads METADATA instead of PKG-INFO
+    cls = getattr(pkg_resources, info['class'], None)
+    if not (isinstance(cls, type) and
+            issubclass(cls, pkg_resources.Distribution)):
+        cls = pkg_resources.Distribution
+    return cls(location=info['location'], metadata=metadata,
+            project_name=info['project_name'], version=info['version'],
+            py_version=info['py_version'], platform=info['platform'],
+            precedence=info['precedence'])
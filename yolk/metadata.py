@@ -1,5 +1,5 @@
 # pylint: disable-msg=W0212
-# W0212 Access to a protected member _headers of a client class
+# W0212 Access to a protected member _provider of a client class
 
 """
 
@@ -13,31 +13,142 @@ License  : BSD (See COPYING)
 Desc     : Return metadata for Python distribution installed by setuptools
            in a dict
 
-           Note: The metadata uses RFC 2822-based message documents.
+           Note: The metadata uses RFC 2822-based message documents, of
+           which only the headers are read.
 
 """
 
 __docformat__ = 'restructuredtext'
 
-import email
+import io
+import os
+import platform
 
 
-def get_metadata(dist):
+#Fields that may be given more than once, their values are lists
+MULTIPLE_USE_FIELDS = set(['platform', 'supported-platform', 'classifier',
+    'requires', 'provides', 'obsoletes', 'requires-dist', 'provides-dist',
+    'obsoletes-dist', 'requires-external', 'project-url', 'provides-extra',
+    'license-file', 'dynamic'])
+
+
+def get_metadata(dist, fields=None):
     """
     Return dictionary of metadata for given dist
 
+    Only the header block of PKG-INFO is read, not the long description
+    after it. Fields that may be given more than once, e.g. Classifier,
+    are lists of values.
+
     @param dist: distribution
     @type dist: pkg_resources Distribution object
 
+    @param fields: only return these fields (any case), all if None
+    @type fields: list of strings
+
     @returns: dict of metadata or None
 
     """
     if not dist.has_metadata('PKG-INFO'):
         return
 
-    msg = email.message_from_string(dist.get_metadata('PKG-INFO'))
-    metadata = {}
-    for header in [l for l in msg._headers]:
-        metadata[header[0]] = header[1]
+    filename = get_metadata_file(dist)
+    if filename:
+        try:
+            if platform.python_version().startswith('2'):
+                metadata_file = open(filename)
+            else:
+                metadata_file = io.open(filename, encoding='utf-8',
+                        errors='replace')
+            try:
+                return parse_headers(metadata_file, fields)
+            finally:
+                metadata_file.close()
+        except (IOError, OSError):
+            pass
+    return parse_headers(dist.get_metadata('PKG-INFO').splitlines(True),
+            fields)
+
+
+def get_metadata_file(dist):
+    """
+    Return filename of a dist's PKG-INFO, or None if it isn't a plain
+    file, e.g. in a zipped egg
 
+    @param dist: distribution
+    @type dist: pkg_resources Distribution object
+
+    @returns: filename string or None
+    """
+    if hasattr(dist, 'metadata_file'):
+        #yolk.yolklib.InstalledDistribution
+        return dist.metadata_file('PKG-INFO')
+    provider = getattr(dist, '_provider', None)
+    #pkg_resources FileMetadata is a foo.egg-info file, PathMetadata a
+    #directory
+    filename = getattr(provider, 'path', None)
+    if filename is None and getattr(provider, 'egg_info', None):
+        filename = os.path.join(provider.egg_info, 'PKG-INFO')
+    if filename and os.path.isfile(filename):
+        return filename
+
+
+def parse_headers(lines, fields=None):
+    """
+    Return dict of the RFC 822 style headers at the start of `lines`
+
+    Reading stops at the first blank line, or as soon as every field
+    asked for has been found. Folded (continued) lines are kept in the
+    value, joined by newlines, as the email package does.
+
+    @param lines: lines of a PKG-INFO or METADATA file
+    @type lines: iterable of strings
+
+    @param fields: only return these fields (any case), all if None
+    @type fields: list of strings
+
+    @returns: dict of field names to strings, or lists of strings for
+              `MULTIPLE_USE_FIELDS`
+    """
+    if fields is not None:
+        wanted = set([field.lower() for field in fields])
+        #Fields given once are done with when they have been seen
+        remaining = wanted - MULTIPLE_USE_FIELDS
+        if wanted & MULTIPLE_USE_FIELDS:
+            remaining = None
+    metadata = {}
+    name = None
+    value = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            value.append(line)
+            continue
+        if name is not None:
+            add_header(metadata, name, value)
+            name = None
+        if not line or ':' not in line:
+            break
+        if fields is not None and remaining is not None and not remaining:
+            break
+        (field, field_value) = line.split(':', 1)
+        if fields is None or field.lower() in wanted:
+            name = field
+            value = [field_value.lstrip(' \t')]
+            if fields is not None and remaining is not None:
+                remaining.discard(field.lower())
+        else:
+            #Skipped along with its continuation lines
+            value = []
+    if name is not None:
+        add_header(metadata, name, value)
     return metadata
+
+
+def add_header(metadata, name, value):
+    """Add a header's value lines to `metadata`, see `parse_headers`"""
+    value = "\n".join(value)
+    if name.lower() in MULTIPLE_USE_FIELDS:
+        metadata.setdefault(name, []).append(value)
+    else:
+        metadata[name] = value
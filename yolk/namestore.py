@@ -0,0 +1,169 @@
+"""
+
+namestore.py
+============
+
+Desc: Compact on-disk store of PyPI package names
+
+      The file is memory-mapped and binary-searched in place, so looking
+      up a name only touches a few pages instead of loading every name
+      on PyPI into memory.
+
+      File layout (integers are little-endian):
+
+        header   8 byte magic, name count, index count, names size
+        names    UTF-8 names sorted by name, each prefixed by its length
+                 as an unsigned short
+        index    unsigned int offsets into `names`, sorted by the
+                 PEP 503 normalized form of the name they point to
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import mmap
+import os
+import struct
+
+from yolk.utils import atomic_write, normalize_name
+
+
+MAGIC = b'YOLKPKG1'
+HEADER = struct.Struct('<8sIII')
+NAME_LENGTH = struct.Struct('<H')
+OFFSET = struct.Struct('<I')
+
+
+class PackageNameStore(object):
+
+    """
+    Read-only mapping of normalized package names to PyPI package names
+
+    It supports `in`, `get`, `values` and `len` like the dict it replaces.
+    """
+
+    def __init__(self, filename):
+        """
+        @param filename: file written by `write_name_store`
+        @type filename: string
+
+        @raises ValueError: if the file is truncated or not a name store
+        """
+        self.filename = filename
+        fileobj = open(filename, 'rb')
+        try:
+            size = os.fstat(fileobj.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError("Truncated package name store: %s" % filename)
+            self.data = mmap.mmap(fileobj.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        finally:
+            fileobj.close()
+        (magic, self.name_count, self.index_count, names_size) = \
+                HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or \
+                size != HEADER.size + names_size + OFFSET.size * self.index_count:
+            self.data.close()
+            raise ValueError("Not a valid package name store: %s" % filename)
+        self.names_start = HEADER.size
+        self.index_start = HEADER.size + names_size
+
+    def __len__(self):
+        return self.name_count
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def name_at(self, offset):
+        """
+        Return package name stored at `offset` in the names section
+        """
+        pos = self.names_start + offset
+        (length,) = NAME_LENGTH.unpack_from(self.data, pos)
+        pos += NAME_LENGTH.size
+        return self.data[pos:pos + length].decode('utf-8')
+
+    def get(self, key, default=None):
+        """
+        Return the PyPI name of a package given its normalized name
+
+        @param key: PEP 503 normalized package name
+        @type key: string
+
+        @returns: package name string or `default` if it isn't stored
+
+        """
+        low = 0
+        high = self.index_count
+        while low < high:
+            middle = (low + high) // 2
+            (offset,) = OFFSET.unpack_from(self.data,
+                    self.index_start + OFFSET.size * middle)
+            name = self.name_at(offset)
+            middle_key = normalize_name(name)
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return name
+        return default
+
+    def values(self):
+        """
+        Yield every package name, in sorted order
+        """
+        pos = self.names_start
+        for _i in range(self.name_count):
+            (length,) = NAME_LENGTH.unpack_from(self.data, pos)
+            pos += NAME_LENGTH.size
+            yield self.data[pos:pos + length].decode('utf-8')
+            pos += length
+
+    def close(self):
+        """Unmap the file"""
+        self.data.close()
+
+
+def write_name_store(filename, names):
+    """
+    Write package names to a file that `PackageNameStore` can read
+
+    When several names normalize to the same key, the first one in sorted
+    order is the one found by lookups.
+
+    @param filename: file to write
+    @type filename: string
+
+    @param names: package names
+    @type names: iterable of strings
+
+    """
+    unique_names = set()
+    for name in names:
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        unique_names.add(name)
+    names = sorted(unique_names)
+
+    records = []
+    offsets = []
+    pos = 0
+    for name in names:
+        data = name.encode('utf-8')
+        offsets.append(pos)
+        records.append(NAME_LENGTH.pack(len(data)) + data)
+        pos += NAME_LENGTH.size + len(data)
+
+    keyed = {}
+    for (i, name) in enumerate(names):
+        keyed.setdefault(normalize_name(name), offsets[i])
+    index = [OFFSET.pack(keyed[key]) for key in sorted(keyed)]
+
+    #Replace the file atomically, so processes reading the old one are
+    #not affected. Windows refuses to replace a file while it is mapped,
+    #raising OSError, see `yolk.pypi.CheeseShop.write_pkg_list`.
+    atomic_write(filename, HEADER.pack(MAGIC, len(names), len(index), pos) +
+            b''.join(records) + b''.join(index))
@@ -66,9 +66,9 @@ acquire a logger in the ``yolk.plugins`` namespace.
 """
 
 import logging
-import pkg_resources
 from warnings import warn
 from yolk.plugins.base import Plugin
+from yolk.utils import iter_entry_points
 
 #LOG = logging.getLogger(__name__)
 
@@ -89,7 +89,7 @@ def call_plugins(plugins, method, *arg, **kw):
 def load_plugins(builtin=True, others=True):
     """Load plugins, either builtin, others, or both.
     """
-    for entry_point in pkg_resources.iter_entry_points('yolk.plugins'):
+    for entry_point in iter_entry_points('yolk.plugins'):
         #LOG.debug("load plugin %s" % entry_point)
         try:
             plugin = entry_point.load()
@@ -20,52 +20,244 @@ import re
 import platform
 if platform.python_version().startswith('2'):
     import xmlrpclib
-    import cPickle
     import urllib2
+    import httplib
+    from urllib import quote
+    from urlparse import urljoin, urlparse
 else:
     import xmlrpc.client as xmlrpclib
-    import pickle
     import urllib.request as urllib2
+    import http.client as httplib
+    from urllib.parse import quote, urljoin, urlparse
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 import os
+import json
+import base64
 import time
+import socket
 import logging
+import sqlite3
+import threading
 import urllib
+import zlib
 
-from yolk.utils import get_yolk_dir
+from yolk.__init__ import __version__ as VERSION
+from yolk.cache import CHANGELOG_MAX_AGE, open_response_cache
+from yolk.namestore import PackageNameStore, write_name_store
+from yolk.resilience import REQUEST_TIMEOUT, RETRY_STATUSES, Resilience, \
+        TransientError
+from yolk.snapshot import Snapshot
+from yolk.utils import FileLock, atomic_write, get_yolk_dir, normalize_name, \
+        parallel_map
+from yolk.yolklib import is_prerelease, parse_version
 
 
 XML_RPC_SERVER = 'http://pypi.python.org/pypi'
 
-class addinfourl(urllib2.addinfourl):
+#Maximum number of XML-RPC calls sent in one system.multicall request
+MULTICALL_BATCH_SIZE = 100
+
+#Changelog entries written to the response cache at a time
+CHANGELOG_BATCH_SIZE = 1000
+
+#Seconds before the cached package name list is brought up to date
+PKG_LIST_MAX_AGE = 60 * 60 * 24
+
+#Ways of querying PyPI about a project, see `CheeseShop.get_backend`
+BACKENDS = ('auto', 'json', 'xmlrpc')
+
+#Maximum number of HTTP redirects followed by the JSON backend
+MAX_REDIRECTS = 5
+
+#Compressed bytes read from a gzip encoded response at a time
+GZIP_CHUNK_SIZE = 16 * 1024
+
+#Smallest XML-RPC request body worth compressing, when it is turned on
+COMPRESS_THRESHOLD = 16 * 1024
+
+
+class JSONAPIError(Exception):
+    """Raised when PyPI's JSON API can't be used"""
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections
+
+    Idle connections are kept per (scheme, host) so they can be reused
+    by the next request to the same host instead of opening a new TCP
+    (and TLS) connection each time.
+
+    Requests are routed through the proxy set in the environment, e.g.
+    HTTP_PROXY, the same way urllib2 does it.
+
+    Whoever sends requests through the pool should make them with its
+    `resilience` policy, see `yolk.resilience.Resilience.call`.
+    """
+
+    def __init__(self, max_idle=8, timeout=REQUEST_TIMEOUT, resilience=None):
+        #Maximum number of idle connections kept for each host
+        self.max_idle = max_idle
+        #Seconds to wait for a connection or data, None to wait forever
+        self.timeout = timeout
+        if resilience is None:
+            resilience = Resilience()
+        self.resilience = resilience
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def new_connection(self, scheme, host):
+        """
+        Open a connection to `host`, or to the proxy for `host`
+
+        @returns: httplib.HTTPConnection or httplib.HTTPSConnection
+        """
+        proxy = get_proxy(scheme, host)
+        if scheme == 'https':
+            if proxy:
+                conn = httplib.HTTPSConnection(proxy, timeout=self.timeout)
+                conn.set_tunnel(host)
+            else:
+                conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(proxy or host, timeout=self.timeout)
+        return conn
+
+    def get_connection(self, scheme, host):
+        """
+        Return an idle connection to `host` or a new one
+
+        @returns: tuple of connection and True if it was reused
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return (idle.pop(), True)
+        finally:
+            self.lock.release()
+        return (self.new_connection(scheme, host), False)
+
+    def release(self, scheme, host, conn, response):
+        """
+        Give a connection back to the pool once its response has been read
+        """
+        if response.will_close:
+            conn.close()
+            return
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None, verbose=False):
+        """
+        Send a HTTP request using a pooled connection
+
+        The response must be read to the end and handed back with
+        `release` so the connection can be reused.
+
+        @returns: tuple of (scheme, host, connection, response)
+        """
+        (scheme, host, path, params, query, _fragment) = urlparse(url)
+        if query:
+            path = "%s?%s" % (path, query)
+        if get_proxy(scheme, host) and scheme != 'https':
+            #Plain HTTP proxies want the whole URL in the request line
+            path = url
+        while True:
+            (conn, reused) = self.get_connection(scheme, host)
+            if verbose:
+                conn.set_debuglevel(1)
+            try:
+                conn.request(method, path, body, headers or {})
+                return (scheme, host, conn, conn.getresponse())
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                #The server may have dropped an idle connection, so try
+                #again with a new one. Fail for real on a new connection.
+                if not reused:
+                    raise
+
+
+def get_proxy(scheme, host):
     """
-    Replacement addinfourl class compatible with python-2.7's xmlrpclib
+    Return host:port of the proxy to use for `host` or None
 
-    In python-2.7, xmlrpclib expects that the response object that it receives
-    has a getheader method. httplib.HTTPResponse provides this but
-    urllib2.addinfourl does not. Add the necessary functions here, ported to
-    use the internal data structures of addinfourl.
+    Uses the same environment variables as urllib2 (http_proxy,
+    https_proxy, no_proxy...)
     """
+    proxy = urllib2.getproxies().get(scheme)
+    if not proxy or urllib2.proxy_bypass(host):
+        return
+    if "://" in proxy:
+        proxy = urlparse(proxy)[1]
+    return proxy
 
-    def getheader(self, name, default=None):
-        if self.headers is None:
-            raise httplib.ResponseNotReady()
-        return self.headers.getheader(name, default)
 
-    def getheaders(self):
-        if self.headers is None:
-            raise httplib.ResponseNotReady()
-        return self.headers.items()
+#Connections are shared by everything in yolk that talks to PyPI
+CONNECTION_POOL = ConnectionPool()
 
-urllib2.addinfourl = addinfourl
+
+class GzipReader(object):
+
+    """
+    File-like wrapper decompressing a gzip encoded response as it is read
+
+    Only a chunk of the compressed response and what it expands to are
+    in memory at a time.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        #16 + MAX_WBITS: expect a gzip header
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b""
+        self.eof = False
+
+    def read(self, size=-1):
+        """Read and return up to `size` decompressed bytes, all if -1"""
+        while not self.eof and (size is None or size < 0 or
+                len(self.buffer) < size):
+            data = self.response.read(GZIP_CHUNK_SIZE)
+            if data:
+                self.buffer += self.decompressor.decompress(data)
+            else:
+                self.buffer += self.decompressor.flush()
+                self.eof = True
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+
+def decode_response(response):
+    """
+    Return a file-like object to read a response's body from, which
+    decompresses it if the server gzipped it
+    """
+    if response.getheader('Content-Encoding', '').lower() == 'gzip':
+        return GzipReader(response)
+    return response
 
 
 class ProxyTransport(xmlrpclib.Transport):
     """
     Provides an XMl-RPC transport routing via a http proxy.
 
-    This is done by using urllib2, which in turn uses the environment
-    varable http_proxy and whatever else it is built to use (e.g. the
-    windows    registry).
+    Requests go through a `ConnectionPool`, which honours the environment
+    varable http_proxy and keeps HTTP/1.1 connections alive between calls.
+    It is safe to use from several threads at once.
 
     NOTE: the environment variable http_proxy should be set correctly.
     See check_proxy_setting() below.
@@ -76,20 +268,63 @@ class ProxyTransport(xmlrpclib.Transport):
     A. Ellerton 2006-07-06
     """
 
-    def request(self, host, handler, request_body, verbose):
+    def __init__(self, scheme='http', pool=None, encode_threshold=None):
+        """
+        @param encode_threshold: gzip request bodies of at least this many
+                                 bytes, None to never. The server has to
+                                 support it; if it turns one down it is
+                                 sent again uncompressed.
+        @type encode_threshold: int
+        """
+        xmlrpclib.Transport.__init__(self)
+        self.scheme = scheme
+        if pool is None:
+            pool = CONNECTION_POOL
+        self.pool = pool
+        self.encode_threshold = encode_threshold
+
+    def request(self, host, handler, request_body, verbose=False):
         '''Send xml-rpc request using proxy'''
         #We get a traceback if we don't have this attribute:
         self.verbose = verbose
-        url = 'http://' + host + handler
-        request = urllib2.Request(url)
-        request.add_data(request_body)
+        url = '%s://%s%s' % (self.scheme, host, handler)
+        #Every call yolk makes only reads from PyPI, so it can be repeated
+        return self.pool.resilience.call(host, lambda: self.send_pooled(url,
+            request_body, verbose))
+
+    def send_pooled(self, url, request_body, verbose):
+        """Send a request with a pooled connection and parse the response"""
         # Note: 'Host' and 'Content-Length' are added automatically
-        request.add_header('User-Agent', self.user_agent)
-        request.add_header('Content-Type', 'text/xml')
-        proxy_handler = urllib2.ProxyHandler()
-        opener = urllib2.build_opener(proxy_handler)
-        fhandle = opener.open(request)
-        return(self.parse_response(fhandle))
+        headers = {'User-Agent': self.user_agent,
+                'Content-Type': 'text/xml',
+                'Accept-Encoding': 'gzip'}
+        threshold = self.encode_threshold
+        body = request_body
+        if threshold is not None and len(request_body) >= threshold:
+            body = xmlrpclib.gzip_encode(request_body)
+            headers['Content-Encoding'] = 'gzip'
+        (scheme, host, conn, response) = self.pool.request('POST', url,
+                body, headers, verbose)
+        result = None
+        try:
+            if response.status in (400, 415, 501) and body is not request_body:
+                #The server can't read compressed requests
+                response.read()
+                self.encode_threshold = None
+            elif response.status != 200:
+                response.read()
+                raise xmlrpclib.ProtocolError(url, response.status,
+                        response.reason, response.msg)
+            else:
+                #parse_response would read a gzipped response all at once
+                result = self.parse_response(decode_response(response))
+        except:
+            conn.close()
+            raise
+        self.pool.release(scheme, host, conn, response)
+        if self.encode_threshold is None and body is not request_body:
+            return self.send_pooled(url, request_body, verbose)
+        return result
 
 
 def check_proxy_setting():
@@ -117,41 +352,667 @@ def check_proxy_setting():
     return
 
 
+class XMLRPCBackend(object):
+
+    """
+    Project queries made with PyPI's XML-RPC interface
+
+    Every release needs its own release_data and release_urls call, but
+    calls for many releases are batched with system.multicall.
+    """
+
+    name = 'xmlrpc'
+
+    def __init__(self, shop):
+        """
+        @param shop: used to make (cached) XML-RPC calls
+        @type shop: `CheeseShop`
+        """
+        self.shop = shop
+
+    def package_releases(self, package_name, show_hidden=False):
+        """
+        Return versions of a package, newest first
+
+        @param show_hidden: True for every release, not just the latest
+        @type show_hidden: boolean
+        """
+        if show_hidden:
+            return self.shop.cached_call("package_releases", package_name,
+                    True)
+        return self.shop.cached_call("package_releases", package_name)
+
+    def package_releases_many(self, package_names, jobs=1):
+        """Yield versions of each package in `package_names`, in order"""
+        calls = [("package_releases", (name,)) for name in package_names]
+        for versions in self.shop.multicall(calls, jobs):
+            if isinstance(versions, xmlrpclib.Fault):
+                raise versions
+            yield versions
+
+    def release_data(self, package_name, version):
+        """Return metadata of a release or None if there is no such release"""
+        try:
+            return self.shop.cached_call("release_data", package_name, version)
+        except xmlrpclib.Fault:
+            #XXX Raises xmlrpclib.Fault if you give non-existant version
+            #Could this be server bug?
+            return
+
+    def release_urls(self, package_name, version):
+        """Return files of a release"""
+        return self.shop.cached_call("release_urls", package_name, version)
+
+    def get_releases(self, package_name, versions, metadata=True):
+        """
+        Return metadata and files of several releases of a package
+
+        @param metadata: False if only the files are wanted
+        @type metadata: boolean
+
+        @returns: list of (metadata, files) tuples, one for each version.
+                  metadata is None if not wanted or not known.
+        """
+        #Fetch everything in as few requests as we can
+        calls = []
+        for ver in versions:
+            if metadata:
+                calls.append(("release_data", (package_name, ver)))
+            calls.append(("release_urls", (package_name, ver)))
+        results = list(self.shop.multicall(calls))
+
+        releases = []
+        for i in range(len(versions)):
+            if metadata:
+                release_data = results[2 * i]
+                release_urls = results[2 * i + 1]
+            else:
+                release_data = None
+                release_urls = results[i]
+            if isinstance(release_data, xmlrpclib.Fault):
+                #XXX Raises xmlrpclib.Fault if you give non-existant version
+                release_data = None
+            if isinstance(release_urls, xmlrpclib.Fault):
+                raise release_urls
+            releases.append((release_data, release_urls))
+        return releases
+
+    def iter_release_files(self, package_name, versions, metadata=True,
+            jobs=1):
+        """
+        Yield files of several releases of a package, in version order
+
+        Files are fetched in batches of multicalls, `jobs` batches at a
+        time, and yielded as each batch arrives. Metadata is only fetched
+        for releases without files, whose download_url is all there is.
+
+        @param metadata: False if metadata is never wanted
+        @type metadata: boolean
+
+        @returns: yields (metadata, files) tuples, metadata is None for
+                  releases with files
+        """
+        files = self.shop.multicall([("release_urls", (package_name, ver))
+            for ver in versions], jobs)
+        size = max(self.shop.batch_size, 1)
+        for start in range(0, len(versions), size):
+            batch = [(ver, next(files)) for ver in versions[start:start + size]]
+            calls = []
+            for (ver, release_urls) in batch:
+                if isinstance(release_urls, xmlrpclib.Fault):
+                    raise release_urls
+                if metadata and not release_urls:
+                    calls.append(("release_data", (package_name, ver)))
+            found = dict(zip([args[1] for (_method, args) in calls],
+                self.shop.multicall(calls)))
+            for (ver, release_urls) in batch:
+                release_data = found.get(ver)
+                if isinstance(release_data, xmlrpclib.Fault):
+                    release_data = None
+                yield (release_data, release_urls)
+
+
+class JSONBackend(object):
+
+    """
+    Project queries answered from PyPI's JSON API
+
+    One request for a project's JSON document gives every version, the
+    files of every release and the metadata of the latest release. The
+    document is kept for the rest of the run, and in the response cache,
+    so later queries about the same project cost nothing.
+
+    If a `fallback` backend is given, it takes over for the rest of the
+    run as soon as the JSON API turns out not to work.
+    """
+
+    name = 'json'
+
+    def __init__(self, shop, fallback=None, pool=None):
+        """
+        @param shop: gives the server URL and response cache
+        @type shop: `CheeseShop`
+
+        @param fallback: backend to use if the JSON API fails
+        @type fallback: `XMLRPCBackend`
+
+        @param pool: connections to use, `CONNECTION_POOL` if None
+        @type pool: `ConnectionPool`
+        """
+        self.shop = shop
+        self.fallback = fallback
+        if pool is None:
+            pool = CONNECTION_POOL
+        self.pool = pool
+        #Documents fetched this run, keyed by normalized project name
+        self.projects = {}
+        self.releases = {}
+        #True once the server has given us a JSON document
+        self.confirmed = False
+        #True once we've given up on the JSON API for this run
+        self.failed = False
+        self.verbose = 'XMLRPC_DEBUG' in os.environ
+        self.logger = logging.getLogger("yolk")
+
+    def use_fallback(self, err_msg):
+        """
+        Give up on the JSON API and return the backend to use instead
+
+        @raises JSONAPIError: if there is no fallback
+        """
+        if self.fallback is None:
+            raise err_msg
+        if not self.failed:
+            self.logger.debug("DEBUG: PyPI JSON API failed (%s), " \
+                    "using XML-RPC" % err_msg)
+            self.failed = True
+        return self.fallback
+
+    def package_releases(self, package_name, show_hidden=False):
+        """
+        Return versions of a package like XML-RPC's package_releases: only
+        the latest stable release, see `get_latest_version`, or every
+        release newest first with `show_hidden`
+        """
+        try:
+            doc = self.get_project(package_name)
+        except JSONAPIError as err_msg:
+            return self.use_fallback(err_msg).package_releases(package_name,
+                    show_hidden)
+        if doc is None:
+            return []
+        if show_hidden:
+            return sort_versions(doc.get('releases', {}).keys())
+        latest = get_latest_version(doc)
+        if latest is None:
+            return []
+        return [latest]
+
+    def package_releases_many(self, package_names, jobs=1):
+        """
+        Yield versions of each package in `package_names`, in order
+
+        One XML-RPC multicall answers a whole batch of packages where the
+        JSON API needs a request for each, so the fallback backend is
+        asked if there is one.
+        """
+        if self.fallback is None:
+            return parallel_map(self.package_releases, package_names, jobs)
+        return self.iter_package_releases(list(package_names), jobs)
+
+    def iter_package_releases(self, package_names, jobs=1):
+        """
+        Yield versions of each package with XML-RPC multicalls, using the
+        JSON API for the rest if XML-RPC fails
+        """
+        done = 0
+        try:
+            for versions in self.fallback.package_releases_many(
+                    package_names, jobs):
+                yield versions
+                done += 1
+        except (xmlrpclib.ProtocolError, httplib.HTTPException,
+                socket.error, IOError) as err_msg:
+            if self.failed:
+                raise
+            self.logger.debug("DEBUG: XML-RPC failed (%s), using the " \
+                    "PyPI JSON API" % err_msg)
+            for versions in parallel_map(self.package_releases,
+                    package_names[done:], jobs):
+                yield versions
+
+    def release_data(self, package_name, version):
+        """Return metadata of a release or None if there is no such release"""
+        try:
+            doc = self.get_project(package_name)
+            if doc is not None and doc['info'].get('version') == version:
+                return doc['info']
+            #Only the latest release's metadata is in the project document
+            doc = self.get_release(package_name, version)
+        except JSONAPIError as err_msg:
+            return self.use_fallback(err_msg).release_data(package_name,
+                    version)
+        if doc is not None:
+            return doc['info']
+
+    def release_urls(self, package_name, version):
+        """Return files of a release"""
+        try:
+            return self.get_files(package_name, version)
+        except JSONAPIError as err_msg:
+            return self.use_fallback(err_msg).release_urls(package_name,
+                    version)
+
+    def get_releases(self, package_name, versions, metadata=True):
+        """
+        Return metadata and files of several releases of a package
+
+        See `XMLRPCBackend.get_releases`. Metadata of releases other than
+        the latest costs a request each, so only ask for it if needed.
+        """
+        try:
+            releases = []
+            for ver in versions:
+                release_data = None
+                if metadata:
+                    release_data = self.release_data(package_name, ver)
+                releases.append((release_data,
+                    self.get_files(package_name, ver)))
+            return releases
+        except JSONAPIError as err_msg:
+            return self.use_fallback(err_msg).get_releases(package_name,
+                    versions, metadata)
+
+    def iter_release_files(self, package_name, versions, metadata=True,
+            jobs=1):
+        """
+        Yield files of several releases of a package, in version order
+
+        See `XMLRPCBackend.iter_release_files`. Files usually all come
+        from the project document; releases that need a request of their
+        own are fetched `jobs` at a time.
+        """
+        def get_release(ver):
+            release_urls = self.get_files(package_name, ver)
+            release_data = None
+            if metadata and not release_urls:
+                release_data = self.release_data(package_name, ver)
+            return (release_data, release_urls)
+        done = 0
+        try:
+            if self.failed:
+                raise JSONAPIError("PyPI JSON API failed before")
+            #Fetch the project document once, before the threads need it
+            self.get_project(package_name)
+            for release in parallel_map(get_release, versions, jobs):
+                yield release
+                done += 1
+        except JSONAPIError as err_msg:
+            for release in self.use_fallback(err_msg).iter_release_files(
+                    package_name, versions[done:], metadata, jobs):
+                yield release
+
+    def get_files(self, package_name, version):
+        """
+        Return files of a release, from the project document if we can
+
+        @raises JSONAPIError: if the JSON API doesn't work
+        """
+        doc = self.get_project(package_name)
+        if doc is not None and version in doc['releases']:
+            return doc['releases'][version]
+        doc = self.get_release(package_name, version)
+        if doc is None:
+            return []
+        return doc['urls']
+
+    def get_project(self, package_name):
+        """
+        Return JSON document of a project
+
+        @returns: dict with 'info' and 'releases' or None if PyPI has no
+                  such project
+
+        @raises JSONAPIError: if the JSON API doesn't work
+        """
+        key = normalize_name(package_name)
+        if key in self.projects:
+            return self.projects[key]
+        doc = self.fetch_doc('project_json', (key,), package_name,
+                '%s/%s/json' % (XML_RPC_SERVER, quote(package_name)))
+        if doc is None and self.fallback is not None and not self.confirmed:
+            #A server without the JSON API may answer 404 for everything
+            if self.fallback.package_releases(package_name):
+                raise JSONAPIError("%s has no JSON document" % package_name)
+        self.projects[key] = doc
+        return doc
+
+    def get_release(self, package_name, version):
+        """
+        Return JSON document of a release
+
+        @returns: dict with 'info' and 'urls' or None if PyPI has no such
+                  release
+
+        @raises JSONAPIError: if the JSON API doesn't work
+        """
+        key = (normalize_name(package_name), version)
+        if key in self.releases:
+            return self.releases[key]
+        doc = self.fetch_doc('release_json', key, key[0],
+                '%s/%s/%s/json' % (XML_RPC_SERVER, quote(package_name),
+                    quote(version)))
+        self.releases[key] = doc
+        return doc
+
+    def fetch_doc(self, method, args, package_name, url):
+        """
+        Return a JSON document from the response cache or PyPI
+
+        Only the parts we use are kept, project documents can be large.
+
+        @raises JSONAPIError: if the JSON API doesn't work
+        """
+        if self.failed:
+            raise JSONAPIError("JSON API already failed")
+        cache = self.shop.get_response_cache()
+        if cache is not None:
+            doc = cache.get(method, args)
+            if doc is not None:
+                self.confirmed = True
+                return doc
+        doc = self.fetch_json(url)
+        if doc is None:
+            return
+        try:
+            doc = dict([(field, doc[field]) for field in ('info', 'releases',
+                'urls') if field in doc])
+            if not isinstance(doc['info'], dict):
+                raise TypeError("info is not an object")
+        except (KeyError, TypeError) as err_msg:
+            raise JSONAPIError("Unexpected JSON document from %s: %s" \
+                    % (url, err_msg))
+        if method == 'project_json':
+            #Same as the latest release's files in 'releases'
+            doc.pop('urls', None)
+        self.confirmed = True
+        if cache is not None:
+            cache.set(method, args, normalize_name(package_name), doc)
+        return doc
+
+    def fetch_json(self, url):
+        """
+        GET and decode a JSON document, following redirects
+
+        @returns: decoded document, or None if the server says 404
+
+        @raises JSONAPIError: on any other HTTP error or bad JSON
+        """
+        for _redirect in range(MAX_REDIRECTS + 1):
+            try:
+                (response, body) = self.pool.resilience.call(
+                        urlparse(url)[1], lambda: self.get(url))
+            except TransientError as err_msg:
+                raise JSONAPIError(str(err_msg))
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            if response.status == 404:
+                return
+            if response.status != 200:
+                raise JSONAPIError("%s %s from %s" % (response.status,
+                    response.reason, url))
+            try:
+                return json.loads(body.decode('utf-8'))
+            except ValueError as err_msg:
+                raise JSONAPIError("Bad JSON from %s: %s" % (url, err_msg))
+        raise JSONAPIError("Too many redirects from %s" % url)
+
+    def get(self, url):
+        """
+        GET a URL and read the whole response
+
+        @returns: tuple of response and body
+
+        @raises TransientError: on a response worth retrying, e.g. 503
+        """
+        headers = {'User-Agent': 'yolk/%s' % VERSION,
+                'Accept': 'application/json', 'Accept-Encoding': 'gzip'}
+        (scheme, host, conn, response) = self.pool.request('GET', url, None,
+                headers, self.verbose)
+        try:
+            body = decode_response(response).read()
+        except:
+            conn.close()
+            raise
+        self.pool.release(scheme, host, conn, response)
+        if response.status in RETRY_STATUSES:
+            raise TransientError(response.status, response.reason, url)
+        return (response, body)
+
+
 class CheeseShop(object):
 
     """Interface to Python Package Index"""
 
-    def __init__(self, debug=False, no_cache=False, yolk_dir=None):
+    def __init__(self, debug=False, no_cache=False, yolk_dir=None,
+            batch_size=MULTICALL_BATCH_SIZE, max_age=PKG_LIST_MAX_AGE,
+            backend='auto', snapshot=None, compress_requests=False):
+        """
+        @param snapshot: snapshot file written by
+                         `yolk.snapshot.write_snapshot`. If given, every
+                         query is answered from it instead of PyPI.
+        @type snapshot: string
+
+        @param compress_requests: gzip large XML-RPC requests, e.g.
+                                  multicall batches
+        @type compress_requests: boolean
+        """
         self.debug = debug
         self.no_cache = no_cache
+        #Seconds the package name list cache is used before it is synced
+        self.max_age = max_age
+        #Calls per system.multicall request, 1 or less disables batching
+        self.batch_size = batch_size
+        #Set to False if the server turns down system.multicall
+        self.multicall_supported = True
+        self.compress_requests = compress_requests
         if yolk_dir:
             self.yolk_dir = yolk_dir
         else:
             self.yolk_dir = get_yolk_dir()
-        self.xmlrpc = self.get_xmlrpc_server()
         self.pkg_cache_file = self.get_pkg_cache_file()
         self.last_sync_file = self.get_last_sync_file()
-        self.pkg_list = None
+        #The XML-RPC server proxy and package name cache are only set up
+        #when first used. See the `xmlrpc` and `pkg_index` properties.
+        self._xmlrpc = None
+        self._pkg_index = None
+        self.init_lock = threading.RLock()
+        #True once the package list has been brought up to date this run
+        self.pkg_list_synced = False
+        #Time of the sync the package list we loaded is from
+        self.pkg_list_time = 0
+        #Guards refetching the package list when called from several threads
+        self.pkg_list_lock = threading.Lock()
+        #Persistent cache of release metadata, opened on first use
+        self.response_cache = None
+        #Set if it couldn't be validated, so it isn't used this run
+        self.response_cache_failed = False
+        #Serial PyPI's changelog has been fetched since into the response
+        #cache this run, see `fetch_changelog_tail`
+        self.changelog_tail = None
+        self.changelog_tail_lock = threading.Lock()
+        self.response_cache_lock = threading.Lock()
         self.logger = logging.getLogger("yolk")
-        self.get_cache()
+        #Offline mode
+        self.snapshot = None
+        if snapshot:
+            self.snapshot = Snapshot(snapshot)
+            backend = 'snapshot'
+        #Answers queries about projects and their releases
+        self.backend = self.get_backend(backend)
+
+    def get_backend(self, name):
+        """
+        Return backend for project queries
+
+        @param name: 'xmlrpc', 'json', 'auto' for the JSON API with
+                     XML-RPC as a fallback, or 'snapshot' when offline
+        @type name: string
+
+        @returns: `JSONBackend`, `XMLRPCBackend` or `yolk.snapshot.Snapshot`
+        """
+        if name == 'snapshot':
+            return self.snapshot
+        elif name == 'xmlrpc':
+            return XMLRPCBackend(self)
+        elif name == 'json':
+            return JSONBackend(self)
+        elif name == 'auto':
+            return JSONBackend(self, fallback=XMLRPCBackend(self))
+        raise ValueError("Unknown PyPI backend: %s" % name)
+
+    def get_xmlrpc(self):
+        """
+        Return PyPI's XML-RPC server instance, creating it on first use
+        """
+        if self._xmlrpc is None:
+            self.init_lock.acquire()
+            try:
+                if self._xmlrpc is None:
+                    self._xmlrpc = self.get_xmlrpc_server()
+            finally:
+                self.init_lock.release()
+        return self._xmlrpc
+
+    xmlrpc = property(get_xmlrpc)
+
+    def get_pkg_index(self):
+        """
+        Return mapping of normalized package names to names as PyPI has them
+
+        The package name cache is loaded, or fetched, on first use.
+
+        @returns: `yolk.namestore.PackageNameStore`, or a dict if
+                  no_cache is set
+        """
+        if self._pkg_index is None:
+            self.init_lock.acquire()
+            try:
+                if self._pkg_index is None:
+                    self.get_cache()
+            finally:
+                self.init_lock.release()
+        return self._pkg_index
+
+    def set_pkg_index(self, pkg_index):
+        """Replace the normalized package name mapping"""
+        self._pkg_index = pkg_index
+
+    pkg_index = property(get_pkg_index, set_pkg_index)
 
     def get_cache(self):
         """
         Get a package name list from disk cache or PyPI
         """
+        if self.snapshot is not None:
+            self.pkg_index = self.snapshot.names
+            self.pkg_list_synced = True
+            return
+
         #This is used by external programs that import `CheeseShop` and don't
         #want a cache file written to ~/.pypi and query PyPI every time.
         if self.no_cache:
-            self.pkg_list = self.list_packages()
+            self.pkg_index = build_pkg_index(self.list_packages())
+            self.pkg_list_synced = True
             return
 
-        if not os.path.exists(self.yolk_dir):
-            os.mkdir(self.yolk_dir)
-        if os.path.exists(self.pkg_cache_file):
-            self.pkg_list = self.query_cached_package_list()
-        else:
+        self.make_yolk_dir()
+        try:
+            self.load_pkg_list()
+        except (IOError, OSError, ValueError) as err_msg:
+            #Missing or damaged
+            self.logger.debug("DEBUG: Can't read package list cache: %s" \
+                    % err_msg)
             self.logger.debug("DEBUG: Fetching package list cache from PyPi...")
-            self.fetch_pkg_list()
+            self.refresh_pkg_list(wait=True)
+            return
+        (last_sync, serial) = self.query_last_sync()
+        if time.time() - last_sync > self.max_age:
+            self.refresh_pkg_list(wait=False)
+
+    def make_yolk_dir(self):
+        """
+        Create the yolk dir if it doesn't exist
+        """
+        try:
+            os.mkdir(self.yolk_dir)
+        except OSError:
+            #Another process may have just made it
+            if not os.path.isdir(self.yolk_dir):
+                raise
+
+    def get_pkg_lock_file(self):
+        """
+        Returns filename locked while the pkg cache is being synced
+        """
+        return os.path.abspath('%s/pkg_list.lock' % self.yolk_dir)
+
+    def load_pkg_list(self):
+        """
+        Load the package name cache from disk
+
+        @raises IOError, OSError: if there is no cache
+        @raises ValueError: if the cache file is damaged
+        """
+        pkg_index = self.query_cached_package_list()
+        self.pkg_list_time = self.query_last_sync()[0]
+        self.pkg_index = pkg_index
+
+    def refresh_pkg_list(self, wait):
+        """
+        Bring the package name cache up to date with PyPI
+
+        Only one process syncs the cache at a time. If another one is
+        already doing it we either wait and use what it fetched, or
+        carry on with the cache we have.
+
+        @param wait: wait for another process syncing the cache
+        @type wait: boolean
+        """
+        lock = FileLock(self.get_pkg_lock_file())
+        if not lock.acquire(wait):
+            self.logger.debug("DEBUG: Package list cache is being synced " \
+                    "by another process, using the one we have")
+            return
+        try:
+            #See if another process synced it while we waited
+            (last_sync, serial) = self.query_last_sync()
+            if last_sync > self.pkg_list_time:
+                try:
+                    self.load_pkg_list()
+                    self.pkg_list_synced = True
+                    return
+                except (IOError, OSError, ValueError):
+                    pass
+            if self._pkg_index is None:
+                self.fetch_pkg_list()
+            else:
+                self.sync_pkg_list()
+        finally:
+            lock.release()
+
+    def get_pkg_list(self):
+        """
+        Return list of all package names on PyPI
+
+        Note: this reads every cached name, `find_package_name` is much
+        quicker for looking up a package.
+        """
+        return list(self.pkg_index.values())
+
+    pkg_list = property(get_pkg_list)
 
     def get_last_sync_file(self):
         """
@@ -159,99 +1020,684 @@ class CheeseShop(object):
         """
         return os.path.abspath(self.yolk_dir + "/last_sync")
 
+    def query_last_sync(self):
+        """
+        Return time of the last pkg list sync and PyPI's changelog serial then
+
+        @returns: tuple of seconds since the epoch (0 if never synced) and
+                  changelog serial (None if not known)
+        """
+        try:
+            fields = open(self.last_sync_file, "r").read().split()
+            last_sync = float(fields[0])
+        except (IOError, IndexError, ValueError):
+            return (0, None)
+        if len(fields) > 1 and fields[1].isdigit():
+            return (last_sync, int(fields[1]))
+        return (last_sync, None)
+
+    def write_last_sync(self, serial):
+        """
+        Record that the pkg list is up to date with PyPI's changelog `serial`
+        """
+        if serial is None:
+            serial = ""
+        now = time.time()
+        atomic_write(self.last_sync_file,
+                ("%f %s\n" % (now, serial)).encode('ascii'))
+        self.pkg_list_time = now
+
+    def get_response_cache_file(self):
+        """
+        Returns filename of the release metadata response cache
+        """
+        return os.path.abspath('%s/responses.db' % self.yolk_dir)
+
+    def get_response_cache(self):
+        """
+        Return the release metadata response cache, or None with no_cache
+
+        The first time it is used in a run, cached responses for projects
+        that changed on PyPI since it was last used are dropped. If that
+        fails the cache isn't used at all this run, rather than serving
+        responses that may be stale.
+
+        @returns: `yolk.cache.ResponseCache` or None
+        """
+        if self.no_cache or self.snapshot is not None:
+            return
+        self.response_cache_lock.acquire()
+        try:
+            if self.response_cache is None and not self.response_cache_failed:
+                self.make_yolk_dir()
+                cache = open_response_cache(self.get_response_cache_file())
+                if self.validate_response_cache(cache):
+                    self.response_cache = cache
+                else:
+                    cache.close()
+                    self.response_cache_failed = True
+        finally:
+            self.response_cache_lock.release()
+        return self.response_cache
+
+    def validate_response_cache(self, cache):
+        """
+        Drop cached responses for projects in PyPI's changelog since the
+        cache was last validated
+
+        @param cache: response cache
+        @type cache: `yolk.cache.ResponseCache`
+
+        @returns: False if it couldn't be validated
+        """
+        serial = cache.get_serial()
+        try:
+            if serial is None:
+                #We can't tell what changed, so start again
+                if not cache.clear():
+                    return False
+                serial = self.changelog_last_serial()
+            else:
+                if not self.fetch_changelog_tail(cache, serial):
+                    return False
+                projects = set()
+                for change in cache.iter_changelog_after(serial):
+                    projects.add(normalize_name(change[0]))
+                    serial = max(serial, change[4])
+                if not cache.invalidate(projects):
+                    return False
+        except (xmlrpclib.Fault, xmlrpclib.ProtocolError,
+                httplib.HTTPException, socket.error, IOError,
+                sqlite3.DatabaseError) as err_msg:
+            #socket.error and IOError include the resilience layer's
+            #TransientError and CircuitOpenError
+            self.logger.debug("DEBUG: Can't validate response cache: %s" \
+                    % err_msg)
+            return False
+        if serial is not None:
+            cache.set_serial(serial)
+        return True
+
+    def fetch_changelog_tail(self, cache, serial):
+        """
+        Make sure the response cache has PyPI's changelog entries after
+        `serial`
+
+        Validating the response cache, syncing the package name list and
+        the cached changelog all need the latest changelog entries. They
+        are fetched once a run, since the oldest serial any of them still
+        needs, streamed into the cache, and each reads its entries from
+        there.
+
+        @param cache: response cache
+        @type cache: `yolk.cache.ResponseCache`
+
+        @param serial: changelog serial
+        @type serial: int
+
+        @returns: False if the entries couldn't be cached
+
+        @raises xmlrpclib.Fault: if the server returns a fault
+        @raises xmlrpclib.ProtocolError: on a HTTP error
+        """
+        self.changelog_tail_lock.acquire()
+        try:
+            if self.changelog_tail is not None and \
+                    self.changelog_tail <= serial:
+                return True
+            now = int(time.time())
+            serials = [serial, cache.get_serial()]
+            (start, fetched, changelog_serial) = cache.get_changelog_range()
+            #Only worth bringing up to date if it's still used for the
+            #usual windows
+            if changelog_serial is not None and \
+                    fetched >= now - CHANGELOG_MAX_AGE:
+                serials.append(changelog_serial)
+            (last_sync, sync_serial) = self.query_last_sync()
+            if time.time() - last_sync > self.max_age:
+                serials.append(sync_serial)
+            since_serial = min([value for value in serials \
+                    if value is not None])
+            #Entries left over from earlier runs, those after since_serial
+            #are fetched again
+            if start is None:
+                cache.prune_changelog(now - CHANGELOG_MAX_AGE)
+            else:
+                cache.prune_changelog(min(start, now - CHANGELOG_MAX_AGE))
+            self.logger.debug("DEBUG: Fetching changelog since serial %d" \
+                    % since_serial)
+            last_serial = since_serial
+            batch = []
+            complete = True
+            for entry in self.stream_call('changelog_since_serial',
+                    since_serial):
+                batch.append(entry)
+                if len(batch) >= CHANGELOG_BATCH_SIZE:
+                    complete = cache.add_changelog(batch) and complete
+                    batch = []
+                last_serial = max(last_serial, entry[4])
+            complete = cache.add_changelog(batch) and complete
+            if not complete:
+                return False
+            if changelog_serial is not None and \
+                    since_serial <= changelog_serial:
+                cache.set_changelog_range(start, now, last_serial)
+            self.changelog_tail = since_serial
+            return True
+        finally:
+            self.changelog_tail_lock.release()
+
+    def cached_call(self, method, *args):
+        """
+        Make an XML-RPC call, using the response cache if it is cached
+
+        @param method: XML-RPC method name
+        @type method: string
+
+        @returns: response of XML-RPC call
+        """
+        cache = self.get_response_cache()
+        if cache is None or not cache.is_cached_method(method):
+            return getattr(self.xmlrpc, method)(*args)
+        value = cache.get(method, args)
+        if value is None:
+            value = getattr(self.xmlrpc, method)(*args)
+            cache.set(method, args, normalize_name(args[0]), value)
+        return value
+
     def get_xmlrpc_server(self):
         """
         Returns PyPI's XML-RPC server instance
         """
         check_proxy_setting()
-        if os.environ.has_key('XMLRPC_DEBUG'):
+        if 'XMLRPC_DEBUG' in os.environ:
             debug = 1
         else:
             debug = 0
+        if self.compress_requests:
+            threshold = COMPRESS_THRESHOLD
+        else:
+            threshold = None
+        transport = ProxyTransport(urlparse(XML_RPC_SERVER)[0],
+                encode_threshold=threshold)
         try:
-            return xmlrpclib.Server(XML_RPC_SERVER, transport=ProxyTransport(), verbose=debug)
+            return xmlrpclib.Server(XML_RPC_SERVER, transport=transport,
+                    verbose=debug)
         except IOError:
-            self.logger("ERROR: Can't connect to XML-RPC server: %s" \
+            self.logger.error("ERROR: Can't connect to XML-RPC server: %s" \
                     % XML_RPC_SERVER)
+            raise
 
     def get_pkg_cache_file(self):
         """
         Returns filename of pkg cache
         """
-        return os.path.abspath('%s/pkg_list.pkl' % self.yolk_dir)
+        return os.path.abspath('%s/pkg_list.idx' % self.yolk_dir)
+
+    def find_package_name(self, package_name):
+        """
+        Return the name of a package with the case PyPI uses for it
+
+        @param package_name: package name in any case
+        @type package_name: string
+
+        @returns: string or None if PyPI doesn't list the package
+
+        """
+        key = normalize_name(package_name)
+        if not key in self.pkg_index:
+            self.pkg_list_lock.acquire()
+            try:
+                #Another thread may have refetched it while we waited
+                #Once synced this run, a missing package isn't on PyPI
+                if not key in self.pkg_index and not self.pkg_list_synced:
+                    self.logger.debug("Package %s not in cache, querying PyPI..." \
+                            % package_name)
+                    self.refresh_pkg_list(wait=True)
+            finally:
+                self.pkg_list_lock.release()
+        return self.pkg_index.get(key)
 
     def query_versions_pypi(self, package_name):
         """Fetch list of available versions for a package from The CheeseShop"""
-        if not package_name in self.pkg_list:
-            self.logger.debug("Package %s not in cache, querying PyPI..." \
-                    % package_name)
-            self.fetch_pkg_list()
         #I have to set version=[] for edge cases like "Magic file extensions"
         #but I'm not sure why this happens. It's included with Python or
         #because it has a space in it's name?
         versions = []
-        for pypi_pkg in self.pkg_list:
-            if pypi_pkg.lower() == package_name.lower():
-                if self.debug:
-                    self.logger.debug("DEBUG: %s" % package_name)
-                versions = self.package_releases(pypi_pkg)
-                package_name = pypi_pkg
-                break
+        pypi_pkg = self.find_package_name(package_name)
+        if pypi_pkg:
+            if self.debug:
+                self.logger.debug("DEBUG: %s" % package_name)
+            versions = self.package_releases(pypi_pkg)
+            package_name = pypi_pkg
         return (package_name, versions)
 
+    def query_versions_pypi_many(self, package_names, jobs=1):
+        """
+        Fetch lists of available versions for many packages
+
+        The queries are batched or made concurrently, depending on the
+        backend.
+
+        @param package_names: package names in any case
+        @type package_names: list of strings
+
+        @param jobs: number of batches to request concurrently
+        @type jobs: int
+
+        @returns: yields (package_name, versions) tuples in the same order
+                  as `package_names`, like `query_versions_pypi`
+
+        """
+        pypi_names = [self.find_package_name(name) for name in package_names]
+        releases = self.backend.package_releases_many(
+                [name for name in pypi_names if name], jobs)
+        for (i, pypi_pkg) in enumerate(pypi_names):
+            if not pypi_pkg:
+                yield (package_names[i], [])
+                continue
+            yield (pypi_pkg, next(releases))
+
+    def multicall(self, calls, jobs=1):
+        """
+        Make many XML-RPC calls with as few requests as possible
+
+        Calls are sent in batches of `batch_size` using system.multicall.
+        If the server doesn't support system.multicall we fall back to
+        making each call separately.
+
+        @param calls: XML-RPC method names and their arguments
+        @type calls: list of (string, tuple)
+
+        @param jobs: number of batches to request concurrently
+        @type jobs: int
+
+        @returns: yields results in the same order as `calls`. A call
+                  that failed yields the xmlrpclib.Fault it raised.
+
+        """
+        cache = self.get_response_cache()
+        if cache is None:
+            cached = [None] * len(calls)
+        else:
+            cached = [cache.get(method, args) for (method, args) in calls]
+        #Only ask PyPI for what isn't cached
+        missing = [calls[i] for i in range(len(calls)) if cached[i] is None]
+        size = max(self.batch_size, 1)
+        batches = [missing[i:i + size] for i in range(0, len(missing), size)]
+        results = parallel_map(self.call_batch, batches, jobs)
+        fetched = []
+        for (i, call) in enumerate(calls):
+            if cached[i] is not None:
+                yield cached[i]
+                continue
+            if not fetched:
+                fetched = list(next(results))
+            result = fetched.pop(0)
+            (method, args) = call
+            if cache is not None and cache.is_cached_method(method) and \
+                    not isinstance(result, xmlrpclib.Fault):
+                cache.set(method, args, normalize_name(args[0]), result)
+            yield result
+
+    def call_batch(self, calls):
+        """
+        Make a list of XML-RPC calls in a single system.multicall request
+
+        @param calls: XML-RPC method names and their arguments
+        @type calls: list of (string, tuple)
+
+        @returns: list of results, see `multicall`
+
+        """
+        if self.batch_size <= 1 or len(calls) == 1 or \
+                not self.multicall_supported:
+            return self.call_each(calls)
+        batch = xmlrpclib.MultiCall(self.xmlrpc)
+        for (method, args) in calls:
+            getattr(batch, method)(*args)
+        try:
+            batch_results = batch()
+        except (xmlrpclib.Fault, xmlrpclib.ProtocolError) as err_msg:
+            self.logger.debug("DEBUG: system.multicall failed (%s), " \
+                    "making calls one at a time" % err_msg)
+            self.multicall_supported = False
+            return self.call_each(calls)
+        results = []
+        for i in range(len(calls)):
+            try:
+                results.append(batch_results[i])
+            except xmlrpclib.Fault as fault:
+                results.append(fault)
+        return results
+
+    def call_each(self, calls):
+        """
+        Make a list of XML-RPC calls one request at a time
+
+        @param calls: XML-RPC method names and their arguments
+        @type calls: list of (string, tuple)
+
+        @returns: list of results, see `multicall`
+
+        """
+        results = []
+        for (method, args) in calls:
+            try:
+                results.append(getattr(self.xmlrpc, method)(*args))
+            except xmlrpclib.Fault as fault:
+                results.append(fault)
+        return results
+
     def query_cached_package_list(self):
-        """Return list of pickled package names from PYPI"""
+        """
+        Return memory-mapped store of package names from PYPI
+
+        @returns: `yolk.namestore.PackageNameStore`
+
+        @raises ValueError: if the cache file is damaged
+        """
         if self.debug:
-            self.logger.debug("DEBUG: reading pickled cache file")
-        return cPickle.load(open(self.pkg_cache_file, "r"))
+            self.logger.debug("DEBUG: reading package name cache file")
+        return PackageNameStore(self.pkg_cache_file)
 
     def fetch_pkg_list(self):
         """Fetch and cache master list of package names from PYPI"""
         self.logger.debug("DEBUG: Fetching package name list from PyPI")
-        package_list = self.list_packages()
-        cPickle.dump(package_list, open(self.pkg_cache_file, "w"))
-        self.pkg_list = package_list
+        #Get the serial first so we can't miss changes made meanwhile
+        serial = self.changelog_last_serial()
+        self.write_pkg_list(self.list_packages(), serial)
+
+    def sync_pkg_list(self):
+        """
+        Bring the cached package name list up to date with PyPI
+
+        Only the projects created or removed since the last sync are
+        fetched, using PyPI's changelog serial. The whole list is fetched
+        again if we don't know the serial of the last sync.
+        """
+        (last_sync, serial) = self.query_last_sync()
+        if serial is None:
+            self.fetch_pkg_list()
+            return
+        self.logger.debug("DEBUG: Syncing package name list since serial %s" \
+                % serial)
+        removed = set()
+        added = []
+        try:
+            for (name, version, _timestamp, action, change_serial) in \
+                    self.iter_changelog_after(serial):
+                serial = max(serial, change_serial)
+                key = normalize_name(name)
+                if action == "create":
+                    removed.discard(key)
+                    if not key in self.pkg_index:
+                        added.append(name)
+                elif action == "remove project" or \
+                        (action == "remove" and not version):
+                    removed.add(key)
+        except (xmlrpclib.Fault, xmlrpclib.ProtocolError,
+                sqlite3.DatabaseError):
+            self.fetch_pkg_list()
+            return
+        if not added and not removed:
+            self.write_last_sync(serial)
+            self.pkg_list_synced = True
+            return
+        package_list = [name for name in self.pkg_list + added \
+                if not removed or not normalize_name(name) in removed]
+        self.write_pkg_list(package_list, serial)
+
+    def iter_changelog_after(self, serial):
+        """
+        Yield PyPI's changelog entries after `serial`, from the response
+        cache if it has them, see `fetch_changelog_tail`
+
+        @returns: yields (name, version, timestamp, action, serial) lists
+        """
+        cache = self.get_response_cache()
+        if cache is not None and self.fetch_changelog_tail(cache, serial):
+            return cache.iter_changelog_after(serial)
+        return self.stream_call('changelog_since_serial', serial)
+
+    def write_pkg_list(self, package_list, serial):
+        """
+        Cache package names as synced with changelog `serial`
+
+        Windows can't replace a file that is memory-mapped, so the store
+        we have open is closed first. If another process still has it
+        mapped, the old file is kept and the names are only used for
+        this run; as the last sync isn't recorded, the next run syncs
+        again.
+        """
+        package_list = list(package_list)
+        old_index = self._pkg_index
+        self.pkg_index = build_pkg_index(package_list)
+        if isinstance(old_index, PackageNameStore):
+            old_index.close()
+        self.pkg_list_synced = True
+        try:
+            write_name_store(self.pkg_cache_file, package_list)
+        except (IOError, OSError) as err_msg:
+            self.logger.debug("DEBUG: Can't replace package name cache, " \
+                    "will sync it next time: %s" % err_msg)
+            return
+        self.write_last_sync(serial)
+        self.pkg_index = PackageNameStore(self.pkg_cache_file)
+
+    def changelog_last_serial(self):
+        """
+        Query PYPI via XMLRPC interface for the serial of its latest change
+
+        @returns: int or None if the server doesn't support serials
+        """
+        try:
+            return self.xmlrpc.changelog_last_serial()
+        except xmlrpclib.Fault:
+            return
 
     def search(self, spec, operator):
         '''Query PYPI via XMLRPC interface using search spec'''
+        if self.snapshot is not None:
+            return self.snapshot.search(spec, operator)
         return self.xmlrpc.search(spec, operator.lower())
 
     def changelog(self, hours):
-        '''Query PYPI via XMLRPC interface using search spec'''
-        return self.xmlrpc.changelog(get_seconds(hours))
+        '''Query PYPI via XMLRPC interface for changes in the last `hours`'''
+        return list(self.iter_changelog(hours))
 
     def updated_releases(self, hours):
-        '''Query PYPI via XMLRPC interface using search spec'''
-        return self.xmlrpc.updated_releases(get_seconds(hours))
+        '''Query PYPI via XMLRPC interface for releases in the last `hours`'''
+        return list(self.iter_updated_releases(hours))
+
+    def iter_changelog(self, hours):
+        """
+        Yield PyPI changelog entries for the last `hours` as they are read
+
+        @returns: yields (name, version, timestamp, action) lists
+        """
+        if self.snapshot is not None:
+            self.logger.warning("The snapshot has no changelog")
+            return iter([])
+        since = get_seconds(hours)
+        cache = self.get_response_cache()
+        if cache is None:
+            return self.stream_call('changelog', since)
+        return self.iter_cached_changelog(cache, since)
+
+    def iter_updated_releases(self, hours):
+        """
+        Yield releases made on PyPI in the last `hours` as they are read
+
+        @returns: yields (name, version) lists
+        """
+        if self.snapshot is not None:
+            self.logger.warning("The snapshot has no changelog")
+            return iter([])
+        since = get_seconds(hours)
+        cache = self.get_response_cache()
+        if cache is None:
+            return self.stream_call('updated_releases', since)
+        return self.iter_cached_updated_releases(cache, since)
+
+    def iter_cached_changelog(self, cache, since):
+        """
+        Yield changelog entries since time `since`, fetching only those
+        that aren't in the response cache yet
+
+        PyPI's changelog methods only take a start, so a window can't be
+        split into slices that are fetched on their own. Instead entries
+        are kept, and when the cache covers the start of the window only
+        the entries after its last serial are fetched, along with those
+        the rest of the run needs (see `fetch_changelog_tail`). Entries
+        are cached as they are read; the cache only counts as complete
+        once the whole response has been read.
+
+        @returns: yields (name, version, timestamp, action) lists
+        """
+        (start, fetched, serial) = cache.get_changelog_range()
+        fetch_time = int(time.time())
+        if serial is not None and start <= since <= fetched:
+            if self.fetch_changelog_tail(cache, serial):
+                for entry in cache.iter_changelog(since):
+                    yield entry
+                return
+            for entry in cache.iter_changelog(since):
+                yield entry
+            entries = self.stream_call('changelog_since_serial', serial)
+        else:
+            #Nothing cached for the start of the window, fetch all of it
+            self.logger.debug("DEBUG: Fetching changelog since %d" % since)
+            start = since
+            entries = self.stream_call('changelog', since, True)
+        batch = []
+        complete = True
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= CHANGELOG_BATCH_SIZE:
+                complete = cache.add_changelog(batch) and complete
+                batch = []
+            if serial is None or entry[4] > serial:
+                serial = entry[4]
+            yield entry[:4]
+        complete = cache.add_changelog(batch) and complete
+        if complete and serial is not None:
+            cache.set_changelog_range(start, fetch_time, serial)
+            cache.prune_changelog(min(since, fetch_time - CHANGELOG_MAX_AGE))
+
+    def iter_cached_updated_releases(self, cache, since):
+        """
+        Yield releases made since time `since`, newest first
+
+        If the cached changelog covers the window, only the entries after
+        it are fetched and the releases come from the cache. Otherwise
+        they are streamed from PyPI's updated_releases, which is much
+        smaller than the changelog it would take to fill the cache.
+
+        @returns: yields (name, version) lists
+        """
+        (start, fetched, serial) = cache.get_changelog_range()
+        if serial is None or not start <= since <= fetched:
+            for release in self.stream_call('updated_releases', since):
+                yield release
+            return
+        for _entry in self.iter_cached_changelog(cache, since):
+            pass
+        for release in cache.iter_new_releases(since):
+            yield release
+
+    def stream_call(self, method, *args):
+        """
+        Make an XML-RPC call returning an array, yielding its items while
+        the response is still being read
+
+        Unlike a call through `xmlrpc`, memory use doesn't grow with the
+        size of the response.
+
+        @param method: XML-RPC method name
+        @type method: string
+
+        @raises xmlrpclib.Fault: if the server returns a fault
+        @raises xmlrpclib.ProtocolError: on a HTTP error
+        """
+        check_proxy_setting()
+        body = xmlrpclib.dumps(args, method, allow_none=True)
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        headers = {'User-Agent': xmlrpclib.Transport.user_agent,
+                'Content-Type': 'text/xml', 'Accept-Encoding': 'gzip'}
+        def open_response():
+            (scheme, host, conn, response) = CONNECTION_POOL.request('POST',
+                    XML_RPC_SERVER, body, headers,
+                    'XMLRPC_DEBUG' in os.environ)
+            if response.status != 200:
+                conn.close()
+                raise xmlrpclib.ProtocolError(XML_RPC_SERVER,
+                        response.status, response.reason, response.msg)
+            return (scheme, host, conn, response)
+        #Only opening the response is retried, it is read as it arrives
+        (scheme, host, conn, response) = CONNECTION_POOL.resilience.call(
+                urlparse(XML_RPC_SERVER)[1], open_response, hedge=False)
+        finished = False
+        try:
+            for item in iter_xmlrpc_array(decode_response(response)):
+                yield item
+            finished = True
+        finally:
+            if finished:
+                CONNECTION_POOL.release(scheme, host, conn, response)
+            else:
+                conn.close()
 
     def list_packages(self):
         """Query PYPI via XMLRPC interface for a a list of all package names"""
+        if self.snapshot is not None:
+            return self.snapshot.list_packages()
         return self.xmlrpc.list_packages()
 
     def release_urls(self, package_name, version):
-        """Query PYPI via XMLRPC interface for a pkg's available versions"""
-
-        return self.xmlrpc.release_urls(package_name, version)
+        """Query PYPI for a release's files"""
+        return self.backend.release_urls(package_name, version)
 
     def release_data(self, package_name, version):
-        """Query PYPI via XMLRPC interface for a pkg's metadata"""
-        try:
-            return self.xmlrpc.release_data(package_name, version)
-        except xmlrpclib.Fault:
-            #XXX Raises xmlrpclib.Fault if you give non-existant version
-            #Could this be server bug?
-            return
+        """Query PYPI for a pkg's metadata, None if there's no such version"""
+        return self.backend.release_data(package_name, version)
+
+    def package_releases(self, package_name, show_hidden=False):
+        """
+        Query PYPI for a pkg's available versions
 
-    def package_releases(self, package_name):
-        """Query PYPI via XMLRPC interface for a pkg's available versions"""
+        @param show_hidden: True for every release, not just the latest
+        @type show_hidden: boolean
+        """
         if self.debug:
             self.logger.debug("DEBUG: querying PyPI for versions of " \
                     + package_name)
-        return self.xmlrpc.package_releases(package_name)
+        return self.backend.package_releases(package_name, show_hidden)
 
-    def get_download_urls(self, package_name, version="", pkg_type="all"):
+    def get_download_urls(self, package_name, version="", pkg_type="all",
+            jobs=4):
         """Query PyPI for pkg download URI for a packge"""
+        return list(self.iter_download_urls(package_name, version, pkg_type,
+            jobs))
+
+    def iter_download_urls(self, package_name, version="", pkg_type="all",
+            jobs=4):
+        """
+        Yield download URLs of a package, newest release first
+
+        Without a version every release is queried, `jobs` requests at a
+        time, and each release's URLs are yielded as soon as they and
+        those of the releases before it are known.
+
+        @param pkg_type: 'source', 'egg' or 'all'
+        @type pkg_type: string
 
+        @param jobs: maximum number of concurrent requests
+        @type jobs: int
+
+        @returns: yields URL strings
+        """
         if version:
             versions = [version]
         else:
@@ -260,30 +1706,177 @@ class CheeseShop(object):
 
             (package_name, versions) = self.query_versions_pypi(package_name)
 
+        #Metadata is only used for its download_url when filtering by type
         all_urls = []
-        for ver in versions:
-            metadata = self.release_data(package_name, ver)
-            for urls in self.release_urls(package_name, ver):
-                if pkg_type == "source" and urls['packagetype'] == "sdist":
-                    all_urls.append(urls['url'])
-                elif pkg_type == "egg" and \
-                        urls['packagetype'].startswith("bdist"):
-                    all_urls.append(urls['url'])
-                elif pkg_type == "all":
-                    #All
-                    all_urls.append(urls['url'])
-
-            #Try the package's metadata directly in case there's nothing
-            #returned by XML-RPC's release_urls()
-            if metadata and metadata.has_key('download_url') and \
-                        metadata['download_url'] != "UNKNOWN" and \
-                        metadata['download_url'] != None:
-                if metadata['download_url'] not in all_urls:
-                    if pkg_type != "all":
-                        url = filter_url(pkg_type, metadata['download_url'])
-                        if url:
-                            all_urls.append(url)
-        return all_urls
+        for (metadata, release_urls) in self.backend.iter_release_files(
+                package_name, versions, pkg_type != "all", jobs):
+            found = len(all_urls)
+            add_download_urls(all_urls, pkg_type, release_urls, metadata)
+            for url in all_urls[found:]:
+                yield url
+
+def add_download_urls(all_urls, pkg_type, release_urls, metadata):
+    """
+    Add download URLs of the wanted file type for one release to a list
+
+    @param all_urls: URLs found so far, added to in place
+    @type all_urls: list of strings
+
+    @param pkg_type: 'source', 'egg' or 'all'
+    @type pkg_type: string
+
+    @param release_urls: files of the release, from PyPI's release_urls
+    @type release_urls: list of dicts
+
+    @param metadata: metadata of the release, from PyPI's release_data
+    @type metadata: dict or None
+
+    @returns: None
+
+    """
+    for urls in release_urls:
+        if pkg_type == "source" and urls['packagetype'] == "sdist":
+            all_urls.append(urls['url'])
+        elif pkg_type == "egg" and \
+                urls['packagetype'].startswith("bdist"):
+            all_urls.append(urls['url'])
+        elif pkg_type == "all":
+            #All
+            all_urls.append(urls['url'])
+
+    #Try the package's metadata directly in case there's nothing
+    #returned by XML-RPC's release_urls()
+    if metadata and 'download_url' in metadata and \
+                metadata['download_url'] != "UNKNOWN" and \
+                metadata['download_url'] != None:
+        if metadata['download_url'] not in all_urls:
+            if pkg_type != "all":
+                url = filter_url(pkg_type, metadata['download_url'])
+                if url:
+                    all_urls.append(url)
+
+def iter_xmlrpc_array(response):
+    """
+    Parse an XML-RPC response holding an array, yielding each item as
+    soon as it has been read
+
+    Items are dropped from the parse tree once yielded.
+
+    @param response: XML-RPC response
+    @type response: file-like object
+
+    @raises xmlrpclib.Fault: if the response is a fault
+    """
+    path = []
+    items = None
+    for (event, elem) in iterparse(response, events=('start', 'end')):
+        if event == 'start':
+            if path == ['methodResponse', 'params', 'param', 'value',
+                    'array'] and elem.tag == 'data':
+                items = elem
+            path.append(elem.tag)
+            continue
+        path.pop()
+        if elem.tag == 'value' and items is not None and \
+                len(path) == 6 and path[-1] == 'data':
+            yield unmarshal_value(elem)
+            items.clear()
+        elif elem.tag == 'fault' and path == ['methodResponse']:
+            fault = unmarshal_value(elem.find('value'))
+            raise xmlrpclib.Fault(fault['faultCode'], fault['faultString'])
+
+def unmarshal_value(value):
+    """
+    Return Python value of an XML-RPC <value> element
+
+    @param value: <value> element
+    @type value: ElementTree element
+    """
+    if not len(value):
+        return value.text or ""
+    elem = value[0]
+    if elem.tag == 'string':
+        return elem.text or ""
+    elif elem.tag in ('int', 'i4', 'i8'):
+        return int(elem.text)
+    elif elem.tag == 'boolean':
+        return elem.text.strip() == '1'
+    elif elem.tag == 'double':
+        return float(elem.text)
+    elif elem.tag == 'nil':
+        return None
+    elif elem.tag == 'dateTime.iso8601':
+        return xmlrpclib.DateTime(elem.text.strip())
+    elif elem.tag == 'base64':
+        return xmlrpclib.Binary(base64.b64decode(elem.text or ""))
+    elif elem.tag == 'array':
+        return [unmarshal_value(item) for item in elem.find('data')]
+    elif elem.tag == 'struct':
+        return dict([(member.findtext('name'),
+            unmarshal_value(member.find('value'))) for member in elem])
+    raise ValueError("Unknown XML-RPC type: %s" % elem.tag)
+
+def build_pkg_index(package_list):
+    """
+    Return dict mapping normalized package names to PyPI package names
+
+    @param package_list: package names from PyPI
+    @type package_list: list of strings
+
+    @returns: dict
+
+    """
+    pkg_index = {}
+    for name in package_list:
+        pkg_index.setdefault(normalize_name(name), name)
+    return pkg_index
+
+def get_latest_version(doc):
+    """
+    Return the version XML-RPC's package_releases would give for a
+    project's JSON document
+
+    That is the version PyPI shows for the project, the latest stable
+    release, unless it was yanked or has no files left. Then it's the
+    newest stable release that still has files that aren't yanked.
+
+    @param doc: project document, see `JSONBackend.get_project`
+    @type doc: dict
+
+    @returns: version string or None
+    """
+    releases = doc.get('releases', {})
+    def is_available(version):
+        return [release for release in releases.get(version, [])
+                if not release.get('yanked')]
+    latest = doc['info'].get('version')
+    #A release missing from 'releases' is taken on trust
+    if latest and (is_available(latest) or latest not in releases):
+        return latest
+    for version in sort_versions(releases.keys()):
+        if is_available(version) and not is_prerelease(version):
+            return version
+
+def sort_versions(versions):
+    """
+    Return versions sorted newest first, like PyPI's package_releases
+
+    Versions that don't parse, e.g. legacy ones from before PEP 440, are
+    left out.
+
+    @param versions: version strings
+    @type versions: iterable of strings
+
+    @returns: list of strings
+    """
+    keyed = []
+    for version in versions:
+        try:
+            keyed.append((parse_version(version), version))
+        except ValueError:
+            continue
+    keyed.sort(reverse=True)
+    return [version for (key, version) in keyed]
 
 def filter_url(pkg_type, url):
     """
@@ -0,0 +1,315 @@
+"""
+
+resilience.py
+=============
+
+Desc: Retries, hedged requests and a circuit breaker for PyPI requests
+
+      A `Resilience` object wraps each request yolk makes to PyPI:
+
+      - failed requests that are safe to repeat are retried after a
+        randomized, exponentially growing delay
+      - if hedging is on, a request that takes longer than most recent
+        ones did is sent a second time, and whichever answer comes
+        first is used
+      - after several failures in a row to a host, requests to it fail
+        straight away for a while instead of each waiting for a timeout
+
+      What happened is counted in `Resilience.counters`.
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import platform
+import random
+import socket
+import sys
+import threading
+import time
+if platform.python_version().startswith('2'):
+    import httplib
+    import Queue as queue
+    import xmlrpclib
+else:
+    import http.client as httplib
+    import queue
+    import xmlrpc.client as xmlrpclib
+
+
+#Seconds to wait for a connection or for data before giving up
+REQUEST_TIMEOUT = 30
+
+#Times a failed request is tried again
+MAX_RETRIES = 3
+
+#Seconds before the first retry, doubled for each retry after it
+RETRY_BACKOFF = 0.5
+
+#Most seconds to wait between retries
+MAX_RETRY_BACKOFF = 8
+
+#Failures in a row before requests to a host are turned down
+BREAKER_THRESHOLD = 5
+
+#Seconds requests are turned down for before one is let through again
+BREAKER_RESET = 30
+
+#Latencies of recent requests kept for the hedging threshold
+LATENCY_SAMPLES = 200
+
+#Requests timed before any are hedged
+HEDGE_MIN_SAMPLES = 20
+
+#HTTP status codes worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransientError(IOError):
+
+    """A HTTP error response that may not happen if the request is retried"""
+
+    def __init__(self, status, reason, url):
+        IOError.__init__(self, "%s %s from %s" % (status, reason, url))
+        self.status = status
+
+
+class CircuitOpenError(IOError):
+
+    """Raised instead of sending a request to a host that keeps failing"""
+
+    pass
+
+
+class Resilience(object):
+
+    """
+    Retry, hedging and circuit breaker policy for requests to PyPI
+
+    It is safe to use from several threads at once.
+    """
+
+    def __init__(self, retries=MAX_RETRIES, backoff=RETRY_BACKOFF,
+            hedge_percentile=None, breaker_threshold=BREAKER_THRESHOLD,
+            breaker_reset=BREAKER_RESET):
+        """
+        @param retries: times a failed request is tried again
+        @type retries: int
+
+        @param backoff: seconds before the first retry
+        @type backoff: float
+
+        @param hedge_percentile: send a second copy of a request that
+                                 takes longer than this percentile (e.g.
+                                 95) of recent requests, None to never
+        @type hedge_percentile: float
+
+        @param breaker_threshold: failures in a row before a host's
+                                  requests are turned down, 0 for never
+        @type breaker_threshold: int
+
+        @param breaker_reset: seconds before a turned down host is tried
+        @type breaker_reset: float
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.lock = threading.Lock()
+        self.latencies = []
+        #Failures in a row and time the breaker opened, for each host
+        self.breakers = {}
+        self.counters = {'requests': 0, 'retries': 0, 'failures': 0,
+                'hedged': 0, 'hedge_wins': 0, 'rejected': 0}
+
+    def count(self, name):
+        """Add one to a counter"""
+        self.lock.acquire()
+        try:
+            self.counters[name] += 1
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """Return the counters as a string for the log"""
+        return ", ".join(["%s=%d" % (name, self.counters[name])
+            for name in sorted(self.counters)])
+
+    def call(self, host, func, idempotent=True, hedge=True):
+        """
+        Make a request, retrying and hedging it as the policy says
+
+        @param host: host the request goes to, for the circuit breaker
+        @type host: string
+
+        @param func: makes the request and returns its result
+        @type func: function taking no arguments
+
+        @param idempotent: False if the request mustn't be repeated
+        @type idempotent: boolean
+
+        @param hedge: False if the request mustn't be sent twice at once,
+                      e.g. because its response is streamed
+        @type hedge: boolean
+
+        @returns: what `func` returns
+
+        @raises CircuitOpenError: if the host keeps failing
+        """
+        attempt = 0
+        while True:
+            self.check_breaker(host)
+            self.count('requests')
+            try:
+                if idempotent and hedge:
+                    result = self.hedged(func)
+                else:
+                    result = self.timed(func)
+            except:
+                err_msg = sys.exc_info()[1]
+                if not is_transient(err_msg):
+                    raise
+                self.count('failures')
+                self.record_failure(host)
+                if not idempotent or attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.count('retries')
+                #"Full jitter", so clients that failed together don't
+                #all come back at the same time
+                time.sleep(random.uniform(0, min(MAX_RETRY_BACKOFF,
+                    self.backoff * 2 ** (attempt - 1))))
+                continue
+            self.record_success(host)
+            return result
+
+    def timed(self, func):
+        """Call `func` and keep its latency for the hedging threshold"""
+        start = time.time()
+        result = func()
+        self.lock.acquire()
+        try:
+            self.latencies.append(time.time() - start)
+            del self.latencies[:-LATENCY_SAMPLES]
+        finally:
+            self.lock.release()
+        return result
+
+    def hedge_delay(self):
+        """
+        Return seconds to wait for an answer before sending a request
+        again, or None if it shouldn't be
+        """
+        if self.hedge_percentile is None:
+            return
+        self.lock.acquire()
+        try:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return
+            latencies = sorted(self.latencies)
+        finally:
+            self.lock.release()
+        index = int(len(latencies) * self.hedge_percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def hedged(self, func):
+        """
+        Call `func`, and call it again in another thread if it is slow
+
+        The first successful answer is returned. The other call is left
+        to finish on its own.
+        """
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.timed(func)
+        answers = queue.Queue()
+        def run(hedge):
+            try:
+                answers.put((True, self.timed(func), hedge))
+            except:
+                answers.put((False, sys.exc_info()[1], hedge))
+        start_thread(run, False)
+        try:
+            (ok, result, hedge) = answers.get(timeout=delay)
+            pending = 0
+        except queue.Empty:
+            self.count('hedged')
+            start_thread(run, True)
+            (ok, result, hedge) = answers.get()
+            pending = 1
+        if not ok and pending:
+            #The other copy may still get an answer
+            (ok, result, hedge) = answers.get()
+        if not ok:
+            raise result
+        if hedge:
+            self.count('hedge_wins')
+        return result
+
+    def check_breaker(self, host):
+        """
+        Raise CircuitOpenError if requests to `host` are turned down
+
+        Once `breaker_reset` seconds have passed, requests are let
+        through again; another failure turns them down again.
+        """
+        if not self.breaker_threshold:
+            return
+        self.lock.acquire()
+        try:
+            (failures, opened) = self.breakers.get(host, (0, None))
+            if opened is None or time.time() - opened >= self.breaker_reset:
+                return
+        finally:
+            self.lock.release()
+        self.count('rejected')
+        raise CircuitOpenError("Not sending requests to %s after %d " \
+                "failures" % (host, failures))
+
+    def record_failure(self, host):
+        """Count a failed request, opening the breaker after too many"""
+        self.lock.acquire()
+        try:
+            (failures, opened) = self.breakers.get(host, (0, None))
+            failures += 1
+            if self.breaker_threshold and failures >= self.breaker_threshold:
+                opened = time.time()
+            self.breakers[host] = (failures, opened)
+        finally:
+            self.lock.release()
+
+    def record_success(self, host):
+        """Close the breaker of a host that answered"""
+        self.lock.acquire()
+        try:
+            self.breakers.pop(host, None)
+        finally:
+            self.lock.release()
+
+
+def is_transient(err_msg):
+    """
+    Return True if a request that failed with `err_msg` is worth retrying
+
+    Network errors, timeouts and HTTP 429 and 5xx responses are. XML-RPC
+    faults and other HTTP errors aren't.
+    """
+    if isinstance(err_msg, CircuitOpenError):
+        return False
+    if isinstance(err_msg, TransientError):
+        return True
+    if isinstance(err_msg, xmlrpclib.ProtocolError):
+        return err_msg.errcode in RETRY_STATUSES
+    return isinstance(err_msg, (socket.error, socket.timeout,
+        httplib.HTTPException))
+
+
+def start_thread(target, *args):
+    """Run target(*args) in a daemon thread"""
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
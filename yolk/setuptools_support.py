@@ -12,7 +12,8 @@ License  : BSD (See COPYING)
 """
 
 
-from yolk.yolklib import Distributions
+#get_pkglist moved to yolklib, it can still be imported from here
+from yolk.yolklib import get_pkglist
 
 from setuptools.package_index import PackageIndex
 import pkg_resources
@@ -79,22 +80,3 @@ def get_download_uri(package_name, version, source, index_url=None):
             return
         else:
             return clean_url
-
-def get_pkglist():
-    """
-    Return list of all installed packages
-
-    Note: It returns one project name per pkg no matter how many versions
-    of a particular package is installed
-
-    @returns: list of project name strings for every installed pkg
-
-    """
-
-    dists = Distributions()
-    projects = []
-    for (dist, _active) in dists.get_distributions("all"):
-        if dist.project_name not in projects:
-            projects.append(dist.project_name)
-    return projects
-
@@ -0,0 +1,404 @@
+"""
+
+simpleindex.py
+==============
+
+Desc: Find download links on a PEP 503 "simple" package index
+
+      Only the project's own page, /simple/<project>/, is fetched. It is
+      parsed while it is being read, and links are filtered by file type
+      and version without following homepage or download links the way
+      setuptools' PackageIndex does.
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import codecs
+import platform
+import re
+import sys
+if platform.python_version().startswith('2'):
+    from HTMLParser import HTMLParser
+    from urllib import quote
+    from urlparse import urldefrag, urljoin, urlparse
+else:
+    from html.parser import HTMLParser
+    from urllib.parse import quote, urldefrag, urljoin, urlparse
+
+from yolk import pypi
+from yolk.__init__ import __version__ as VERSION
+from yolk.resilience import RETRY_STATUSES, TransientError
+from yolk.utils import normalize_name
+from yolk.yolklib import parse_version, version_key
+
+
+#File extensions of source distributions
+SOURCE_EXTENSIONS = (".tar.gz", ".tgz", ".zip", ".tar.bz2", ".tbz2")
+
+#Python tags of wheels this interpreter can install, e.g. py3, py311, cp311
+PYTHON_TAGS = ["py%d" % sys.version_info[0],
+        "py%d%d" % sys.version_info[:2]]
+if platform.python_implementation() == 'CPython':
+    PYTHON_TAGS.append("cp%d%d" % sys.version_info[:2])
+
+#Bytes read from the project page at a time
+CHUNK_SIZE = 16 * 1024
+
+
+class LinkParser(HTMLParser):
+
+    """
+    Incremental HTML parser that finds links
+
+    `callback` is called with the absolute URL and attributes of each
+    <a href> as soon as it has been fed.
+    """
+
+    def __init__(self, base_url, callback):
+        HTMLParser.__init__(self)
+        self.base_url = base_url
+        self.callback = callback
+
+    def handle_starttag(self, tag, attrs):
+        """Report links, and follow <base href> for relative ones"""
+        attrs = dict(attrs)
+        if not attrs.get('href'):
+            return
+        if tag == 'base':
+            self.base_url = urljoin(self.base_url, attrs['href'])
+        elif tag == 'a':
+            self.callback(urljoin(self.base_url, attrs['href']), attrs)
+
+
+class SimpleIndex(object):
+
+    """Client for a PEP 503 simple package index, e.g. a PyPI mirror"""
+
+    def __init__(self, index_url=None, pool=None):
+        """
+        @param index_url: URL of the index, PyPI's /simple/ if None
+        @type index_url: string
+
+        @param pool: connections to use, `yolk.pypi.CONNECTION_POOL` if None
+        @type pool: `yolk.pypi.ConnectionPool`
+        """
+        if not index_url:
+            index_url = urljoin(pypi.XML_RPC_SERVER, '/simple/')
+        if not index_url.endswith('/'):
+            index_url += '/'
+        self.index_url = index_url
+        if pool is None:
+            pool = pypi.CONNECTION_POOL
+        self.pool = pool
+        #ProjectLinks of projects scanned, by normalized name
+        self.scans = {}
+
+    def project_url(self, project_name):
+        """Return URL of a project's page on the index"""
+        return urljoin(self.index_url, quote(normalize_name(project_name)) +
+                '/')
+
+    def iter_links(self, project_name):
+        """
+        Yield links on a project's page as the page is read
+
+        Nothing is yielded if the index doesn't have the project. If the
+        caller stops early the rest of the page isn't downloaded.
+
+        @returns: yields (url, attrs) tuples
+
+        @raises IOError: on a HTTP error
+        """
+        url = self.project_url(project_name)
+        for _redirect in range(pypi.MAX_REDIRECTS + 1):
+            #Only opening the page is retried, it is parsed as it arrives
+            (scheme, host, conn, response) = self.pool.resilience.call(
+                    urlparse(url)[1], lambda: self.open_page(url),
+                    hedge=False)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self.pool.release(scheme, host, conn, response)
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                self.pool.release(scheme, host, conn, response)
+                if response.status == 404:
+                    return
+                raise IOError("%s %s from %s" % (response.status,
+                    response.reason, url))
+            break
+        else:
+            raise IOError("Too many redirects from %s" % url)
+
+        links = []
+        parser = LinkParser(url, lambda link, attrs: links.append((link,
+            attrs)))
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        body = pypi.decode_response(response)
+        finished = False
+        try:
+            while True:
+                data = body.read(CHUNK_SIZE)
+                parser.feed(decoder.decode(data, not data))
+                while links:
+                    yield links.pop(0)
+                if not data:
+                    break
+            parser.close()
+            for link in links:
+                yield link
+            finished = True
+        finally:
+            if finished:
+                self.pool.release(scheme, host, conn, response)
+            else:
+                #Unread data is left on the connection
+                conn.close()
+
+    def scan(self, project_name):
+        """
+        Read a project's page once and sort its links by kind
+
+        The result is kept, so finding files of several kinds, or
+        finding and then fetching one, reads the page only once.
+
+        @returns: `ProjectLinks`
+
+        @raises IOError: on a HTTP error
+        """
+        key = normalize_name(project_name)
+        if key not in self.scans:
+            links = ProjectLinks(project_name)
+            for (url, attrs) in self.iter_links(project_name):
+                links.add(url, attrs)
+            self.scans[key] = links
+        return self.scans[key]
+
+    def open_page(self, url):
+        """
+        GET a page, leaving the body to be read
+
+        @returns: tuple of scheme, host, connection and response, see
+                  `yolk.pypi.ConnectionPool.request`
+
+        @raises TransientError: on a response worth retrying, e.g. 503
+        """
+        headers = {'User-Agent': 'yolk/%s' % VERSION,
+                'Accept-Encoding': 'gzip'}
+        (scheme, host, conn, response) = self.pool.request('GET', url, None,
+                headers)
+        if response.status in RETRY_STATUSES:
+            response.read()
+            self.pool.release(scheme, host, conn, response)
+            raise TransientError(response.status, response.reason, url)
+        return (scheme, host, conn, response)
+
+    def find_download_uri(self, project_name, version, source):
+        """
+        Return URL of a project's source or egg file
+
+        @param project_name: project name
+        @type project_name: string
+
+        @param version: version wanted, None for the highest, or 'dev' for
+                        a link to the development version (#egg=name-dev)
+        @type version: string
+
+        @param source: True for a source distribution, False for an egg
+        @type source: boolean
+
+        @returns: URL string or None if there's no such file
+        """
+        return self.scan(project_name).find_download_uri(version, source)
+
+
+class ProjectLinks(object):
+
+    """
+    Links found on a project's simple index page, sorted by kind
+
+    `sources` and `binaries` are lists of (version, url, yanked) tuples
+    for source distributions and for eggs and wheels this Python can
+    install, in page order. `dev` is a list of links to the development
+    version.
+    """
+
+    def __init__(self, project_name):
+        self.project_name = project_name
+        self.sources = []
+        self.binaries = []
+        self.dev = []
+
+    def add(self, url, attrs):
+        """Put a link in its bucket, links to other files are ignored"""
+        (url, fragment) = urldefrag(url)
+        if fragment.startswith("egg=") and normalize_name(fragment[4:]) == \
+                normalize_name(self.project_name + "-dev"):
+            self.dev.append(url)
+            return
+        filename = url.rsplit('/', 1)[-1]
+        yanked = 'data-yanked' in attrs
+        for (source, bucket) in ((True, self.sources),
+                (False, self.binaries)):
+            file_version = get_file_version(filename, self.project_name,
+                    source)
+            if file_version is not None:
+                bucket.append((file_version, url, yanked))
+                return
+
+    def find_download_uri(self, version, source):
+        """
+        Return URL of a source or egg file
+
+        See `SimpleIndex.find_download_uri`.
+        """
+        if version == "dev":
+            if self.dev:
+                return self.dev[0]
+            return
+        if version:
+            wanted = version_key(version)
+        best = None
+        if source:
+            bucket = self.sources
+        else:
+            bucket = self.binaries
+        for (file_version, url, yanked) in bucket:
+            try:
+                key = parse_version(file_version)
+            except ValueError:
+                #One oddly named file shouldn't hide the others
+                continue
+            if version:
+                if key == wanted:
+                    return url
+            elif not yanked and (best is None or key > best[0]):
+                best = (key, url)
+        if best is not None:
+            return best[1]
+
+
+def get_file_version(filename, project_name, source):
+    """
+    Return version of a project's file from its name
+
+    @param filename: file name, e.g. yolk-0.4.3.tar.gz
+    @type filename: string
+
+    @param project_name: project the file must belong to
+    @type project_name: string
+
+    @param source: True to match source distributions, False to match
+                   eggs and wheels this Python can install
+    @type source: boolean
+
+    @returns: version string or None if the file isn't a match, or its
+              version doesn't parse, e.g. foo-1.0.win32.zip made by
+              bdist_dumb
+    """
+    key = normalize_name(project_name)
+    lower = filename.lower()
+    if source:
+        for extension in SOURCE_EXTENSIONS:
+            if lower.endswith(extension):
+                base = filename[:-len(extension)]
+                break
+        else:
+            return
+        #The project name may have '-' in it too
+        pos = base.find('-')
+        while pos != -1:
+            if normalize_name(base[:pos]) == key:
+                return get_valid_version(base[pos + 1:])
+            pos = base.find('-', pos + 1)
+        return
+    if lower.endswith(".whl"):
+        return get_wheel_version(filename, key)
+    if not lower.endswith(".egg"):
+        return
+    #name-version(-pyX.Y(-platform)).egg with '-' escaped as '_' in parts
+    parts = filename[:-4].split('-')
+    if len(parts) < 2 or normalize_name(parts[0]) != key:
+        return
+    if len(parts) > 2 and parts[2] != "py%d.%d" % sys.version_info[:2]:
+        return
+    return get_valid_version(parts[1].replace('_', '-'))
+
+
+def get_wheel_version(filename, key):
+    """
+    Return version of a wheel this Python can install, else None
+
+    Only the Python and platform tags are checked, roughly the way pip
+    does: pure Python wheels and ones for this platform are kept.
+
+    @param filename: file name, e.g. yolk-0.4.3-py2.py3-none-any.whl
+    @type filename: string
+
+    @param key: normalized name of the project the file must belong to
+    @type key: string
+    """
+    #name-version(-build)-python-abi-platform.whl
+    parts = filename[:-4].split('-')
+    if len(parts) not in (5, 6) or normalize_name(parts[0]) != key:
+        return
+    if not [tag for tag in parts[-3].split('.') if tag in PYTHON_TAGS]:
+        return
+    if not [tag for tag in parts[-1].split('.') if is_platform_tag(tag)]:
+        return
+    return get_valid_version(parts[1])
+
+
+def is_platform_tag(tag):
+    """
+    Return True if a wheel's platform tag is 'any' or this platform's,
+    e.g. linux_x86_64 or manylinux2014_x86_64 on 64-bit Linux
+    """
+    if tag == 'any':
+        return True
+    try:
+        import sysconfig
+        this_platform = sysconfig.get_platform()
+    except ImportError:
+        #Python 2.6
+        from distutils.util import get_platform
+        this_platform = get_platform()
+    this_platform = re.sub(r'[-.]', '_', this_platform)
+    if tag == this_platform:
+        return True
+    machine = this_platform.split('_', 1)[-1]
+    if this_platform.startswith('linux_'):
+        return re.match(r'(many|musl)linux.*_%s$' % re.escape(machine),
+                tag) is not None
+    if this_platform.startswith('macosx_'):
+        return tag.startswith('macosx_') and (tag.endswith('_universal2')
+                or tag.endswith('_' + this_platform.rsplit('_', 1)[-1]))
+    return False
+
+
+def get_valid_version(version):
+    """Return `version` if it parses, else None"""
+    try:
+        parse_version(version)
+    except ValueError:
+        return
+    return version
+
+
+def get_download_uri(package_name, version, source, index_url=None):
+    """
+    Search a simple index for a package's URI
+
+    Replaces `yolk.setuptools_support.get_download_uri` with a single
+    request for the project's page. Use `SimpleIndex.scan` to find files
+    of several kinds with one request.
+
+    @returns: URI string
+    """
+    return SimpleIndex(index_url).find_download_uri(package_name, version,
+            source)
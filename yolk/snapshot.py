@@ -0,0 +1,300 @@
+"""
+
+snapshot.py
+===========
+
+Desc: Local snapshot of The CheeseShop (PyPI) for use offline
+
+      `write_snapshot` saves the package name list and the versions,
+      metadata and files of chosen projects (or every project) to an
+      SQLite database. `Snapshot` reads it back and answers the same
+      queries `yolk.pypi.CheeseShop` sends to PyPI, so yolk can run
+      where there is no network, with reproducible results.
+
+      Values are stored as JSON so a snapshot can be read by any Python
+      version.
+
+License  : BSD (See COPYING)
+
+"""
+
+__docformat__ = 'restructuredtext'
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+
+from yolk.utils import normalize_name, parallel_map, replace_file
+
+
+class NameIndex(object):
+
+    """
+    Mapping of normalized package names to PyPI package names, read from
+    a snapshot
+
+    It supports `in`, `get`, `values` and `len` like
+    `yolk.namestore.PackageNameStore`.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """Return the PyPI name of a package given its normalized name"""
+        row = self.conn.execute("SELECT name FROM names WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def values(self):
+        """Yield every package name, in sorted order"""
+        for (name,) in self.conn.execute("SELECT name FROM names ORDER BY name"):
+            yield name
+
+
+class Snapshot(object):
+
+    """
+    Read-only snapshot of PyPI
+
+    Used as the backend of `yolk.pypi.CheeseShop` in offline mode, see
+    `yolk.pypi.XMLRPCBackend` for the methods it has to provide. Projects
+    that weren't saved look like projects with no releases.
+    """
+
+    name = 'snapshot'
+
+    def __init__(self, filename):
+        """
+        @param filename: file written by `write_snapshot`
+        @type filename: string
+
+        @raises IOError: if the file doesn't exist
+        @raises sqlite3.DatabaseError: if it isn't a snapshot
+        """
+        if not os.path.exists(filename):
+            raise IOError("No such snapshot: %s" % filename)
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("SELECT COUNT(*) FROM releases").fetchone()
+        self.names = NameIndex(self.conn)
+
+    def get_meta(self, name):
+        """
+        Return information about the snapshot, e.g. its 'created' time
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?",
+                (name,)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def list_packages(self):
+        """Return every package name on PyPI when the snapshot was taken"""
+        return list(self.names.values())
+
+    def package_releases(self, package_name, show_hidden=False):
+        """
+        Return versions of a package, newest first
+
+        Every release that was saved is returned, so older ones can be
+        asked about offline too.
+        """
+        row = self.conn.execute("SELECT versions FROM projects WHERE key = ?",
+                (normalize_name(package_name),)).fetchone()
+        if row is None:
+            return []
+        return json.loads(row[0])
+
+    def package_releases_many(self, package_names, jobs=1):
+        """Yield versions of each package in `package_names`, in order"""
+        for package_name in package_names:
+            yield self.package_releases(package_name)
+
+    def get_release(self, package_name, version):
+        """
+        Return metadata and files of a release
+
+        @returns: tuple of metadata dict (or None) and list of files
+        """
+        row = self.conn.execute("""SELECT metadata, urls FROM releases
+                WHERE key = ? AND version = ?""",
+                (normalize_name(package_name), version)).fetchone()
+        if row is None:
+            return (None, [])
+        return (json.loads(row[0]), json.loads(row[1]))
+
+    def release_data(self, package_name, version):
+        """Return metadata of a release or None if there is no such release"""
+        return self.get_release(package_name, version)[0]
+
+    def release_urls(self, package_name, version):
+        """Return files of a release"""
+        return self.get_release(package_name, version)[1]
+
+    def get_releases(self, package_name, versions, metadata=True):
+        """Return list of (metadata, files) tuples, one for each version"""
+        releases = []
+        for version in versions:
+            (release_data, release_urls) = self.get_release(package_name,
+                    version)
+            if not metadata:
+                release_data = None
+            releases.append((release_data, release_urls))
+        return releases
+
+    def iter_release_files(self, package_name, versions, metadata=True,
+            jobs=1):
+        """
+        Yield (metadata, files) of several releases, in version order,
+        with metadata only for releases without files
+        """
+        for (release_data, release_urls) in self.get_releases(package_name,
+                versions, metadata):
+            if release_urls:
+                release_data = None
+            yield (release_data, release_urls)
+
+    def search(self, spec, operator):
+        """
+        Search metadata of saved releases like PyPI's XML-RPC search
+
+        @param spec: metadata field names and terms to find in them, a
+                     term matches if it is part of the field's value
+        @type spec: dict of strings or lists of strings
+
+        @param operator: 'and' or 'or'
+        @type operator: string
+
+        @returns: list of dicts with name, version and summary
+        """
+        terms = []
+        for (field, values) in spec.items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                terms.append((field, value.strip().lower()))
+        results = []
+        for (metadata,) in self.conn.execute("""SELECT metadata FROM releases
+                WHERE metadata != 'null' ORDER BY key, version"""):
+            metadata = json.loads(metadata)
+            matches = [term in (u"%s" % (metadata.get(field) or "")).lower()
+                    for (field, term) in terms]
+            if (operator.lower() == 'or' and any(matches)) or \
+                    (operator.lower() != 'or' and matches and all(matches)):
+                results.append({'name': metadata.get('name'),
+                    'version': metadata.get('version'),
+                    'summary': metadata.get('summary')})
+        return results
+
+    def close(self):
+        """Close the database"""
+        self.conn.close()
+
+
+def write_snapshot(shop, filename, project_names=None, jobs=1):
+    """
+    Save PyPI data to a snapshot file
+
+    The file is replaced once the snapshot is complete.
+
+    @param shop: where to get the data from
+    @type shop: `yolk.pypi.CheeseShop`
+
+    @param filename: snapshot file to write
+    @type filename: string
+
+    @param project_names: projects to save, every project on PyPI if None
+    @type project_names: list of strings
+
+    @param jobs: number of projects to query concurrently
+    @type jobs: int
+
+    @returns: number of projects saved
+    """
+    logger = logging.getLogger("yolk")
+    package_list = shop.pkg_list
+    if project_names is None:
+        project_names = package_list
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    (tmp_fd, tmp_file) = tempfile.mkstemp(dir=directory, suffix='.tmp',
+            prefix=os.path.basename(filename) + '.')
+    os.close(tmp_fd)
+    try:
+        conn = sqlite3.connect(tmp_file)
+        try:
+            conn.executescript("""
+                CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE names (key TEXT PRIMARY KEY, name TEXT);
+                CREATE TABLE projects (key TEXT PRIMARY KEY, name TEXT,
+                    versions TEXT);
+                CREATE TABLE releases (key TEXT, version TEXT, metadata TEXT,
+                    urls TEXT, PRIMARY KEY (key, version));
+                """)
+            conn.execute("INSERT INTO meta (name, value) VALUES (?, ?)",
+                    ('created', str(time.time())))
+            names = {}
+            for name in package_list:
+                names.setdefault(normalize_name(name), name)
+            conn.executemany("INSERT INTO names (key, name) VALUES (?, ?)",
+                    names.items())
+
+            count = 0
+            for project in parallel_map(lambda name: get_project(shop, name),
+                    project_names, jobs):
+                if project is None:
+                    continue
+                (name, versions, releases) = project
+                key = normalize_name(name)
+                conn.execute("""INSERT OR REPLACE INTO projects
+                        (key, name, versions) VALUES (?, ?, ?)""",
+                        (key, name, to_json(versions)))
+                conn.executemany("""INSERT OR REPLACE INTO releases
+                        (key, version, metadata, urls) VALUES (?, ?, ?, ?)""",
+                        [(key, versions[i], to_json(releases[i][0]),
+                            to_json(releases[i][1]))
+                            for i in range(len(versions))])
+                count += 1
+            conn.commit()
+        finally:
+            conn.close()
+        replace_file(tmp_file, filename)
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    logger.debug("DEBUG: Saved %d projects to snapshot %s" % (count,
+        filename))
+    return count
+
+
+def get_project(shop, package_name):
+    """
+    Query PyPI for everything a snapshot keeps about a project
+
+    @returns: tuple of PyPI name, versions and (metadata, files) of each
+              version, or None if PyPI doesn't have the project
+    """
+    name = shop.find_package_name(package_name)
+    if not name:
+        logging.getLogger("yolk").warning("%s isn't on PyPI, not saved" \
+                % package_name)
+        return
+    versions = shop.package_releases(name, True)
+    return (name, versions, shop.backend.get_releases(name, versions))
+
+
+def to_json(value):
+    """Encode a value for the snapshot, XML-RPC dates become strings"""
+    return json.dumps(value, sort_keys=True, default=str)
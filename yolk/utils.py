@@ -14,8 +14,21 @@ run_command borrowed from Cheesecake - See CREDITS.
 __docformat__ = 'restructuredtext'
 
 import os
+import platform
+import re
 import signal
+import sys
+import tempfile
 import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, STDOUT
 
 
@@ -27,6 +40,142 @@ def get_yolk_dir():
     return os.path.abspath("%s/.yolk" % os.path.expanduser("~"))
 
 
+def get_snapshot_file(backend):
+    """
+    Return filename of the installed distributions snapshot
+
+    Each interpreter and backend has its own, so using several of them
+    doesn't make each run scan everything again.
+
+    @param backend: 'pkg_resources' or 'importlib', the backend that
+                    finds the distributions
+    @type backend: string
+    """
+    interpreter = "%s%d.%d" % (platform.python_implementation().lower(),
+            sys.version_info[0], sys.version_info[1])
+    return os.path.join(get_yolk_dir(),
+            'installed-%s-%s.json' % (interpreter, backend))
+
+
+def normalize_name(name):
+    """
+    Return a package name normalized as described in PEP 503
+
+    Case is folded and runs of '-', '_' and '.' become a single '-', so
+    'Zope.Interface' and 'zope_interface' both give 'zope-interface'
+
+    @param name: package name
+    @type name: string
+
+    @returns: normalized package name string
+
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def atomic_write(filename, data):
+    """
+    Write `data` to a file so readers see the old or new contents, never
+    a partly written file
+
+    The data is written to a temporary file in the same directory, which
+    is then renamed over `filename`.
+
+    @param filename: file to write
+    @type filename: string
+
+    @param data: contents of the file
+    @type data: bytes
+
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    (tmp_fd, tmp_file) = tempfile.mkstemp(dir=directory, suffix='.tmp',
+            prefix=os.path.basename(filename) + '.')
+    try:
+        tmp = os.fdopen(tmp_fd, 'wb')
+        try:
+            tmp.write(data)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        replace_file(tmp_file, filename)
+    except:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def replace_file(src, dst):
+    """
+    Rename `src` to `dst`, replacing `dst` if it exists
+
+    This is atomic except on Windows with Python 2.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class FileLock(object):
+
+    """
+    Advisory lock shared between processes, held on a lock file
+
+    Locking does nothing on platforms with neither fcntl nor msvcrt.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fileobj = None
+
+    def acquire(self, blocking=True):
+        """
+        Lock the file
+
+        @param blocking: wait for another process to release the lock
+        @type blocking: boolean
+
+        @returns: True if we have the lock, False if it is held elsewhere
+        """
+        self.fileobj = open(self.filename, 'a')
+        try:
+            if fcntl:
+                flags = fcntl.LOCK_EX
+                if not blocking:
+                    flags |= fcntl.LOCK_NB
+                fcntl.flock(self.fileobj.fileno(), flags)
+            elif msvcrt:
+                if blocking:
+                    mode = msvcrt.LK_LOCK
+                else:
+                    mode = msvcrt.LK_NBLCK
+                self.fileobj.seek(0)
+                msvcrt.locking(self.fileobj.fileno(), mode, 1)
+        except (IOError, OSError):
+            self.fileobj.close()
+            self.fileobj = None
+            return False
+        return True
+
+    def release(self):
+        """Unlock the file"""
+        if self.fileobj is None:
+            return
+        try:
+            if fcntl:
+                fcntl.flock(self.fileobj.fileno(), fcntl.LOCK_UN)
+            elif msvcrt:
+                self.fileobj.seek(0)
+                msvcrt.locking(self.fileobj.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.fileobj.close()
+            self.fileobj = None
+
+
 def run_command(cmd, env=None, max_timeout=None):
     """
     Run command and return its return status code and its output
@@ -61,3 +210,78 @@ def command_successful(cmd):
     """
     return_code, _output = run_command(cmd)
     return return_code == 0
+
+def parallel_map(func, items, jobs=1):
+    """
+    Yield func(item) for every item in `items`, in the original order
+
+    Calls are spread over a pool of `jobs` threads and each result is
+    yielded as soon as it and every result before it are ready.
+    With `jobs` <= 1 the calls are made one after another.
+
+    @param func: callable taking a single item
+    @type func: function
+
+    @param items: items to call `func` with
+    @type items: list
+
+    @param jobs: maximum number of concurrent calls
+    @type jobs: int
+
+    @returns: generator of results
+    """
+    items = list(items)
+    if not jobs or jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        for result in pool.imap(func, items):
+            yield result
+    finally:
+        pool.terminate()
+
+def get_python_lib():
+    """
+    Return the site-packages directory packages are installed in
+
+    distutils' answer is used where Python still has it, as it differs
+    from sysconfig's on some systems, e.g. Debian's dist-packages.
+    Python 2.6 has no sysconfig, and Python 3.12 no distutils.
+
+    @returns: directory name
+    """
+    import warnings
+    try:
+        #Python 3.10 and 3.11 warn that distutils is going away
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            from distutils.sysconfig import get_python_lib as distutils_lib
+    except ImportError:
+        import sysconfig
+        return sysconfig.get_path('purelib')
+    return distutils_lib()
+
+def iter_entry_points(group):
+    """
+    Return entry points of installed packages in `group`
+
+    importlib.metadata is used where Python has it, which is much quicker
+    to import than pkg_resources.
+
+    @param group: entry point group, e.g. 'yolk.plugins'
+    @type group: string
+
+    @returns: iterable of entry points, each with a load() method
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return pkg_resources.iter_entry_points(group)
+    points = entry_points()
+    if hasattr(points, 'select'):
+        return points.select(group=group)
+    #Python 3.8 and 3.9 return a dict of groups
+    return points.get(group, [])
@@ -17,19 +17,108 @@ License  : BSD (See COPYING)
 
 __docformat__ = 'restructuredtext'
 
-import pkg_resources
+import os
+import re
+import sys
+try:
+    from importlib import metadata as importlib_metadata
+except ImportError:
+    #Python 2 and Python 3 before 3.8
+    importlib_metadata = None
 
+from yolk.metadata import get_metadata
+
+
+#Ways of finding installed packages, see `get_installed`
+INSTALLED_BACKENDS = ('auto', 'importlib', 'pkg_resources')
+
+#Python version part of an egg's filename, e.g. foo-1.0-py2.7.egg
+EGG_PY_VERSION = re.compile(r'-py(\d+\.\d+)(?:-|\.egg$)')
+
+#Versions as PEP 440 allows them to be written, see `parse_version`
+VERSION_PATTERN = re.compile(r"""^\s*v?(?:\d+!)?\d+(?:\.\d+)*
+        (?:[-_.]?(?:a|b|c|rc|alpha|beta|pre|preview)[-_.]?\d*)?
+        (?:-\d+|[-_.]?(?:post|rev|r)[-_.]?\d*)?
+        (?:[-_.]?dev[-_.]?\d*)?
+        (?:\+[a-z0-9]+(?:[-_.][a-z0-9]+)*)?\s*$""", re.VERBOSE | re.IGNORECASE)
+
+
+def get_installed(backend='auto', snapshot_file=None):
+    """
+    Return installed packages found on sys.path
+
+    importlib.metadata is used if Python has it and `backend` is 'auto',
+    so pkg_resources and setuptools are only imported by the commands
+    that need them.
+
+    @param backend: one of `INSTALLED_BACKENDS`
+    @type backend: string
+
+    @param snapshot_file: see `Distributions`
+    @type snapshot_file: string
+
+    @returns: `Distributions` or `MetadataDistributions`
+    """
+    if get_installed_backend(backend) == 'importlib':
+        return MetadataDistributions(snapshot_file=snapshot_file)
+    return Distributions(snapshot_file)
+
+
+def get_installed_backend(backend='auto'):
+    """
+    Return the backend `get_installed` uses for `backend`
+
+    @param backend: one of `INSTALLED_BACKENDS`
+    @type backend: string
+
+    @returns: 'importlib' or 'pkg_resources'
+    """
+    if backend == 'importlib' or (backend == 'auto' and importlib_metadata):
+        return 'importlib'
+    return 'pkg_resources'
 
 
 class Distributions(object):
 
     """Helper class for pkg_resources"""
 
-    def __init__(self):
-        """init"""
+    def __init__(self, snapshot_file=None):
+        """
+        @param snapshot_file: keep what was found on sys.path in this file
+                              and only rescan what changed, see
+                              `yolk.envcache`. Scan everything if None.
+        @type snapshot_file: string
+        """
 
-        self.environment = pkg_resources.Environment()
-        self.working_set = pkg_resources.WorkingSet()
+        import pkg_resources
+        if snapshot_file:
+            from yolk.envcache import load_environment
+            (self.environment, self.working_set) = \
+                    load_environment(snapshot_file)
+        else:
+            self.environment = pkg_resources.Environment()
+            self.working_set = pkg_resources.WorkingSet()
+        #Built on first use, see get_index
+        self.index = None
+        self.active = None
+
+    def get_index(self):
+        """
+        Return index of installed distributions, built once
+
+        @returns: dict of project keys to dicts of versions to lists of
+                  pkg_resources Distribution objects
+
+        """
+        if self.index is None:
+            index = {}
+            for key in self.environment:
+                for dist in self.environment[key]:
+                    index.setdefault(key, {}).setdefault(dist.version,
+                            []).append(dist)
+            self.index = index
+            self.active = set(self.working_set)
+        return self.index
 
     def query_activated(self, dist):
         """
@@ -41,10 +130,8 @@ class Distributions(object):
         @returns: True or False
 
         """
-        if dist in self.working_set:
-            return True
-        else:
-            return False
+        self.get_index()
+        return dist in self.active
 
     def get_distributions(self, show, pkg_name="", version=""):
         """
@@ -63,18 +150,16 @@ class Distributions(object):
                   on active state. e.g. (dist, True)
 
         """
+        index = self.get_index()
         #pylint: disable-msg=W0612
         #'name' is a placeholder for the sorted list
         for name, dist in self.get_alpha(show, pkg_name, version):
-            ver = dist.version
-            for package in self.environment[dist.project_name]:
-                if ver == package.version:
-                    if show == "nonactive" and dist not in self.working_set:
-                        yield (dist, self.query_activated(dist))
-                    elif show == "active" and dist in self.working_set:
-                        yield (dist, self.query_activated(dist))
-                    elif show == "all":
-                        yield (dist, self.query_activated(dist))
+            if dist.version not in index.get(dist.key, {}):
+                continue
+            active = self.query_activated(dist)
+            if (show == "nonactive" and not active) or \
+                    (show == "active" and active) or show == "all":
+                yield (dist, active)
 
     def get_alpha(self, show, pkg_name="", version=""):
         """
@@ -92,7 +177,7 @@ class Distributions(object):
 
         """
         alpha_list = []
-        for dist in self.get_packages(show):
+        for dist in self.get_packages(show, pkg_name):
             if pkg_name and dist.project_name != pkg_name:
                 #Only checking for a single package name
                 pass
@@ -104,25 +189,36 @@ class Distributions(object):
         alpha_list.sort()
         return alpha_list
 
-    def get_packages(self, show):
+    def get_packages(self, show, pkg_name=""):
         """
         Return list of Distributions filtered by active status or all
 
         @param show: Type of package(s) to show; active, non-active or all
         @type show: string: "active", "non-active", "all"
 
+        @param pkg_name: only return this project's distributions, and
+                         maybe those of projects differing in case
+        @type pkg_name: string
+
         @returns: list of pkg_resources Distribution objects
         """
-
-
+        index = self.get_index()
         if show == 'nonactive' or show == "all":
+            if pkg_name:
+                projects = [index.get(pkg_name.lower(), {})]
+            else:
+                projects = index.values()
             all_packages = []
-            for package in self.environment:
-                #There may be multiple versions of same packages
-                for i in range(len(self.environment[package])):
-                    if self.environment[package][i]:
-                        all_packages.append(self.environment[package][i])
+            #There may be multiple versions of same packages
+            for versions in projects:
+                for dists in versions.values():
+                    all_packages.extend(dists)
             return all_packages
+        elif pkg_name:
+            dist = self.working_set.by_key.get(pkg_name.lower())
+            if dist is None:
+                return []
+            return [dist]
         else:
             # Only activated packages
             return self.working_set
@@ -154,7 +250,7 @@ class Distributions(object):
 def get_highest_version(versions):
     """
     Returns highest available version for a package in a list of versions
-    Uses pkg_resources to parse the versions
+    Uses `version_key` to compare the versions
 
     @param versions: List of PyPI package versions
     @type versions: List of strings
@@ -163,11 +259,308 @@ def get_highest_version(versions):
 
 
     """
-    sorted_versions = []
-    for ver in versions:
-        sorted_versions.append((pkg_resources.parse_version(ver), ver))
+    return max(versions, key=version_key)
+
+
+
+def get_pkglist(dists=None):
+    """
+    Return list of all installed packages
+
+    Note: It returns one project name per pkg no matter how many versions
+    of a particular package is installed
+
+    @param dists: installed packages, found on sys.path if None
+    @type dists: `Distributions`
+
+    @returns: list of project name strings for every installed pkg
+
+    """
+
+    if dists is None:
+        dists = get_installed()
+    projects = []
+    for (dist, _active) in dists.get_distributions("all"):
+        if dist.project_name not in projects:
+            projects.append(dist.project_name)
+    return projects
+
+
+class MetadataDistributions(Distributions):
+
+    """
+    Installed packages found with importlib.metadata, without pkg_resources
+
+    Distributions are `InstalledDistribution` objects, which have the
+    parts of pkg_resources Distributions yolk uses.
+    """
+
+    def __init__(self, search_path=None, snapshot_file=None):
+        """
+        @param search_path: path entries, sys.path if None
+        @type search_path: list of strings
+
+        @param snapshot_file: see `Distributions`
+        @type snapshot_file: string
+        """
+        if search_path is None:
+            search_path = sys.path
+        if snapshot_file:
+            from yolk.envcache import load_metadata_environment
+            (self.environment, self.working_set) = \
+                    load_metadata_environment(snapshot_file, search_path)
+        else:
+            (self.environment, self.working_set) = \
+                    build_environment(search_path, find_entry_dists)
+        self.index = None
+        self.active = None
+
+
+class MetadataEnvironment(object):
+
+    """
+    Installed distributions by project, like a pkg_resources Environment
+    """
+
+    def __init__(self):
+        self.dists = {}
+
+    def add(self, dist):
+        """Add a distribution, keeping each project's newest first"""
+        dists = self.dists.setdefault(dist.key, [])
+        if dist not in dists:
+            dists.append(dist)
+            dists.sort(key=lambda dist: version_key(dist.version),
+                    reverse=True)
+
+    def __iter__(self):
+        return iter(list(self.dists.keys()))
+
+    def __getitem__(self, project_name):
+        return self.dists.get(project_name.lower(), [])
+
+
+class MetadataWorkingSet(object):
+
+    """
+    Active distributions, like a pkg_resources WorkingSet: the first one
+    found on sys.path for each project
+    """
+
+    def __init__(self):
+        self.dists = []
+        self.by_key = {}
+
+    def add(self, dist):
+        """Add a distribution unless its project already has one"""
+        if dist.key not in self.by_key:
+            self.by_key[dist.key] = dist
+            self.dists.append(dist)
+
+    def __iter__(self):
+        return iter(self.dists)
+
+
+class InstalledDistribution(object):
+
+    """
+    An importlib.metadata distribution with the attributes and methods
+    of a pkg_resources Distribution that yolk uses
+    """
+
+    def __init__(self, dist, project_name=None, version=None):
+        """
+        @param dist: importlib.metadata Distribution object
+        @type dist: importlib.metadata Distribution object
+
+        @param project_name: name if already known, e.g. from a snapshot
+        @type project_name: string
+
+        @param version: version if already known
+        @type version: string
+        """
+        self.dist = dist
+        #The metadata directory, if the distribution was found in one,
+        #so metadata files can be opened and only their headers read
+        path = getattr(dist, '_path', None)
+        self.path = path is not None and str(path) or None
+        if project_name is None or version is None:
+            headers = get_metadata(self, ['Name', 'Version']) or {}
+            project_name = safe_name(headers.get('Name') or '')
+            version = headers.get('Version') or ''
+        self.project_name = project_name
+        self.version = version
+        self.key = self.project_name.lower()
+        self.location = os.path.normpath(str(dist.locate_file('')))
+
+    def has_metadata(self, name):
+        """Return True if the metadata file `name` exists"""
+        if self.path is not None:
+            return self.metadata_file(name) is not None
+        return self.get_metadata(name) is not None
+
+    def get_metadata(self, name):
+        """
+        Return contents of the metadata file `name`, or None
+
+        The core metadata is PKG-INFO in .egg-info directories and
+        METADATA in .dist-info directories, either name finds it.
+        """
+        text = self.dist.read_text(name)
+        if text is None and name == 'PKG-INFO':
+            text = self.dist.read_text('METADATA')
+        return text
+
+    def metadata_file(self, name):
+        """
+        Return filename of the metadata file `name`, or None if it isn't
+        a file on disk, see `get_metadata`
+        """
+        if self.path is None:
+            return
+        names = [name]
+        if name == 'PKG-INFO':
+            names.append('METADATA')
+        for filename in names:
+            filename = os.path.join(self.path, filename)
+            if os.path.isfile(filename):
+                return filename
+
+    def __str__(self):
+        return "%s %s" % (self.project_name, self.version)
+
+
+def build_environment(search_path, get_dists):
+    """
+    Return the installed and the active distributions on `search_path`
+
+    @param search_path: path entries
+    @type search_path: list of strings
+
+    @param get_dists: returns distributions in a path entry, see
+                      `find_entry_dists`
+    @type get_dists: function
+
+    @returns: tuple of `MetadataEnvironment` and `MetadataWorkingSet`
+    """
+    environment = MetadataEnvironment()
+    working_set = MetadataWorkingSet()
+    on_path = set([os.path.normcase(os.path.abspath(path_item or '.'))
+        for path_item in search_path])
+    for path_item in search_path:
+        for (dist, egg) in get_dists(path_item or '.'):
+            if not egg:
+                environment.add(dist)
+                working_set.add(dist)
+            elif os.path.normcase(dist.location) not in on_path:
+                #Eggs not on sys.path are installed but not active, like
+                #those installed with 'easy_install --multi-version'
+                environment.add(dist)
+    return (environment, working_set)
+
+
+def find_entry_dists(path_item):
+    """
+    Return distributions found in a path entry, and in the eggs in it
+
+    @returns: list of (`InstalledDistribution`, is_egg) tuples
+    """
+    dists = [(dist, False) for dist in find_distributions(path_item)]
+    for egg in find_eggs(path_item):
+        dists.extend([(dist, True) for dist in find_distributions(egg)])
+    return dists
+
+
+def find_distributions(path_item):
+    """
+    Yield `InstalledDistribution` objects for the metadata in a path entry
+    """
+    if importlib_metadata is None:
+        return
+    for dist in importlib_metadata.distributions(path=[path_item]):
+        try:
+            found = InstalledDistribution(dist)
+        except (IOError, OSError, TypeError, ValueError):
+            #Damaged metadata
+            continue
+        if found.project_name:
+            yield found
+
+
+def find_eggs(path_item):
+    """
+    Return paths of eggs for this version of Python in a directory
+    """
+    try:
+        names = sorted(os.listdir(path_item))
+    except OSError:
+        return []
+    eggs = []
+    this_python = "%d.%d" % sys.version_info[:2]
+    for name in names:
+        if not name.lower().endswith('.egg'):
+            continue
+        match = EGG_PY_VERSION.search(name)
+        if match and match.group(1) != this_python:
+            continue
+        eggs.append(os.path.abspath(os.path.join(path_item, name)))
+    return eggs
+
+
+def safe_name(name):
+    """
+    Return project name with runs of characters other than letters,
+    digits and '.' replaced by '-', like pkg_resources.safe_name
+    """
+    return re.sub('[^A-Za-z0-9.]+', '-', name)
+
 
-    sorted_versions = sorted(sorted_versions)
-    sorted_versions.reverse()
-    return sorted_versions[0][1]
+def version_key(version):
+    """
+    Return sort key for a version string, without pkg_resources
 
+    Trailing zeros don't count (1.0 == 1.0.0), and development and
+    pre-releases (1.0.dev1, 1.0a1) come before the release, post-releases
+    (1.0.post1, 1.0-1) after it.
+    """
+    match = re.match(r'v?(\d+(?:\.\d+)*)(.*)$', version.strip().lower())
+    if match:
+        release = [int(part) for part in match.group(1).split('.')]
+        suffix = match.group(2)
+    else:
+        release = []
+        suffix = version.lower()
+    while release and release[-1] == 0:
+        release.pop()
+    parts = [(part.isdigit(), part.isdigit() and int(part) or 0, part)
+            for part in re.findall(r'\d+|[a-z]+', suffix)]
+    if not parts:
+        rank = 1
+    elif parts[0][2] == 'dev':
+        rank = -1
+    elif parts[0][0] or parts[0][2] in ('post', 'rev', 'r'):
+        rank = 2
+    else:
+        rank = 0
+    return (release, rank, parts)
+
+
+def parse_version(version):
+    """
+    Return sort key for a version string, like `version_key`, if it is a
+    PEP 440 version
+
+    @raises ValueError: if it isn't, e.g. '1.0.win32' taken from the
+                        name of a bdist_dumb file
+    """
+    if not VERSION_PATTERN.match(version):
+        raise ValueError("Invalid version: %r" % version)
+    return version_key(version)
+
+
+def is_prerelease(version):
+    """
+    Return True for a development or pre-release, e.g. 1.0a1 or 1.0.dev1
+    """
+    (release, rank, parts) = version_key(version.split('+')[0])
+    return rank <= 0 or 'dev' in [part for (digit, number, part) in parts]